@@ -0,0 +1,100 @@
+import heapq
+import random
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+
+import numpy as np
+import pyrallis
+
+from osrl.common.dataset import grid_filter, select_optimal_trajectory
+
+
+@dataclass
+class BenchConfig:
+    num_trajs: int = 50000
+    cost_bins: int = 60
+    rew_bins: int = 50
+    max_num_per_bin: int = 10
+    min_num_per_bin: int = 2
+    npb: int = 5
+    repeats: int = 3
+    seed: int = 0
+
+
+def reference_grid_filter(x, y, xbins, ybins, max_num_per_bin, min_num_per_bin):
+    """The original dict-of-lists implementation without bounds, kept for comparison."""
+    xmin, xmax = min(x), max(x)
+    ymin, ymax = min(y), max(y)
+    xbin_step = (xmax - xmin) / xbins
+    ybin_step = (ymax - ymin) / ybins
+    bin_hashmap = defaultdict(list)
+    for i in range(len(x)):
+        bin_hashmap[((x[i] - xmin) // xbin_step, (y[i] - ymin) // ybin_step)].append(i)
+    indices = []
+    for v in bin_hashmap.values():
+        if len(v) > max_num_per_bin:
+            indices += random.sample(v, max_num_per_bin)
+        elif len(v) > min_num_per_bin:
+            indices += v
+    return indices
+
+
+def reference_select_optimal(trajs, cost_bins, max_num_per_bin):
+    """The original heapq implementation with rmin=-inf, kept for comparison."""
+    rew = [traj["returns"][0] for traj in trajs]
+    cost = [traj["cost_returns"][0] for traj in trajs]
+    xmin, xmax = min(cost), max(cost)
+    xbin_step = (xmax - xmin) / cost_bins
+    bin_hashmap = defaultdict(list)
+    for i in range(len(cost)):
+        bin_hashmap[(cost[i] - xmin) // xbin_step].append(i)
+    indices = []
+    for v in bin_hashmap.values():
+        indices += heapq.nlargest(max_num_per_bin, v, key=lambda idx: rew[idx])
+    return [trajs[i] for i in indices]
+
+
+def timeit(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    return (time.perf_counter() - start) / repeats, out
+
+
+@pyrallis.wrap()
+def bench(args: BenchConfig):
+    rng = np.random.default_rng(args.seed)
+    cost = rng.uniform(0, 100, args.num_trajs).astype(np.float32)
+    rew = (rng.uniform(0, 1000, args.num_trajs) * np.sqrt(cost / 100)).astype(np.float32)
+    trajs = [{"returns": [r], "cost_returns": [c]} for r, c in zip(rew, cost)]
+
+    ref_time, ref = timeit(
+        lambda: reference_grid_filter(cost, rew, args.cost_bins, args.rew_bins, args.
+                                      max_num_per_bin, args.min_num_per_bin),
+        args.repeats)
+    new_time, new = timeit(
+        lambda: grid_filter(cost,
+                            rew,
+                            xbins=args.cost_bins,
+                            ybins=args.rew_bins,
+                            max_num_per_bin=args.max_num_per_bin,
+                            min_num_per_bin=args.min_num_per_bin,
+                            rng=np.random.default_rng(args.seed)), args.repeats)
+    # the subsampled bins differ, but every bin keeps the same number of points
+    same_size = len(ref) == len(new)
+    print(f"grid_filter: {ref_time:.4f}s -> {new_time:.4f}s "
+          f"({ref_time / new_time:.1f}x), same size: {same_size}")
+
+    ref_time, ref = timeit(
+        lambda: reference_select_optimal(trajs, args.cost_bins, args.npb), args.repeats)
+    new_time, new = timeit(
+        lambda: select_optimal_trajectory(trajs, -np.inf, args.cost_bins, args.npb),
+        args.repeats)
+    same = [id(traj) for traj in ref] == [id(traj) for traj in new]
+    print(f"select_optimal_trajectory: {ref_time:.4f}s -> {new_time:.4f}s "
+          f"({ref_time / new_time:.1f}x), identical: {same}")
+
+
+if __name__ == "__main__":
+    bench()
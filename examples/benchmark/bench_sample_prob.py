@@ -0,0 +1,65 @@
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import pyrallis
+from scipy.optimize import minimize
+from tqdm.auto import trange
+
+from osrl.common.dataset import compute_sample_prob
+
+
+@dataclass
+class BenchConfig:
+    num_trajs: int = 20000
+    deg: int = 3
+    max_cost: float = 100.0
+    max_reward: float = 1000.0
+    beta: float = 1.0
+    # number of trajectories solved with the per-trajectory BFGS reference
+    reference_trajs: int = 2000
+    seed: int = 0
+
+
+def reference_sample_prob(rew_ret, cost_ret, pareto_frontier, beta):
+    """The original per-trajectory BFGS implementation, kept for comparison."""
+    sample_prob = []
+    for i in trange(cost_ret.shape[0], desc="BFGS reference"):
+        r, c = rew_ret[i], cost_ret[i]
+        dist_fun = lambda x: (x - c)**2 + (pareto_frontier(x) - r)**2
+        sol = minimize(dist_fun, x0=c, method="bfgs", tol=1e-4)
+        x = np.max([0, (sol.x)[0]])
+        sample_prob.append(1 / (np.sqrt(dist_fun(x)) + beta))
+    return np.array(sample_prob)
+
+
+@pyrallis.wrap()
+def bench(args: BenchConfig):
+    rng = np.random.default_rng(args.seed)
+    cost_ret = rng.uniform(0, args.max_cost, args.num_trajs)
+    rew_ret = rng.uniform(0, args.max_reward, args.num_trajs) * np.sqrt(
+        cost_ret / args.max_cost)
+    noise = rng.normal(0, 0.05 * args.max_reward, args.num_trajs)
+    pareto_frontier = np.poly1d(np.polyfit(cost_ret, rew_ret + noise, deg=args.deg))
+    dataset = [{"returns": [r], "cost_returns": [c]} for r, c in zip(rew_ret, cost_ret)]
+
+    start = time.perf_counter()
+    sample_prob = compute_sample_prob(dataset, pareto_frontier, args.beta)
+    batched_time = time.perf_counter() - start
+
+    n = min(args.reference_trajs, args.num_trajs)
+    start = time.perf_counter()
+    ref = reference_sample_prob(rew_ret[:n], cost_ret[:n], pareto_frontier, args.beta)
+    ref_time = (time.perf_counter() - start) * args.num_trajs / n
+
+    # renormalize both over the reference subset before comparing
+    batched = sample_prob[:n] / sample_prob[:n].sum()
+    ref /= ref.sum()
+    print(f"trajectories: {args.num_trajs}, frontier degree: {args.deg}")
+    print(f"batched: {batched_time:.3f}s, BFGS (extrapolated): {ref_time:.3f}s, "
+          f"speedup: {ref_time / batched_time:.1f}x")
+    print(f"max relative difference: {np.max(np.abs(batched - ref) / ref):.2e}")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,124 @@
+import time
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+import pyrallis
+import torch
+from pyrallis import field
+
+from osrl.common.dataset import TransitionDataset, from_storage_dtype
+
+
+@dataclass
+class BenchConfig:
+    # a DSRL task, or None for a synthetic dataset
+    task: Optional[str] = None
+    num_transitions: int = 1_000_000
+    obs_dim: int = 64
+    act_dim: int = 8
+    batch_size: int = 512
+    num_batches: int = 2000
+    dtypes: List[str] = field(default=["float16", "bfloat16"], is_mutable=True)
+    # BC update steps per dtype before the evaluation, 0 to skip the training comparison
+    update_steps: int = 0
+    eval_episodes: int = 10
+    cost_limit: float = 10
+    device: str = "cpu"
+    seed: int = 0
+
+
+def synthetic_dataset(args: BenchConfig) -> dict:
+    rng = np.random.default_rng(args.seed)
+    n = args.num_transitions
+    observations = rng.normal(0, 5, (n + 1, args.obs_dim)).astype(np.float32)
+    return {
+        "observations": observations[:-1],
+        "next_observations": observations[1:],
+        "actions": rng.uniform(-1, 1, (n, args.act_dim)).astype(np.float32),
+        "rewards": rng.normal(size=n).astype(np.float32),
+        "costs": rng.integers(0, 2, n).astype(np.float32),
+        "terminals": np.zeros(n, dtype=np.float32),
+        "timeouts": (np.arange(n) % 1000 == 999).astype(np.float32),
+    }
+
+
+def resident_bytes(dataset: TransitionDataset) -> int:
+    keys = ["observations", "next_observations", "actions", "rewards", "costs", "done"]
+    return sum(dataset.dataset[k].nbytes for k in keys)
+
+
+def gather_time(dataset: TransitionDataset, num_batches: int) -> float:
+    it = iter(dataset)
+    next(it)
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(it)
+    return (time.perf_counter() - start) / num_batches
+
+
+def bc_return(env, data: dict, obs_dtype: Optional[str], args: BenchConfig):
+    """Trains BC on the dataset stored with obs_dtype and evaluates it on the task."""
+    from osrl.algorithms import BC, BCTrainer
+    from osrl.common.exp_util import seed_all
+
+    seed_all(args.seed)
+    model = BC(state_dim=env.observation_space.shape[0],
+               action_dim=env.action_space.shape[0],
+               max_action=env.action_space.high[0],
+               device=args.device)
+    trainer = BCTrainer(model, env, cost_limit=args.cost_limit, device=args.device)
+    dataset = TransitionDataset(dict(data),
+                                batch_size=args.batch_size,
+                                seed=args.seed,
+                                obs_dtype=obs_dtype)
+    it = iter(dataset)
+    for _ in range(args.update_steps):
+        observations, _, actions, _, _, _ = [
+            torch.as_tensor(b, device=args.device) for b in next(it)
+        ]
+        trainer.train_one_step(observations, actions)
+    return trainer.evaluate(args.eval_episodes)
+
+
+@pyrallis.wrap()
+def bench(args: BenchConfig):
+    env = None
+    if args.task is None:
+        data = synthetic_dataset(args)
+    else:
+        import dsrl  # noqa
+        import gymnasium as gym
+        env = gym.make(args.task)
+        env.set_target_cost(args.cost_limit)
+        data = env.get_dataset()
+
+    base = TransitionDataset(dict(data), batch_size=args.batch_size, seed=args.seed)
+    base_bytes = resident_bytes(base)
+    base_time = gather_time(base, args.num_batches)
+    print(f"float32: {base_bytes / 2**20:.1f} MiB, {base_time * 1e6:.1f} us/batch")
+    for dtype in args.dtypes:
+        dataset = TransitionDataset(dict(data),
+                                    batch_size=args.batch_size,
+                                    seed=args.seed,
+                                    obs_dtype=dtype)
+        n_bytes = resident_bytes(dataset)
+        t = gather_time(dataset, args.num_batches)
+        obs = from_storage_dtype(dataset.dataset["observations"][:10000], dtype)
+        ref = base.dataset["observations"][:10000]
+        err = np.max(np.abs(obs - ref) / np.maximum(np.abs(ref), 1e-6))
+        print(f"{dtype}: {n_bytes / 2**20:.1f} MiB "
+              f"({100 * (1 - n_bytes / base_bytes):.0f}% saved), "
+              f"{t * 1e6:.1f} us/batch ({base_time / t:.2f}x), "
+              f"max relative error: {err:.1e}")
+
+    if env is not None and args.update_steps > 0:
+        ret, cost, _ = bc_return(env, data, None, args)
+        print(f"BC float32: reward {ret:.2f}, cost {cost:.2f}")
+        for dtype in args.dtypes:
+            ret, cost, _ = bc_return(env, data, dtype, args)
+            print(f"BC {dtype}: reward {ret:.2f}, cost {cost:.2f}")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,118 @@
+import time
+from dataclasses import dataclass
+from typing import List
+
+import pyrallis
+import torch
+from pyrallis import field
+
+from osrl.algorithms import (BCPQ, BCQL, BEARL, CPQ, BCPQTrainer, BCQLTrainer,
+                             BEARLTrainer, CPQTrainer)
+
+ALGOS = {
+    "bcql": (BCQL, BCQLTrainer),
+    "bearl": (BEARL, BEARLTrainer),
+    "cpq": (CPQ, CPQTrainer),
+    "bcpq": (BCPQ, BCPQTrainer),
+}
+OPTIMS = ["actor_optim", "critic_optim", "cost_critic_optim", "vae_optim"]
+
+
+@dataclass
+class BenchConfig:
+    algos: List[str] = field(default=["bcql", "bearl", "cpq", "bcpq"], is_mutable=True)
+    obs_dim: int = 64
+    act_dim: int = 8
+    batch_size: int = 512
+    num_q: int = 2
+    num_qc: int = 2
+    warmup_steps: int = 10
+    num_steps: int = 100
+    # the variants are timed in turns, the best rate of every variant is kept
+    repeats: int = 3
+    device: str = "cpu"
+    seed: int = 0
+
+
+def random_batch(args: BenchConfig):
+    g = torch.Generator().manual_seed(args.seed)
+    n = args.batch_size
+    batch = [
+        torch.randn(n, args.obs_dim, generator=g),
+        torch.randn(n, args.obs_dim, generator=g),
+        torch.rand(n, args.act_dim, generator=g) * 2 - 1,
+        torch.randn(n, generator=g),
+        torch.rand(n, generator=g),
+        (torch.rand(n, generator=g) < 0.01).float(),
+    ]
+    return [b.to(args.device) for b in batch]
+
+
+def build(args: BenchConfig, algo: str, reference: bool, fused_critic_update: bool,
+          flat_params: bool, stack_critics: bool):
+    torch.manual_seed(args.seed)
+    model_cls, trainer_cls = ALGOS[algo]
+    # BEARL waits 20k steps before updating the actor, the timed steps include it
+    kwargs = {"start_update_policy_step": 0} if algo == "bearl" else {}
+    model = model_cls(state_dim=args.obs_dim,
+                      action_dim=args.act_dim,
+                      max_action=1.0,
+                      num_q=args.num_q,
+                      num_qc=args.num_qc,
+                      flat_params=flat_params,
+                      stack_critics=stack_critics,
+                      device=args.device,
+                      **kwargs)
+    trainer = trainer_cls(model,
+                          None,
+                          fused_critic_update=fused_critic_update,
+                          device=args.device)
+    if reference:
+        # the per-parameter loop of the default Adam, as before build_adam
+        for name in OPTIMS:
+            optim = getattr(model, name)
+            group = optim.param_groups[0]
+            setattr(model, name,
+                    torch.optim.Adam(group["params"], lr=group["lr"], foreach=False))
+    return trainer
+
+
+def steps_per_sec(trainer, batch, args: BenchConfig) -> float:
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.num_steps):
+        trainer.train_one_step(*batch)
+    if args.device.startswith("cuda"):
+        torch.cuda.synchronize()
+    return args.num_steps / (time.perf_counter() - start)
+
+
+@pyrallis.wrap()
+def bench(args: BenchConfig):
+    batch = random_batch(args)
+    # every variant adds one change to the previous one, but the stacked critics replace
+    # the flat params, the flags are the arguments reference, fused_critic_update,
+    # flat_params and stack_critics of build
+    variants = [
+        ("reference", True, False, False, False),
+        ("build_adam", False, False, False, False),
+        ("+ fused critics", False, True, False, False),
+        ("+ flat params", False, True, True, False),
+        ("+ stacked critics", False, True, False, True),
+    ]
+    for algo in args.algos:
+        trainers = [build(args, algo, *flags) for _, *flags in variants]
+        for trainer in trainers:
+            for _ in range(args.warmup_steps):
+                trainer.train_one_step(*batch)
+        rates = [0.0] * len(variants)
+        for _ in range(args.repeats):
+            for i, trainer in enumerate(trainers):
+                rates[i] = max(rates[i], steps_per_sec(trainer, batch, args))
+        for (name, *_), rate in zip(variants, rates):
+            print(f"{algo} {name}: {rate:.1f} steps/s ({rate / rates[0]:.2f}x)")
+
+
+if __name__ == "__main__":
+    bench()
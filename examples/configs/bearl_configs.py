@@ -36,6 +36,18 @@ class BEARLTrainConfig:
     batch_size: int = 512
     update_steps: int = 300_000
     num_workers: int = 8
+    # keep the whole dataset on `device` and sample there instead of using workers
+    device_dataset: bool = False
+    # memory-map the dataset from .npy files under this directory, shared by the workers
+    dataset_mmap_dir: Optional[str] = None
+    # share the pre-processed dataset with the concurrent runs on the same task and seed
+    shared_dataset: bool = False
+    # number of batches prepared ahead by a background thread, 0 to disable
+    prefetch: int = 0
+    # walk shuffled epochs of the dataset instead of sampling with replacement
+    epoch_sampling: bool = False
+    # half-precision storage of the observations, "float16" or "bfloat16"
+    obs_dtype: Optional[str] = None
     # model params
     a_hidden_sizes: List[float] = field(default=[256, 256], is_mutable=True)
     c_hidden_sizes: List[float] = field(default=[256, 256], is_mutable=True)
@@ -43,6 +55,14 @@ class BEARLTrainConfig:
     sample_action_num: int = 10
     gamma: float = 0.99
     tau: float = 0.005
+    # soft update the target networks every k steps, with the same effective rate
+    target_update_every: int = 1
+    # keep the parameters of every network in one contiguous buffer
+    flat_params: bool = False
+    # keep the weights of the critic and the cost critic stacked as one ensemble
+    stack_critics: bool = False
+    # update the critic and the cost critic together, sharing their target actions
+    fused_critic_update: bool = False
     beta: float = 0.5
     lmbda: float = 0.75
     mmd_sigma: float = 50
@@ -18,6 +18,16 @@ class CDTTrainConfig:
     inpaint_ranges: Tuple[Tuple[float, float], ...] = None
     epsilon: float = None
     density: float = 1.0
+    # save the processed dataset here and reuse it in later runs with the same inputs
+    dataset_cache_dir: Optional[str] = None
+    # share the pre-processed dataset with the concurrent runs on the same task and seed
+    shared_dataset: bool = False
+    # number of batches prepared ahead by a background thread, 0 to disable
+    prefetch: int = 0
+    # walk shuffled epochs of the dataset instead of sampling with replacement
+    epoch_sampling: bool = False
+    # half-precision storage of the observations, "float16" or "bfloat16"
+    obs_dtype: Optional[str] = None
     # model params
     embedding_dim: int = 128
     num_layers: int = 3
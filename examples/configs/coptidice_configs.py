@@ -36,6 +36,18 @@ class COptiDICETrainConfig:
     batch_size: int = 512
     update_steps: int = 100_000
     num_workers: int = 8
+    # keep the whole dataset on `device` and sample there instead of using workers
+    device_dataset: bool = False
+    # memory-map the dataset from .npy files under this directory, shared by the workers
+    dataset_mmap_dir: Optional[str] = None
+    # share the pre-processed dataset with the concurrent runs on the same task and seed
+    shared_dataset: bool = False
+    # number of batches prepared ahead by a background thread, 0 to disable
+    prefetch: int = 0
+    # walk shuffled epochs of the dataset instead of sampling with replacement
+    epoch_sampling: bool = False
+    # half-precision storage of the observations, "float16" or "bfloat16"
+    obs_dtype: Optional[str] = None
     # model params
     a_hidden_sizes: List[float] = field(default=[256, 256], is_mutable=True)
     c_hidden_sizes: List[float] = field(default=[256, 256], is_mutable=True)
@@ -18,9 +18,11 @@ from tqdm.auto import trange  # noqa
 
 from examples.configs.bc_configs import BC_DEFAULT_CONFIG, BCTrainConfig
 from osrl.algorithms import BC, BCTrainer
-from osrl.common import TransitionDataset
+from osrl.common import Prefetcher, TransitionDataset
 from osrl.common.dataset import process_bc_dataset
 from osrl.common.exp_util import auto_name, seed_all
+from osrl.common.shared import SharedDataset, shared_dataset_name
+from osrl.common.stream import read_hdf5_chunks, stream_bc_dataset
 
 
 @pyrallis.wrap()
@@ -53,28 +55,61 @@ def train(args: BCTrainConfig):
     if "Metadrive" in args.task:
         import gym
     env = gym.make(args.task)
-    data = env.get_dataset()
     env.set_target_cost(args.cost_limit)
 
-    cbins, rbins, max_npb, min_npb = None, None, None, None
-    if args.density != 1.0:
-        density_cfg = DENSITY_CFG[args.task + "_density" + str(args.density)]
-        cbins = density_cfg["cbins"]
-        rbins = density_cfg["rbins"]
-        max_npb = density_cfg["max_npb"]
-        min_npb = density_cfg["min_npb"]
-    data = env.pre_process_data(data,
-                                args.outliers_percent,
-                                args.noise_scale,
-                                args.inpaint_ranges,
-                                args.epsilon,
-                                args.density,
-                                cbins=cbins,
-                                rbins=rbins,
-                                max_npb=max_npb,
-                                min_npb=min_npb)
-
-    process_bc_dataset(data, args.cost_limit, args.gamma, args.bc_mode)
+    def load_dataset():
+        data = env.get_dataset()
+
+        cbins, rbins, max_npb, min_npb = None, None, None, None
+        if args.density != 1.0:
+            density_cfg = DENSITY_CFG[args.task + "_density" + str(args.density)]
+            cbins = density_cfg["cbins"]
+            rbins = density_cfg["rbins"]
+            max_npb = density_cfg["max_npb"]
+            min_npb = density_cfg["min_npb"]
+        return env.pre_process_data(data,
+                                    args.outliers_percent,
+                                    args.noise_scale,
+                                    args.inpaint_ranges,
+                                    args.epsilon,
+                                    args.density,
+                                    cbins=cbins,
+                                    rbins=rbins,
+                                    max_npb=max_npb,
+                                    min_npb=min_npb)
+
+    # identifies the pre-processed dataset across runs
+    name = shared_dataset_name(args.task, args.outliers_percent, args.noise_scale,
+                               args.inpaint_ranges, args.epsilon, args.density,
+                               args.seed)
+    if args.stream_dir is not None:
+        # the dsrl pre-processing needs the whole dataset in memory
+        pre_processing = [
+            args.outliers_percent, args.noise_scale, args.inpaint_ranges, args.epsilon
+        ]
+        if args.dataset is None or args.density != 1.0 or any(
+                x is not None for x in pre_processing) or args.shared_dataset:
+            raise ValueError("stream_dir needs the HDF5 file `dataset`, and does not "
+                             "support the dataset pre-processing or shared_dataset")
+    elif args.shared_dataset:
+        # the first run on this dataset publishes it, the other runs attach read-only
+        shared = SharedDataset(name, load_dataset)
+
+    def load_bc_dataset():
+        data = dict(shared.arrays) if args.shared_dataset else load_dataset()
+        process_bc_dataset(data, args.cost_limit, args.gamma, args.bc_mode, copy=False)
+        return data
+
+    if args.stream_dir is not None:
+        source = os.path.splitext(os.path.basename(args.dataset))[0]
+        data = stream_bc_dataset(lambda: read_hdf5_chunks(args.dataset),
+                                 os.path.join(args.stream_dir, source), args.cost_limit,
+                                 args.gamma, args.bc_mode)
+    elif args.dataset_mmap_dir is not None:
+        # only loaded if the memory-mapped copy does not exist yet
+        data = load_bc_dataset
+    else:
+        data = load_bc_dataset()
 
     # model & optimizer & scheduler setup
     state_dim = env.observation_space.shape[0]
@@ -103,13 +138,30 @@ def train(args: BCTrainConfig):
                         cost_limit=args.cost_limit,
                         device=args.device)
 
-    trainloader = DataLoader(
-        TransitionDataset(data),
-        batch_size=args.batch_size,
-        pin_memory=True,
-        num_workers=args.num_workers,
-    )
-    trainloader_iter = iter(trainloader)
+    dataset = TransitionDataset(data,
+                                batch_size=args.batch_size,
+                                device=args.device if args.device_dataset else None,
+                                mmap_dir=args.dataset_mmap_dir,
+                                mmap_key=shared_dataset_name(name, args.cost_limit,
+                                                             args.gamma, args.bc_mode),
+                                seed=args.seed,
+                                epoch_sampling=args.epoch_sampling,
+                                obs_dtype=args.obs_dtype)
+    # free the loaded arrays, the dataset keeps the ones it samples
+    del data
+    if args.device_dataset:
+        trainloader_iter = iter(dataset)
+    else:
+        trainloader = DataLoader(
+            dataset,
+            batch_size=None,
+            pin_memory=True,
+            num_workers=args.num_workers,
+        )
+        trainloader_iter = iter(trainloader)
+    if args.prefetch > 0:
+        # sample the next batches in the background during the training step
+        trainloader_iter = Prefetcher(trainloader_iter, args.device, args.prefetch)
 
     # for saving the best
     best_reward = -np.inf
@@ -18,8 +18,9 @@ from tqdm.auto import trange  # noqa
 
 from examples.configs.bcpq_configs import BCPQ_DEFAULT_CONFIG, BCPQTrainConfig
 from osrl.algorithms import BCPQ, BCPQTrainer
-from osrl.common import TransitionDataset
+from osrl.common import Prefetcher, TransitionDataset
 from osrl.common.exp_util import auto_name, seed_all
+from osrl.common.shared import SharedDataset, shared_dataset_name
 
 
 @pyrallis.wrap()
@@ -56,26 +57,42 @@ def train(args: BCPQTrainConfig):
     env = gym.make(args.task)
 
     # pre-process offline dataset
-    data = env.get_dataset()
     env.set_target_cost(args.cost_limit)
 
-    cbins, rbins, max_npb, min_npb = None, None, None, None
-    if args.density != 1.0:
-        density_cfg = DENSITY_CFG[args.task + "_density" + str(args.density)]
-        cbins = density_cfg["cbins"]
-        rbins = density_cfg["rbins"]
-        max_npb = density_cfg["max_npb"]
-        min_npb = density_cfg["min_npb"]
-    data = env.pre_process_data(data,
-                                args.outliers_percent,
-                                args.noise_scale,
-                                args.inpaint_ranges,
-                                args.epsilon,
-                                args.density,
-                                cbins=cbins,
-                                rbins=rbins,
-                                max_npb=max_npb,
-                                min_npb=min_npb)
+    def load_dataset():
+        data = env.get_dataset()
+
+        cbins, rbins, max_npb, min_npb = None, None, None, None
+        if args.density != 1.0:
+            density_cfg = DENSITY_CFG[args.task + "_density" + str(args.density)]
+            cbins = density_cfg["cbins"]
+            rbins = density_cfg["rbins"]
+            max_npb = density_cfg["max_npb"]
+            min_npb = density_cfg["min_npb"]
+        return env.pre_process_data(data,
+                                    args.outliers_percent,
+                                    args.noise_scale,
+                                    args.inpaint_ranges,
+                                    args.epsilon,
+                                    args.density,
+                                    cbins=cbins,
+                                    rbins=rbins,
+                                    max_npb=max_npb,
+                                    min_npb=min_npb)
+
+    # identifies the pre-processed dataset across runs
+    name = shared_dataset_name(args.task, args.outliers_percent, args.noise_scale,
+                               args.inpaint_ranges, args.epsilon, args.density,
+                               args.seed)
+    if args.shared_dataset:
+        # the first run on this dataset publishes it, the other runs attach read-only
+        shared = SharedDataset(name, load_dataset)
+        data = dict(shared.arrays)
+    elif args.dataset_mmap_dir is not None:
+        # only loaded if the memory-mapped copy does not exist yet
+        data = load_dataset
+    else:
+        data = load_dataset()
 
     # wrapper
     env = wrap_env(
@@ -95,12 +112,15 @@ def train(args: BCPQTrainConfig):
         sample_action_num=args.sample_action_num,
         gamma=args.gamma,
         tau=args.tau,
+        target_update_every=args.target_update_every,
         beta=args.beta,
         num_q=args.num_q,
         num_qc=args.num_qc,
         qc_scalar=args.qc_scalar,
         cost_limit=args.cost_limit,
         episode_len=args.episode_len,
+        flat_params=args.flat_params,
+        stack_critics=args.stack_critics,
         device=args.device,
     )
     print(f"Total parameters: {sum(p.numel() for p in model.parameters())}")
@@ -119,18 +139,34 @@ def train(args: BCPQTrainConfig):
                          vae_lr=args.vae_lr,
                          reward_scale=args.reward_scale,
                          cost_scale=args.cost_scale,
+                         fused_critic_update=args.fused_critic_update,
                          device=args.device)
 
     dataset = TransitionDataset(data,
                                 reward_scale=args.reward_scale,
-                                cost_scale=args.cost_scale)
-    trainloader = DataLoader(
-        dataset,
-        batch_size=args.batch_size,
-        pin_memory=True,
-        num_workers=args.num_workers,
-    )
-    trainloader_iter = iter(trainloader)
+                                cost_scale=args.cost_scale,
+                                batch_size=args.batch_size,
+                                device=args.device if args.device_dataset else None,
+                                mmap_dir=args.dataset_mmap_dir,
+                                mmap_key=name,
+                                seed=args.seed,
+                                epoch_sampling=args.epoch_sampling,
+                                obs_dtype=args.obs_dtype)
+    # free the loaded arrays, the dataset keeps the ones it samples
+    del data
+    if args.device_dataset:
+        trainloader_iter = iter(dataset)
+    else:
+        trainloader = DataLoader(
+            dataset,
+            batch_size=None,
+            pin_memory=True,
+            num_workers=args.num_workers,
+        )
+        trainloader_iter = iter(trainloader)
+    if args.prefetch > 0:
+        # sample the next batches in the background during the training step
+        trainloader_iter = Prefetcher(trainloader_iter, args.device, args.prefetch)
 
     # for saving the best
     best_reward = -np.inf
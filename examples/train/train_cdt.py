@@ -18,8 +18,9 @@ from tqdm.auto import trange  # noqa
 
 from examples.configs.cdt_configs import CDT_DEFAULT_CONFIG, CDTTrainConfig
 from osrl.algorithms import CDT, CDTTrainer
-from osrl.common import SequenceDataset
+from osrl.common import Prefetcher, SequenceDataset
 from osrl.common.exp_util import auto_name, seed_all
+from osrl.common.shared import SharedDataset, shared_dataset_name
 
 
 @pyrallis.wrap()
@@ -54,26 +55,38 @@ def train(args: CDTTrainConfig):
     env = gym.make(args.task)
 
     # pre-process offline dataset
-    data = env.get_dataset()
     env.set_target_cost(args.cost_limit)
 
-    cbins, rbins, max_npb, min_npb = None, None, None, None
-    if args.density != 1.0:
-        density_cfg = DENSITY_CFG[args.task + "_density" + str(args.density)]
-        cbins = density_cfg["cbins"]
-        rbins = density_cfg["rbins"]
-        max_npb = density_cfg["max_npb"]
-        min_npb = density_cfg["min_npb"]
-    data = env.pre_process_data(data,
-                                args.outliers_percent,
-                                args.noise_scale,
-                                args.inpaint_ranges,
-                                args.epsilon,
-                                args.density,
-                                cbins=cbins,
-                                rbins=rbins,
-                                max_npb=max_npb,
-                                min_npb=min_npb)
+    def load_dataset():
+        data = env.get_dataset()
+
+        cbins, rbins, max_npb, min_npb = None, None, None, None
+        if args.density != 1.0:
+            density_cfg = DENSITY_CFG[args.task + "_density" + str(args.density)]
+            cbins = density_cfg["cbins"]
+            rbins = density_cfg["rbins"]
+            max_npb = density_cfg["max_npb"]
+            min_npb = density_cfg["min_npb"]
+        return env.pre_process_data(data,
+                                    args.outliers_percent,
+                                    args.noise_scale,
+                                    args.inpaint_ranges,
+                                    args.epsilon,
+                                    args.density,
+                                    cbins=cbins,
+                                    rbins=rbins,
+                                    max_npb=max_npb,
+                                    min_npb=min_npb)
+
+    if args.shared_dataset:
+        # the first run on this dataset publishes it, the other runs attach read-only
+        name = shared_dataset_name(args.task, args.outliers_percent, args.noise_scale,
+                                   args.inpaint_ranges, args.epsilon, args.density,
+                                   args.seed)
+        shared = SharedDataset(name, load_dataset)
+        data = dict(shared.arrays)
+    else:
+        data = load_dataset()
 
     # wrapper
     env = wrap_env(
@@ -163,15 +176,23 @@ def train(args: CDTTrainConfig):
         cgap=args.cgap,
         rstd=args.rstd,
         cstd=args.cstd,
+        batch_size=args.batch_size,
+        cache_dir=args.dataset_cache_dir,
+        seed=args.seed,
+        epoch_sampling=args.epoch_sampling,
+        obs_dtype=args.obs_dtype,
     )
 
     trainloader = DataLoader(
         dataset,
-        batch_size=args.batch_size,
+        batch_size=None,
         pin_memory=True,
         num_workers=args.num_workers,
     )
     trainloader_iter = iter(trainloader)
+    if args.prefetch > 0:
+        # sample the next batches in the background during the training step
+        trainloader_iter = Prefetcher(trainloader_iter, args.device, args.prefetch)
 
     # for saving the best
     best_reward = -np.inf
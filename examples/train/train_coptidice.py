@@ -19,8 +19,9 @@ from tqdm.auto import trange  # noqa
 from examples.configs.coptidice_configs import (COptiDICE_DEFAULT_CONFIG,
                                                 COptiDICETrainConfig)
 from osrl.algorithms import COptiDICE, COptiDICETrainer
-from osrl.common import TransitionDataset
+from osrl.common import Prefetcher, TransitionDataset
 from osrl.common.exp_util import auto_name, seed_all
+from osrl.common.shared import SharedDataset, shared_dataset_name
 
 
 @pyrallis.wrap()
@@ -55,26 +56,42 @@ def train(args: COptiDICETrainConfig):
     env = gym.make(args.task)
 
     # pre-process offline dataset
-    data = env.get_dataset()
     env.set_target_cost(args.cost_limit)
 
-    cbins, rbins, max_npb, min_npb = None, None, None, None
-    if args.density != 1.0:
-        density_cfg = DENSITY_CFG[args.task + "_density" + str(args.density)]
-        cbins = density_cfg["cbins"]
-        rbins = density_cfg["rbins"]
-        max_npb = density_cfg["max_npb"]
-        min_npb = density_cfg["min_npb"]
-    data = env.pre_process_data(data,
-                                args.outliers_percent,
-                                args.noise_scale,
-                                args.inpaint_ranges,
-                                args.epsilon,
-                                args.density,
-                                cbins=cbins,
-                                rbins=rbins,
-                                max_npb=max_npb,
-                                min_npb=min_npb)
+    def load_dataset():
+        data = env.get_dataset()
+
+        cbins, rbins, max_npb, min_npb = None, None, None, None
+        if args.density != 1.0:
+            density_cfg = DENSITY_CFG[args.task + "_density" + str(args.density)]
+            cbins = density_cfg["cbins"]
+            rbins = density_cfg["rbins"]
+            max_npb = density_cfg["max_npb"]
+            min_npb = density_cfg["min_npb"]
+        return env.pre_process_data(data,
+                                    args.outliers_percent,
+                                    args.noise_scale,
+                                    args.inpaint_ranges,
+                                    args.epsilon,
+                                    args.density,
+                                    cbins=cbins,
+                                    rbins=rbins,
+                                    max_npb=max_npb,
+                                    min_npb=min_npb)
+
+    # identifies the pre-processed dataset across runs
+    name = shared_dataset_name(args.task, args.outliers_percent, args.noise_scale,
+                               args.inpaint_ranges, args.epsilon, args.density,
+                               args.seed)
+    if args.shared_dataset:
+        # the first run on this dataset publishes it, the other runs attach read-only
+        shared = SharedDataset(name, load_dataset)
+        data = dict(shared.arrays)
+    elif args.dataset_mmap_dir is not None:
+        # only loaded if the memory-mapped copy does not exist yet
+        data = load_dataset
+    else:
+        data = load_dataset()
 
     # wrapper
     env = wrap_env(
@@ -87,14 +104,29 @@ def train(args: COptiDICETrainConfig):
     dataset = TransitionDataset(data,
                                 reward_scale=args.reward_scale,
                                 cost_scale=args.cost_scale,
-                                state_init=True)
-    trainloader = DataLoader(
-        dataset,
-        batch_size=args.batch_size,
-        pin_memory=True,
-        num_workers=args.num_workers,
-    )
-    trainloader_iter = iter(trainloader)
+                                state_init=True,
+                                batch_size=args.batch_size,
+                                device=args.device if args.device_dataset else None,
+                                mmap_dir=args.dataset_mmap_dir,
+                                mmap_key=name,
+                                seed=args.seed,
+                                epoch_sampling=args.epoch_sampling,
+                                obs_dtype=args.obs_dtype)
+    # free the loaded arrays, the dataset keeps the ones it samples
+    del data
+    if args.device_dataset:
+        trainloader_iter = iter(dataset)
+    else:
+        trainloader = DataLoader(
+            dataset,
+            batch_size=None,
+            pin_memory=True,
+            num_workers=args.num_workers,
+        )
+        trainloader_iter = iter(trainloader)
+    if args.prefetch > 0:
+        # sample the next batches in the background during the training step
+        trainloader_iter = Prefetcher(trainloader_iter, args.device, args.prefetch)
     init_s_propotion, obs_std, act_std = dataset.get_dataset_states()
 
     # setup model
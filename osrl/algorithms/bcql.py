@@ -8,8 +8,10 @@ import torch.nn as nn
 from fsrl.utils import DummyLogger, WandbLogger
 from tqdm.auto import trange  # noqa
 
-from osrl.common.net import (VAE, EnsembleDoubleQCritic, LagrangianPIDController,
-                             MLPGaussianPerturbationActor)
+from osrl.common.net import (VAE, CombinedCritics, EnsembleDoubleQCritic,
+                             LagrangianPIDController, MLPGaussianPerturbationActor,
+                             PolyakAverager, build_adam, flatten_parameters,
+                             module_parameters)
 
 
 class BCQL(nn.Module):
@@ -28,6 +30,8 @@ class BCQL(nn.Module):
         sample_action_num (int): Number of action samples to draw. 
         gamma (float): Discount factor for the reward.
         tau (float): Soft update coefficient for the target networks. 
+        target_update_every (int): Number of steps between two soft updates of the target
+            networks, the coefficient is compounded to keep the same effective rate.
         phi (float): Scale parameter for the Gaussian perturbation 
             applied to the actor's output.
         lmbda (float): Weight of the Lagrangian term.
@@ -38,6 +42,11 @@ class BCQL(nn.Module):
         num_qc (int): Number of cost Q networks in the ensemble.
         cost_limit (int): Upper limit on the cost per episode.
         episode_len (int): Maximum length of an episode.
+        flat_params (bool): Whether to keep the parameters of every network in one
+            contiguous buffer, which the optimizers and the soft updates work on.
+        stack_critics (bool): Whether to keep the weights of the critic and the cost
+            critic, and of their targets, stacked as one ensemble evaluated with one
+            batched forward. It can not be combined with flat_params.
         device (str): Device to run the model on (e.g. 'cpu' or 'cuda:0'). 
     """
 
@@ -51,6 +60,7 @@ class BCQL(nn.Module):
                  sample_action_num: int = 10,
                  gamma: float = 0.99,
                  tau: float = 0.005,
+                 target_update_every: int = 1,
                  phi: float = 0.05,
                  lmbda: float = 0.75,
                  beta: float = 0.5,
@@ -59,6 +69,8 @@ class BCQL(nn.Module):
                  num_qc: int = 1,
                  cost_limit: int = 10,
                  episode_len: int = 300,
+                 flat_params: bool = False,
+                 stack_critics: bool = False,
                  device: str = "cpu"):
 
         super().__init__()
@@ -105,50 +117,67 @@ class BCQL(nn.Module):
         self.critic_old.eval()
         self.cost_critic_old = deepcopy(self.cost_critic)
         self.cost_critic_old.eval()
+        if flat_params:
+            for module in [self.actor, self.critic, self.cost_critic, self.vae]:
+                flatten_parameters(module)
+            for module in [self.actor_old, self.critic_old, self.cost_critic_old]:
+                flatten_parameters(module, grad=False)
+        # the critic and the cost critic, and their targets, evaluated on the same inputs
+        self.critics = CombinedCritics([self.critic, self.cost_critic], stack_critics)
+        self.critics_old = CombinedCritics([self.critic_old, self.cost_critic_old],
+                                           stack_critics,
+                                           grad=False)
+        self.target_averager = PolyakAverager(
+            [self.critic_old, self.cost_critic_old, self.actor_old],
+            [self.critic, self.cost_critic, self.actor], self.tau, target_update_every)
 
         self.qc_thres = cost_limit * (1 - self.gamma**self.episode_len) / (
             1 - self.gamma) / self.episode_len
         self.controller = LagrangianPIDController(self.KP, self.KI, self.KD,
                                                   self.qc_thres)
 
-    def _soft_update(self, tgt: nn.Module, src: nn.Module, tau: float) -> None:
-        """
-        Softly update the parameters of target module 
-        towards the parameters of source module.
-        """
-        for tgt_param, src_param in zip(tgt.parameters(), src.parameters()):
-            tgt_param.data.copy_(tau * src_param.data + (1 - tau) * tgt_param.data)
-
     def vae_loss(self, observations, actions):
         recon, mean, std = self.vae(observations, actions)
         recon_loss = nn.functional.mse_loss(recon, actions)
         KL_loss = -0.5 * (1 + torch.log(std.pow(2)) - mean.pow(2) - std.pow(2)).mean()
         loss_vae = recon_loss + self.beta * KL_loss
 
-        self.vae_optim.zero_grad()
+        self.vae_optim.zero_grad(set_to_none=False)
         loss_vae.backward()
         self.vae_optim.step()
         stats_vae = {"loss/loss_vae": loss_vae.item()}
         return loss_vae, stats_vae
 
+    def _next_actions(self, next_observations):
+        """
+        Repeats every next observation sample_action_num times and samples the target
+        actions of the repeats.
+        """
+        obs_next = torch.repeat_interleave(next_observations, self.sample_action_num,
+                                           0).to(self.device)
+        act_targ_next = self.actor_old(obs_next, self.vae.decode(obs_next))
+        return obs_next, act_targ_next
+
+    def _target_value(self, q1_targ, q2_targ, batch_size):
+        """
+        Soft clipped double Q-learning target, maximized over the sampled actions.
+        """
+        q_targ = self.lmbda * torch.min(
+            q1_targ, q2_targ) + (1. - self.lmbda) * torch.max(q1_targ, q2_targ)
+        return q_targ.reshape(batch_size, -1).max(1)[0]
+
     def critic_loss(self, observations, next_observations, actions, rewards, done):
         _, _, q1_list, q2_list = self.critic.predict(observations, actions)
         with torch.no_grad():
             batch_size = next_observations.shape[0]
-            obs_next = torch.repeat_interleave(next_observations, self.sample_action_num,
-                                               0).to(self.device)
-
-            act_targ_next = self.actor_old(obs_next, self.vae.decode(obs_next))
+            obs_next, act_targ_next = self._next_actions(next_observations)
             q1_targ, q2_targ, _, _ = self.critic_old.predict(obs_next, act_targ_next)
-
-            q_targ = self.lmbda * torch.min(
-                q1_targ, q2_targ) + (1. - self.lmbda) * torch.max(q1_targ, q2_targ)
-            q_targ = q_targ.reshape(batch_size, -1).max(1)[0]
+            q_targ = self._target_value(q1_targ, q2_targ, batch_size)
 
             backup = rewards + self.gamma * (1 - done) * q_targ
         loss_critic = self.critic.loss(backup, q1_list) + self.critic.loss(
             backup, q2_list)
-        self.critic_optim.zero_grad()
+        self.critic_optim.zero_grad(set_to_none=False)
         loss_critic.backward()
         self.critic_optim.step()
         stats_critic = {"loss/critic_loss": loss_critic.item()}
@@ -158,26 +187,51 @@ class BCQL(nn.Module):
         _, _, q1_list, q2_list = self.cost_critic.predict(observations, actions)
         with torch.no_grad():
             batch_size = next_observations.shape[0]
-            obs_next = torch.repeat_interleave(next_observations, self.sample_action_num,
-                                               0).to(self.device)
-
-            act_targ_next = self.actor_old(obs_next, self.vae.decode(obs_next))
+            obs_next, act_targ_next = self._next_actions(next_observations)
             q1_targ, q2_targ, _, _ = self.cost_critic_old.predict(
                 obs_next, act_targ_next)
-
-            q_targ = self.lmbda * torch.min(
-                q1_targ, q2_targ) + (1. - self.lmbda) * torch.max(q1_targ, q2_targ)
-            q_targ = q_targ.reshape(batch_size, -1).max(1)[0]
+            q_targ = self._target_value(q1_targ, q2_targ, batch_size)
 
             backup = costs + self.gamma * q_targ
         loss_cost_critic = self.cost_critic.loss(
             backup, q1_list) + self.cost_critic.loss(backup, q2_list)
-        self.cost_critic_optim.zero_grad()
+        self.cost_critic_optim.zero_grad(set_to_none=False)
         loss_cost_critic.backward()
         self.cost_critic_optim.step()
         stats_cost_critic = {"loss/cost_critic_loss": loss_cost_critic.item()}
         return loss_cost_critic, stats_cost_critic
 
+    def critics_loss(self, observations, next_observations, actions, rewards, costs,
+                     done):
+        """
+        Updates the critic and the cost critic together. Both are evaluated with one
+        batched forward if the critics are stacked, their targets share the sampled next
+        actions, and one backward pass computes the gradients of both since their
+        parameters are disjoint.
+        """
+        q_pred, qc_pred = self.critics.predict(observations, actions)
+        with torch.no_grad():
+            batch_size = next_observations.shape[0]
+            obs_next, act_targ_next = self._next_actions(next_observations)
+            q_targ, qc_targ = self.critics_old.predict(obs_next, act_targ_next)
+            q_targ = self._target_value(q_targ[0], q_targ[1], batch_size)
+            qc_targ = self._target_value(qc_targ[0], qc_targ[1], batch_size)
+
+            backup = rewards + self.gamma * (1 - done) * q_targ
+            cost_backup = costs + self.gamma * qc_targ
+        loss_critic = self.critic.loss(backup, q_pred[2]) + self.critic.loss(
+            backup, q_pred[3])
+        loss_cost_critic = self.cost_critic.loss(
+            cost_backup, qc_pred[2]) + self.cost_critic.loss(cost_backup, qc_pred[3])
+        self.critic_optim.zero_grad(set_to_none=False)
+        self.cost_critic_optim.zero_grad(set_to_none=False)
+        (loss_critic + loss_cost_critic).backward()
+        self.critic_optim.step()
+        self.cost_critic_optim.step()
+        stats_critic = {"loss/critic_loss": loss_critic.item()}
+        stats_cost_critic = {"loss/cost_critic_loss": loss_cost_critic.item()}
+        return loss_critic, stats_critic, loss_cost_critic, stats_cost_critic
+
     def actor_loss(self, observations):
         for p in self.critic.parameters():
             p.requires_grad = False
@@ -187,8 +241,9 @@ class BCQL(nn.Module):
             p.requires_grad = False
 
         actions = self.actor(observations, self.vae.decode(observations))
-        q1_pi, q2_pi, _, _ = self.critic.predict(observations, actions)  # [batch_size]
-        qc1_pi, qc2_pi, _, _ = self.cost_critic.predict(observations, actions)
+        q_pred, qc_pred = self.critics.predict(observations, actions)
+        q1_pi, q2_pi = q_pred[:2]  # [batch_size]
+        qc1_pi, qc2_pi = qc_pred[:2]
         qc_pi = torch.min(qc1_pi, qc2_pi)
         q_pi = torch.min(q1_pi, q2_pi)
 
@@ -197,7 +252,7 @@ class BCQL(nn.Module):
         qc_penalty = ((qc_pi - self.qc_thres) * multiplier).mean()
         loss_actor = -q_pi.mean() + qc_penalty
 
-        self.actor_optim.zero_grad()
+        self.actor_optim.zero_grad(set_to_none=False)
         loss_actor.backward()
         self.actor_optim.step()
 
@@ -219,19 +274,17 @@ class BCQL(nn.Module):
         """
         Sets up optimizers for the actor, critic, cost critic, and VAE models.
         """
-        self.actor_optim = torch.optim.Adam(self.actor.parameters(), lr=actor_lr)
-        self.critic_optim = torch.optim.Adam(self.critic.parameters(), lr=critic_lr)
-        self.cost_critic_optim = torch.optim.Adam(self.cost_critic.parameters(),
-                                                  lr=critic_lr)
-        self.vae_optim = torch.optim.Adam(self.vae.parameters(), lr=vae_lr)
+        self.actor_optim = build_adam(module_parameters(self.actor), actor_lr)
+        self.critic_optim = build_adam(module_parameters(self.critic), critic_lr)
+        self.cost_critic_optim = build_adam(module_parameters(self.cost_critic),
+                                            critic_lr)
+        self.vae_optim = build_adam(module_parameters(self.vae), vae_lr)
 
     def sync_weight(self):
         """
         Soft-update the weight for the target network.
         """
-        self._soft_update(self.critic_old, self.critic, self.tau)
-        self._soft_update(self.cost_critic_old, self.cost_critic, self.tau)
-        self._soft_update(self.actor_old, self.actor, self.tau)
+        self.target_averager.step()
 
     def act(self, obs, deterministic=False, with_logprob=False):
         '''
@@ -256,6 +309,8 @@ class BCQLTrainer:
         vae_lr (float): learning rate for vae
         reward_scale (float): The scaling factor for the reward signal.
         cost_scale (float): The scaling factor for the constraint cost.
+        fused_critic_update (bool): Whether to update the critic and the cost critic
+            together with `BCQL.critics_loss`, which shares their target actions.
         device (str): The device to use for training (e.g. "cpu" or "cuda").
     """
 
@@ -270,6 +325,7 @@ class BCQLTrainer:
             vae_lr: float = 1e-4,
             reward_scale: float = 1.0,
             cost_scale: float = 1.0,
+            fused_critic_update: bool = False,
             device="cpu"):
 
         self.model = model
@@ -277,6 +333,7 @@ class BCQLTrainer:
         self.env = env
         self.reward_scale = reward_scale
         self.cost_scale = cost_scale
+        self.fused_critic_update = fused_critic_update
         self.device = device
         self.model.setup_optimizers(actor_lr, critic_lr, vae_lr)
 
@@ -288,13 +345,18 @@ class BCQLTrainer:
 
         # update VAE
         loss_vae, stats_vae = self.model.vae_loss(observations, actions)
-        # update critic
-        loss_critic, stats_critic = self.model.critic_loss(observations,
-                                                           next_observations, actions,
-                                                           rewards, done)
-        # update cost critic
-        loss_cost_critic, stats_cost_critic = self.model.cost_critic_loss(
-            observations, next_observations, actions, costs, done)
+        if self.fused_critic_update:
+            # update critic and cost critic
+            loss_critic, stats_critic, loss_cost_critic, stats_cost_critic = \
+                self.model.critics_loss(observations, next_observations, actions,
+                                        rewards, costs, done)
+        else:
+            # update critic
+            loss_critic, stats_critic = self.model.critic_loss(
+                observations, next_observations, actions, rewards, done)
+            # update cost critic
+            loss_cost_critic, stats_cost_critic = self.model.cost_critic_loss(
+                observations, next_observations, actions, costs, done)
         # update actor
         loss_actor, stats_actor = self.model.actor_loss(observations)
 
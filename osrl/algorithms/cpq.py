@@ -7,7 +7,9 @@ import torch.nn as nn
 from fsrl.utils import DummyLogger, WandbLogger
 from tqdm.auto import trange  # noqa
 
-from osrl.common.net import VAE, EnsembleQCritic, SquashedGaussianMLPActor
+from osrl.common.net import (VAE, CombinedCritics, EnsembleQCritic, PolyakAverager,
+                             SquashedGaussianMLPActor, build_adam, flatten_parameters,
+                             module_parameters)
 
 
 class CPQ(nn.Module):
@@ -26,12 +28,19 @@ class CPQ(nn.Module):
         sample_action_num (int): Number of action samples to draw. 
         gamma (float): Discount factor for the reward.
         tau (float): Soft update coefficient for the target networks. 
+        target_update_every (int): Number of steps between two soft updates of the target
+            networks, the coefficient is compounded to keep the same effective rate.
         beta (float): Weight of the KL divergence term.
         num_q (int): Number of Q networks in the ensemble.
         num_qc (int): Number of cost Q networks in the ensemble.
         qc_scalar (float): Scaling factor for the cost critic threshold.
         cost_limit (int): Upper limit on the cost per episode.
         episode_len (int): Maximum length of an episode.
+        flat_params (bool): Whether to keep the parameters of every network in one
+            contiguous buffer, which the optimizers and the soft updates work on.
+        stack_critics (bool): Whether to keep the weights of the critic and the cost
+            critic, and of their targets, stacked as one ensemble evaluated with one
+            batched forward. It can not be combined with flat_params.
         device (str): Device to run the model on (e.g. 'cpu' or 'cuda:0'). 
     """
 
@@ -45,12 +54,15 @@ class CPQ(nn.Module):
                  sample_action_num: int = 10,
                  gamma: float = 0.99,
                  tau: float = 0.005,
+                 target_update_every: int = 1,
                  beta: float = 1.5,
                  num_q: int = 1,
                  num_qc: int = 1,
                  qc_scalar: float = 1.5,
                  cost_limit: int = 10,
                  episode_len: int = 300,
+                 flat_params: bool = False,
+                 stack_critics: bool = False,
                  device: str = "cpu"):
 
         super().__init__()
@@ -98,20 +110,25 @@ class CPQ(nn.Module):
         self.critic_old.eval()
         self.cost_critic_old = deepcopy(self.cost_critic)
         self.cost_critic_old.eval()
+        if flat_params:
+            for module in [self.actor, self.critic, self.cost_critic, self.vae]:
+                flatten_parameters(module)
+            for module in [self.actor_old, self.critic_old, self.cost_critic_old]:
+                flatten_parameters(module, grad=False)
+        # the critic and the cost critic, and their targets, evaluated on the same inputs
+        self.critics = CombinedCritics([self.critic, self.cost_critic], stack_critics)
+        self.critics_old = CombinedCritics([self.critic_old, self.cost_critic_old],
+                                           stack_critics,
+                                           grad=False)
+        self.target_averager = PolyakAverager(
+            [self.critic_old, self.cost_critic_old, self.actor_old],
+            [self.critic, self.cost_critic, self.actor], self.tau, target_update_every)
 
         # set critic and cost critic threshold
         self.q_thres = cost_limit * (1 - self.gamma**self.episode_len) / (
             1 - self.gamma) / self.episode_len
         self.qc_thres = qc_scalar * self.q_thres
 
-    def _soft_update(self, tgt: nn.Module, src: nn.Module, tau: float) -> None:
-        """
-        Softly update the parameters of target module 
-        towards the parameters of source module.
-        """
-        for tgt_param, src_param in zip(tgt.parameters(), src.parameters()):
-            tgt_param.data.copy_(tau * src_param.data + (1 - tau) * tgt_param.data)
-
     def _actor_forward(self,
                        obs: torch.tensor,
                        deterministic: bool = False,
@@ -128,7 +145,7 @@ class CPQ(nn.Module):
         KL_loss = -0.5 * (1 + torch.log(std.pow(2)) - mean.pow(2) - std.pow(2)).mean()
         loss_vae = recon_loss + self.beta * KL_loss
 
-        self.vae_optim.zero_grad()
+        self.vae_optim.zero_grad(set_to_none=False)
         loss_vae.backward()
         self.vae_optim.step()
         stats_vae = {"loss/loss_vae": loss_vae.item()}
@@ -139,19 +156,51 @@ class CPQ(nn.Module):
         # Bellman backup for Q functions
         with torch.no_grad():
             next_actions, _ = self._actor_forward(next_observations, False, True)
-            q_targ, _ = self.critic_old.predict(next_observations, next_actions)
-            qc_targ, _ = self.cost_critic_old.predict(next_observations, next_actions)
+            q_pred, qc_pred = self.critics_old.predict(next_observations, next_actions)
+            q_targ, qc_targ = q_pred[0], qc_pred[0]
             # Constraints Penalized Bellman operator
             backup = rewards + self.gamma * (1 -
                                              done) * (qc_targ <= self.q_thres) * q_targ
         # MSE loss against Bellman backup
         loss_critic = self.critic.loss(backup, q_list)
-        self.critic_optim.zero_grad()
+        self.critic_optim.zero_grad(set_to_none=False)
         loss_critic.backward()
         self.critic_optim.step()
         stats_critic = {"loss/critic_loss": loss_critic.item()}
         return loss_critic, stats_critic
 
+    def _ood_cost(self, observations):
+        """
+        Target cost values of the policy actions the VAE finds out of distribution.
+        """
+        batch_size = observations.shape[0]
+        _, _, pi_dist = self.actor(observations, False, True, True)
+        # sample actions
+        sampled_actions = pi_dist.sample(
+            [self.sample_action_num])  # [sample_action_num, batch_size, act_dim]
+        sampled_actions = sampled_actions.reshape(self.sample_action_num * batch_size,
+                                                  self.action_dim)
+        stacked_obs = torch.tile(
+            observations[None, :, :],
+            (self.sample_action_num, 1, 1))  # [sample_action_num, batch_size, obs_dim]
+        stacked_obs = stacked_obs.reshape(self.sample_action_num * batch_size,
+                                          self.state_dim)
+        qc_sampled, _ = self.cost_critic_old.predict(stacked_obs, sampled_actions)
+        qc_sampled = qc_sampled.reshape(self.sample_action_num, batch_size)
+        # get latent mean and std
+        _, mean, std = self.vae(stacked_obs, sampled_actions)
+        mean = mean.reshape(self.sample_action_num, batch_size, self.latent_dim)
+        std = std.reshape(self.sample_action_num, batch_size, self.latent_dim)
+        KL_loss = -0.5 * (1 + torch.log(std.pow(2)) - mean.pow(2) - std.pow(2)).mean(
+            2)  # [sample_action_num, batch_size]
+        quantile = torch.quantile(KL_loss, 0.75)
+        return ((KL_loss >= quantile) * qc_sampled).mean(0)
+
+    def _update_alpha(self, qc_ood):
+        self.log_alpha += self.alpha_lr * self.log_alpha.exp() * (
+            self.qc_thres - qc_ood.mean()).detach()
+        self.log_alpha.data.clamp_(min=-5.0, max=5.0)
+
     def cost_critic_loss(self, observations, next_observations, actions, costs, done):
         _, qc_list = self.cost_critic.predict(observations, actions)
         # Bellman backup for Q functions
@@ -159,40 +208,16 @@ class CPQ(nn.Module):
             next_actions, _ = self._actor_forward(next_observations, False, True)
             qc_targ, _ = self.cost_critic_old.predict(next_observations, next_actions)
             backup = costs + self.gamma * qc_targ
-
-            batch_size = observations.shape[0]
-            _, _, pi_dist = self.actor(observations, False, True, True)
-            # sample actions
-            sampled_actions = pi_dist.sample(
-                [self.sample_action_num])  # [sample_action_num, batch_size, act_dim]
-            sampled_actions = sampled_actions.reshape(
-                self.sample_action_num * batch_size, self.action_dim)
-            stacked_obs = torch.tile(observations[None, :, :],
-                                     (self.sample_action_num, 1,
-                                      1))  # [sample_action_num, batch_size, obs_dim]
-            stacked_obs = stacked_obs.reshape(self.sample_action_num * batch_size,
-                                              self.state_dim)
-            qc_sampled, _ = self.cost_critic_old.predict(stacked_obs, sampled_actions)
-            qc_sampled = qc_sampled.reshape(self.sample_action_num, batch_size)
-            # get latent mean and std
-            _, mean, std = self.vae(stacked_obs, sampled_actions)
-            mean = mean.reshape(self.sample_action_num, batch_size, self.latent_dim)
-            std = std.reshape(self.sample_action_num, batch_size, self.latent_dim)
-            KL_loss = -0.5 * (1 + torch.log(std.pow(2)) - mean.pow(2) - std.pow(2)).mean(
-                2)  # [sample_action_num, batch_size]
-            quantile = torch.quantile(KL_loss, 0.75)
-            qc_ood = ((KL_loss >= quantile) * qc_sampled).mean(0)
+            qc_ood = self._ood_cost(observations)
 
         loss_cost_critic = self.cost_critic.loss(
             backup, qc_list) - self.log_alpha.exp() * (qc_ood.mean() - self.qc_thres)
-        self.cost_critic_optim.zero_grad()
+        self.cost_critic_optim.zero_grad(set_to_none=False)
         loss_cost_critic.backward()
         self.cost_critic_optim.step()
 
         # update alpha
-        self.log_alpha += self.alpha_lr * self.log_alpha.exp() * (
-            self.qc_thres - qc_ood.mean()).detach()
-        self.log_alpha.data.clamp_(min=-5.0, max=5.0)
+        self._update_alpha(qc_ood)
 
         stats_cost_critic = {
             "loss/cost_critic_loss": loss_cost_critic.item(),
@@ -200,6 +225,46 @@ class CPQ(nn.Module):
         }
         return loss_cost_critic, stats_cost_critic
 
+    def critics_loss(self, observations, next_observations, actions, rewards, costs,
+                     done):
+        """
+        Updates the critic and the cost critic together. Both are evaluated with one
+        batched forward if the critics are stacked, their targets share the sampled next
+        actions, and one backward pass computes the gradients of both since their
+        parameters are disjoint.
+        """
+        q_pred, qc_pred = self.critics.predict(observations, actions)
+        # Bellman backup for Q functions
+        with torch.no_grad():
+            next_actions, _ = self._actor_forward(next_observations, False, True)
+            q_targ, qc_targ = self.critics_old.predict(next_observations, next_actions)
+            q_targ, qc_targ = q_targ[0], qc_targ[0]
+            # Constraints Penalized Bellman operator
+            backup = rewards + self.gamma * (1 - done) * (qc_targ
+                                                          <= self.q_thres) * q_targ
+            cost_backup = costs + self.gamma * qc_targ
+            qc_ood = self._ood_cost(observations)
+
+        loss_critic = self.critic.loss(backup, q_pred[1])
+        loss_cost_critic = self.cost_critic.loss(
+            cost_backup,
+            qc_pred[1]) - self.log_alpha.exp() * (qc_ood.mean() - self.qc_thres)
+        self.critic_optim.zero_grad(set_to_none=False)
+        self.cost_critic_optim.zero_grad(set_to_none=False)
+        (loss_critic + loss_cost_critic).backward()
+        self.critic_optim.step()
+        self.cost_critic_optim.step()
+
+        # update alpha
+        self._update_alpha(qc_ood)
+
+        stats_critic = {"loss/critic_loss": loss_critic.item()}
+        stats_cost_critic = {
+            "loss/cost_critic_loss": loss_cost_critic.item(),
+            "loss/alpha_value": self.log_alpha.exp().item()
+        }
+        return loss_critic, stats_critic, loss_cost_critic, stats_cost_critic
+
     def actor_loss(self, observations):
         for p in self.critic.parameters():
             p.requires_grad = False
@@ -207,10 +272,10 @@ class CPQ(nn.Module):
             p.requires_grad = False
 
         actions, _ = self._actor_forward(observations, False, True)
-        q_pi, _ = self.critic.predict(observations, actions)
-        qc_pi, _ = self.cost_critic.predict(observations, actions)
+        q_pred, qc_pred = self.critics.predict(observations, actions)
+        q_pi, qc_pi = q_pred[0], qc_pred[0]
         loss_actor = -((qc_pi <= self.q_thres) * q_pi).mean()
-        self.actor_optim.zero_grad()
+        self.actor_optim.zero_grad(set_to_none=False)
         loss_actor.backward()
         self.actor_optim.step()
         stats_actor = {"loss/actor_loss": loss_actor.item()}
@@ -225,16 +290,14 @@ class CPQ(nn.Module):
         """
         Soft-update the weight for the target network.
         """
-        self._soft_update(self.critic_old, self.critic, self.tau)
-        self._soft_update(self.cost_critic_old, self.cost_critic, self.tau)
-        self._soft_update(self.actor_old, self.actor, self.tau)
+        self.target_averager.step()
 
     def setup_optimizers(self, actor_lr, critic_lr, alpha_lr, vae_lr):
-        self.actor_optim = torch.optim.Adam(self.actor.parameters(), lr=actor_lr)
-        self.critic_optim = torch.optim.Adam(self.critic.parameters(), lr=critic_lr)
-        self.cost_critic_optim = torch.optim.Adam(self.cost_critic.parameters(),
-                                                  lr=critic_lr)
-        self.vae_optim = torch.optim.Adam(self.vae.parameters(), lr=vae_lr)
+        self.actor_optim = build_adam(module_parameters(self.actor), actor_lr)
+        self.critic_optim = build_adam(module_parameters(self.critic), critic_lr)
+        self.cost_critic_optim = build_adam(module_parameters(self.cost_critic),
+                                            critic_lr)
+        self.vae_optim = build_adam(module_parameters(self.vae), vae_lr)
         self.alpha_lr = alpha_lr
 
     def act(self,
@@ -266,6 +329,8 @@ class CPQTrainer:
         vae_lr (float): learning rate for vae
         reward_scale (float): The scaling factor for the reward signal.
         cost_scale (float): The scaling factor for the constraint cost.
+        fused_critic_update (bool): Whether to update the critic and the cost critic
+            together with `CPQ.critics_loss`, which shares their target actions.
         device (str): The device to use for training (e.g. "cpu" or "cuda").
     """
 
@@ -281,6 +346,7 @@ class CPQTrainer:
             vae_lr: float = 1e-4,
             reward_scale: float = 1.0,
             cost_scale: float = 1.0,
+            fused_critic_update: bool = False,
             device="cpu") -> None:
 
         self.model = model
@@ -288,6 +354,7 @@ class CPQTrainer:
         self.env = env
         self.reward_scale = reward_scale
         self.cost_scale = cost_scale
+        self.fused_critic_update = fused_critic_update
         self.device = device
         self.model.setup_optimizers(actor_lr, critic_lr, alpha_lr, vae_lr)
 
@@ -295,13 +362,18 @@ class CPQTrainer:
                        done):
         # update VAE
         loss_vae, stats_vae = self.model.vae_loss(observations, actions)
-        # update critic
-        loss_critic, stats_critic = self.model.critic_loss(observations,
-                                                           next_observations, actions,
-                                                           rewards, done)
-        # update cost critic
-        loss_cost_critic, stats_cost_critic = self.model.cost_critic_loss(
-            observations, next_observations, actions, costs, done)
+        if self.fused_critic_update:
+            # update critic and cost critic
+            loss_critic, stats_critic, loss_cost_critic, stats_cost_critic = \
+                self.model.critics_loss(observations, next_observations, actions,
+                                        rewards, costs, done)
+        else:
+            # update critic
+            loss_critic, stats_critic = self.model.critic_loss(
+                observations, next_observations, actions, rewards, done)
+            # update cost critic
+            loss_cost_critic, stats_cost_critic = self.model.cost_critic_loss(
+                observations, next_observations, actions, costs, done)
         # update actor
         loss_actor, stats_actor = self.model.actor_loss(observations)
 
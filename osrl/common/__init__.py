@@ -1,3 +1,3 @@
-from osrl.common.dataset import SequenceDataset, TransitionDataset
+from osrl.common.dataset import Prefetcher, SequenceDataset, TransitionDataset
 from osrl.common.exp_util import *
 from osrl.common.net import *
@@ -1,18 +1,22 @@
-import copy
-import heapq
-import random
-from collections import Counter, defaultdict
-from typing import Any, DefaultDict, Dict, List, Optional, Tuple, Union
+import hashlib
+import os
+import queue
+import shutil
+import threading
+from collections import Counter
+from typing import Any, DefaultDict, Dict, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
+import torch
 
 try:
     import oapackage
 except ImportError:
     print("OApackage is not installed, can not use CDT.")
-from scipy.optimize import minimize
+from scipy.signal import lfilter
+from scipy.spatial import cKDTree
 from torch.nn import functional as F  # noqa
-from torch.utils.data import IterableDataset
+from torch.utils.data import IterableDataset, get_worker_info
 from tqdm.auto import trange  # noqa
 
 
@@ -20,14 +24,44 @@ def discounted_cumsum(x: np.ndarray, gamma: float) -> np.ndarray:
     """
     Calculate the discounted cumulative sum of x (can be rewards or costs).
     """
-    cumsum = np.zeros_like(x)
-    cumsum[-1] = x[-1]
-    for t in reversed(range(x.shape[0] - 1)):
-        cumsum[t] = x[t] + gamma * cumsum[t + 1]
-    return cumsum
+    if gamma == 1:
+        return np.ascontiguousarray(np.cumsum(x[::-1], axis=0)[::-1])
+    # cumsum[t] = x[t] + gamma * cumsum[t + 1] is a first-order IIR filter on reversed x
+    cumsum = lfilter([1], [1, -gamma], x[::-1], axis=0)[::-1]
+    return np.ascontiguousarray(cumsum, dtype=x.dtype)
 
 
-def process_bc_dataset(dataset: dict, cost_limit: float, gamma: float, bc_mode: str):
+def segment_discounted_cumsum(x: np.ndarray, done_idx: np.ndarray,
+                              gamma: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calculate the discounted cumulative sum of x within every episode of a flat dataset.
+
+    Args:
+        x (np.ndarray): A flat array of per-transition values (can be rewards or costs).
+        done_idx (np.ndarray): The index of the last transition of every episode.
+        gamma (float): The discount factor.
+
+    Returns:
+        returns (np.ndarray): The discounted return-to-go of every transition up to
+            done_idx[-1], transitions after it do not belong to a complete episode.
+        totals (np.ndarray): The discounted return of every episode.
+    """
+    starts = np.append(0, done_idx[:-1] + 1)[:done_idx.shape[0]].astype(int)
+    ends = np.asarray(done_idx, dtype=int) + 1
+    n_transitions = ends[-1] if ends.shape[0] > 0 else 0
+    # every episode is summed on its own, in the dtype of x, so that the returns are
+    # the same as those of discounted_cumsum on the episode
+    returns = np.empty(n_transitions, dtype=x.dtype)
+    for start, end in zip(starts, ends):
+        returns[start:end] = discounted_cumsum(x[start:end], gamma)
+    return returns, returns[starts]
+
+
+def process_bc_dataset(dataset: dict,
+                       cost_limit: float,
+                       gamma: float,
+                       bc_mode: str,
+                       copy: bool = True):
     """
     Processes a givne dataset for behavior cloning and its variants.
 
@@ -46,6 +80,8 @@ def process_bc_dataset(dataset: dict, cost_limit: float, gamma: float, bc_mode:
                                           Required if bc_mode is "frontier".
         frontier_range (float, optional): The range around the frontier to use for selecting trajectories. 
                                            Required if bc_mode is "frontier".
+        copy (bool): If False and every transition is selected (e.g. in the "all" and
+            "multi-task" modes), the arrays are kept as they are instead of being copied.
     
     Returns:
         dict: A dictionary containing the processed dataset.
@@ -58,80 +94,113 @@ def process_bc_dataset(dataset: dict, cost_limit: float, gamma: float, bc_mode:
     n_transitions = dataset["observations"].shape[0]
     dataset["cost_returns"] = np.zeros_like(dataset["costs"])
     dataset["rew_returns"] = np.zeros_like(dataset["rewards"])
-    cost_ret, rew_ret = [], []
-    pareto_frontier, pf_mask = None, None
 
     # compute episode returns
-    for i in range(done_idx.shape[0]):
-        start = 0 if i == 0 else done_idx[i - 1] + 1
-        end = done_idx[i] + 1
-        # compute the cost and reward returns for the segment
-        cost_returns = discounted_cumsum(dataset["costs"][start:end], gamma=gamma)
-        reward_returns = discounted_cumsum(dataset["rewards"][start:end], gamma=gamma)
-        dataset["cost_returns"][start:end] = cost_returns[0]
-        dataset["rew_returns"][start:end] = reward_returns[0]
-        cost_ret.append(cost_returns[0])
-        rew_ret.append(reward_returns[0])
+    _, cost_ret = segment_discounted_cumsum(dataset["costs"], done_idx, gamma)
+    _, rew_ret = segment_discounted_cumsum(dataset["rewards"], done_idx, gamma)
+    # every transition of an episode gets its episode return
+    n_complete = done_idx[-1] + 1 if done_idx.shape[0] > 0 else 0
+    traj_lens = np.diff(done_idx, prepend=-1)
+    dataset["cost_returns"][:n_complete] = np.repeat(cost_ret, traj_lens)
+    dataset["rew_returns"][:n_complete] = np.repeat(rew_ret, traj_lens)
 
     # compute Pareto Frontier
+    frontier = None
     if bc_mode == "frontier":
-        cost_ret = np.array(cost_ret, dtype=np.float64)
-        rew_ret = np.array(rew_ret, dtype=np.float64)
-        rmax, rmin = np.max(rew_ret), np.min(rew_ret)
-
-        pareto = oapackage.ParetoDoubleLong()
-        for i in range(rew_ret.shape[0]):
-            w = oapackage.doubleVector((-cost_ret[i], rew_ret[i]))
-            pareto.addvalue(w, i)
-        pareto.show(verbose=1)
-        pareto_idx = list(pareto.allindices())
-        cost_ret_pareto = cost_ret[pareto_idx]
-        rew_ret_pareto = rew_ret[pareto_idx]
-
-        for deg in [0, 1, 2]:
-            pareto_frontier = np.poly1d(
-                np.polyfit(cost_ret_pareto, rew_ret_pareto, deg=deg))
-            pf_rew_ret = pareto_frontier(cost_ret_pareto)
-            ss_total = np.sum((rew_ret_pareto - np.mean(rew_ret_pareto))**2)
-            ss_residual = np.sum((rew_ret_pareto - pf_rew_ret)**2)
-            r_squared = 1 - (ss_residual / ss_total)
-            if r_squared >= 0.9:
-                break
-
-        pf_rew_ret = pareto_frontier(dataset["cost_returns"])
-        pf_mask = np.logical_and(
-            pf_rew_ret - (rmax - rmin) / 5 <= dataset["rew_returns"],
-            dataset["rew_returns"] <= pf_rew_ret + (rmax - rmin) / 5)
+        frontier = fit_bc_frontier(cost_ret, rew_ret)
 
     # select the transitions for behavior cloning based on the mode
+    selected_transition = select_bc_transitions(dataset["cost_returns"],
+                                                dataset["rew_returns"], cost_limit,
+                                                bc_mode, frontier)
+
+    # a single index for all the keys
+    idx = np.flatnonzero(selected_transition == 1)
+    if copy or idx.shape[0] < n_transitions:
+        for k, v in dataset.items():
+            dataset[k] = v[idx]
+    if bc_mode == "multi-task":
+        dataset["observations"] = np.hstack(
+            (dataset["observations"], dataset["cost_returns"].reshape(-1, 1)))
+
+    print(
+        f"original size = {n_transitions}, cost limit = {cost_limit}, filtered size = {idx.shape[0]}"
+    )
+
+
+def fit_bc_frontier(cost_ret: np.ndarray, rew_ret: np.ndarray):
+    """
+    Fits the Pareto frontier of the episode returns for the "frontier" behavior cloning mode.
+
+    Args:
+        cost_ret (np.ndarray): The cost return of every episode.
+        rew_ret (np.ndarray): The reward return of every episode.
+
+    Returns:
+        Tuple[np.poly1d, float]: The frontier and the half width of the band around it
+            whose transitions are selected.
+    """
+    cost_ret = np.array(cost_ret, dtype=np.float64)
+    rew_ret = np.array(rew_ret, dtype=np.float64)
+    rmax, rmin = np.max(rew_ret), np.min(rew_ret)
+
+    pareto = oapackage.ParetoDoubleLong()
+    for i in range(rew_ret.shape[0]):
+        w = oapackage.doubleVector((-cost_ret[i], rew_ret[i]))
+        pareto.addvalue(w, i)
+    pareto.show(verbose=1)
+    pareto_idx = list(pareto.allindices())
+    cost_ret_pareto = cost_ret[pareto_idx]
+    rew_ret_pareto = rew_ret[pareto_idx]
+
+    for deg in [0, 1, 2]:
+        pareto_frontier = np.poly1d(np.polyfit(cost_ret_pareto, rew_ret_pareto, deg=deg))
+        pf_rew_ret = pareto_frontier(cost_ret_pareto)
+        ss_total = np.sum((rew_ret_pareto - np.mean(rew_ret_pareto))**2)
+        ss_residual = np.sum((rew_ret_pareto - pf_rew_ret)**2)
+        r_squared = 1 - (ss_residual / ss_total)
+        if r_squared >= 0.9:
+            break
+    return pareto_frontier, (rmax - rmin) / 5
+
+
+def select_bc_transitions(
+        cost_returns: np.ndarray,
+        rew_returns: np.ndarray,
+        cost_limit: float,
+        bc_mode: str,
+        frontier: Optional[Tuple[np.poly1d, float]] = None) -> np.ndarray:
+    """
+    Selects the transitions for behavior cloning from the returns of their episodes,
+    see `process_bc_dataset` for the modes. `frontier` comes from `fit_bc_frontier`.
+
+    Returns:
+        np.ndarray: 1 for the selected transitions, 0 otherwise.
+    """
+    n_transitions = cost_returns.shape[0]
     selected_transition = np.zeros((n_transitions, ), dtype=int)
     if bc_mode == "all" or bc_mode == "multi-task":
         selected_transition = np.ones((n_transitions, ), dtype=int)
     elif bc_mode == "safe":
         # safe trajectories
-        selected_transition[dataset["cost_returns"] <= cost_limit] = 1
+        selected_transition[cost_returns <= cost_limit] = 1
     elif bc_mode == "risky":
         # high cost trajectories
-        selected_transition[dataset["cost_returns"] >= 2 * cost_limit] = 1
+        selected_transition[cost_returns >= 2 * cost_limit] = 1
     elif bc_mode == "boundary":
         # trajectories that are near the cost limit
-        mask = np.logical_and(0.5 * cost_limit < dataset["cost_returns"],
-                              dataset["cost_returns"] <= 1.5 * cost_limit)
+        mask = np.logical_and(0.5 * cost_limit < cost_returns, cost_returns
+                              <= 1.5 * cost_limit)
         selected_transition[mask] = 1
     elif bc_mode == "frontier":
+        pareto_frontier, width = frontier
+        pf_rew_ret = pareto_frontier(cost_returns)
+        pf_mask = np.logical_and(pf_rew_ret - width <= rew_returns, rew_returns
+                                 <= pf_rew_ret + width)
         selected_transition[pf_mask] = 1
     else:
         raise NotImplementedError
-
-    for k, v in dataset.items():
-        dataset[k] = v[selected_transition == 1]
-    if bc_mode == "multi-task":
-        dataset["observations"] = np.hstack(
-            (dataset["observations"], dataset["cost_returns"].reshape(-1, 1)))
-
-    print(
-        f"original size = {n_transitions}, cost limit = {cost_limit}, filtered size = {np.sum(selected_transition == 1)}"
-    )
+    return selected_transition
 
 
 def process_sequence_dataset(dataset: dict, cost_reverse: bool = False):
@@ -151,38 +220,108 @@ def process_sequence_dataset(dataset: dict, cost_reverse: bool = False):
         info (dict): A dictionary containing additional information about the trajectories
 
     '''
-    traj, traj_len = [], []
-    data_, episode_step = defaultdict(list), 0
-    for i in trange(dataset["rewards"].shape[0], desc="Processing trajectories"):
-        data_["observations"].append(dataset["observations"][i])
-        data_["actions"].append(dataset["actions"][i])
-        data_["rewards"].append(dataset["rewards"][i])
-        if cost_reverse:
-            data_["costs"].append(1.0 - dataset["costs"][i])
-        else:
-            data_["costs"].append(dataset["costs"][i])
-
-        if dataset["terminals"][i] or dataset["timeouts"][i]:
-            episode_data = {k: np.array(v, dtype=np.float32) for k, v in data_.items()}
-            # return-to-go if gamma=1.0, just discounted returns else
-            episode_data["returns"] = discounted_cumsum(episode_data["rewards"], gamma=1)
-            episode_data["cost_returns"] = discounted_cumsum(episode_data["costs"],
-                                                             gamma=1)
-            traj.append(episode_data)
-            traj_len.append(episode_step)
-            # reset trajectory buffer
-            data_, episode_step = defaultdict(list), 0
-        episode_step += 1
+    # the index of the last transition of every episode, transitions after the last
+    # terminal or timeout do not form a complete episode and are dropped
+    done_idx = np.flatnonzero(np.logical_or(dataset["terminals"], dataset["timeouts"]))
+    n_transitions = done_idx[-1] + 1 if done_idx.shape[0] > 0 else 0
+    split_idx = done_idx[:-1] + 1
+
+    costs = dataset["costs"][:n_transitions]
+    if cost_reverse:
+        costs = 1.0 - costs
+    fields = {
+        "observations": dataset["observations"][:n_transitions],
+        "actions": dataset["actions"][:n_transitions],
+        "rewards": dataset["rewards"][:n_transitions],
+        "costs": costs,
+    }
+    # convert every field once, the episodes are views into the converted arrays
+    fields = {k: np.asarray(v, dtype=np.float32) for k, v in fields.items()}
+    # return-to-go if gamma=1.0, just discounted returns else
+    fields["returns"], _ = segment_discounted_cumsum(fields["rewards"], done_idx, 1)
+    fields["cost_returns"], _ = segment_discounted_cumsum(fields["costs"], done_idx, 1)
+    episodes = {k: np.split(v, split_idx) for k, v in fields.items()}
+    traj = [{k: v[i] for k, v in episodes.items()} for i in range(done_idx.shape[0])]
+
+    # the step counter of the first episode starts from 0, the others from 1
+    traj_len = np.diff(done_idx, prepend=-1)
+    traj_len[:1] -= 1
 
     # needed for normalization, weighted sampling, other stats can be added also
     info = {
         "obs_mean": dataset["observations"].mean(0, keepdims=True),
         "obs_std": dataset["observations"].std(0, keepdims=True) + 1e-6,
-        "traj_lens": np.array(traj_len),
+        "traj_lens": traj_len,
     }
     return traj, info
 
 
+class CostBoundedNearest:
+    """
+    Answers "nearest point with cost <= bound" queries over a set of (cost, reward) points.
+    The points are sorted by cost so that the allowed points of a query are a prefix of
+    the sorted array. Every prefix is covered by O(log n) aligned power-of-two blocks,
+    each one with its own KD-tree, and the blocks smaller than `leaf_size` are searched
+    exhaustively.
+
+    Args:
+        points (np.ndarray): A [n, 2] array of (cost, reward) points.
+        leaf_size (int): The block size below which no KD-tree is built. Defaults to 32.
+    """
+
+    def __init__(self, points: np.ndarray, leaf_size: int = 32):
+        points = np.asarray(points, dtype=np.float64)
+        # duplicated points keep their first occurrence, as np.argmin would return it
+        _, first = np.unique(points, axis=0, return_index=True)
+        self.index = first[np.argsort(points[first, 0], kind="stable")]
+        self.points = points[self.index]
+        self.level = int(leaf_size - 1).bit_length()
+
+        n = self.points.shape[0]
+        self.trees = {}
+        for k in range(self.level, n.bit_length()):
+            size = 1 << k
+            for b in range(n // size):
+                self.trees[k, b] = cKDTree(self.points[b * size:(b + 1) * size])
+
+    def query(self, queries: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+        """
+        Returns the index of the nearest point with cost <= bound for every query.
+        """
+        queries = np.asarray(queries, dtype=np.float64)
+        m = np.searchsorted(self.points[:, 0], bounds, side="right")
+        if np.any(m == 0):
+            raise ValueError("No point has a cost below the bound of some queries.")
+        best_dist = np.full(queries.shape[0], np.inf)
+        best = np.zeros(queries.shape[0], dtype=int)
+
+        def update(sel, dist, idx):
+            better = dist < best_dist[sel]
+            best_dist[sel[better]] = dist[better]
+            best[sel[better]] = idx[better]
+
+        # the set bits of the prefix length m select the blocks covering [0, m)
+        for k in range(self.level, self.points.shape[0].bit_length()):
+            has_block = (m >> k) & 1 == 1
+            block = (m >> (k + 1)) << 1
+            for b in np.unique(block[has_block]):
+                sel = np.flatnonzero(has_block & (block == b))
+                dist, idx = self.trees[k, b].query(queries[sel])
+                update(sel, dist, idx + (b << k))
+
+        # the points after the last block are searched exhaustively
+        start = (m >> self.level) << self.level
+        candidate = start[:, None] + np.arange(1 << self.level)
+        valid = candidate < m[:, None]
+        candidate = np.where(valid, candidate, 0)
+        delta = self.points[candidate] - queries[:, None]
+        dist = np.where(valid, np.hypot(delta[..., 0], delta[..., 1]), np.inf)
+        nearest = np.argmin(dist, axis=1)
+        sel = np.arange(queries.shape[0])
+        update(sel, dist[sel, nearest], candidate[sel, nearest])
+        return self.index[best]
+
+
 def get_nearest_point(original_data: np.ndarray,
                       sampled_data: np.ndarray,
                       max_rew_decrease: float = 1,
@@ -202,17 +341,9 @@ def get_nearest_point(original_data: np.ndarray,
         to each sample in the sampled data.
     """
 
-    idxes = []
     original_idx = np.arange(0, original_data.shape[0])
-    # for i in trange(sampled_data.shape[0], desc="Calculating nearest point"):
-    for i in range(sampled_data.shape[0]):
-        p = sampled_data[i, :]
-        mask = original_data[:, 0] <= p[0]
-        # mask = np.logical_and(original_data[:, 0] <= p[0], original_data[:, 0] >= p[0] - 5)
-        delta = original_data[mask, :] - p
-        dist = np.hypot(delta[:, 0], delta[:, 1])
-        idx = np.argmin(dist)
-        idxes.append(original_idx[mask][idx])
+    nearest = CostBoundedNearest(original_data)
+    idxes = nearest.query(sampled_data, sampled_data[:, 0]).tolist()
     counts = dict(Counter(idxes))
 
     new_idxes = []
@@ -236,6 +367,99 @@ def get_nearest_point(original_data: np.ndarray,
     return new_idxes
 
 
+def get_generator(rng: Optional[np.random.Generator] = None) -> np.random.Generator:
+    """
+    Returns `rng`, or a new Generator seeded from the global numpy random state so that
+    the results still follow `seed_all`.
+    """
+    if rng is None:
+        rng = np.random.default_rng(np.random.randint(2**31))
+    return rng
+
+
+def worker_generator(seed: int) -> np.random.Generator:
+    """
+    Returns the random generator of the calling process. Every DataLoader worker gets
+    its own stream spawned from the seed with `SeedSequence`, the main process uses the
+    root one, so the workers never draw correlated samples and the streams are the same
+    from one run to the next.
+    """
+    info = get_worker_info()
+    spawn_key = () if info is None else (info.id, )
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=spawn_key))
+
+
+def epoch_batches(size: int,
+                  batch_size: int,
+                  seed: int,
+                  num_shards: int = 1,
+                  shard: int = 0) -> Iterator[np.ndarray]:
+    """
+    Yields the indices of range(size) epoch after epoch, without replacement. Every epoch
+    shuffles the indices, splits the permutation into `num_shards` contiguous slices and
+    walks the `shard`-th one in chunks of `batch_size`, the last chunk of a slice may be
+    smaller. The indices of a chunk are sorted, so that the gather reads the arrays in
+    memory order.
+
+    Args:
+        size (int): The number of items.
+        batch_size (int): The number of indices yielded at once.
+        seed (int): The seed of the permutations, it must be the same for all the shards
+            so that their slices are disjoint.
+        num_shards (int): The number of disjoint slices, e.g. the DataLoader workers.
+        shard (int): The slice walked by the caller.
+    """
+    rng = np.random.default_rng(seed)
+    while True:
+        perm = np.array_split(rng.permutation(size), num_shards)[shard]
+        for start in range(0, perm.shape[0], batch_size):
+            yield np.sort(perm[start:start + batch_size])
+
+
+def worker_epoch_batches(size: int, batch_size: int, seed: int) -> Iterator[np.ndarray]:
+    """
+    `epoch_batches` sharded over the DataLoader workers, the calling worker walks its own
+    slice of every epoch.
+    """
+    info = get_worker_info()
+    if info is None:
+        return epoch_batches(size, batch_size, seed)
+    return epoch_batches(size, batch_size, seed, info.num_workers, info.id)
+
+
+def group_by_bin(*bins: np.ndarray):
+    """
+    Groups the points by their bin ids, the groups are numbered in the order of their
+    first point.
+
+    Args:
+        bins (np.ndarray): The non-negative integer bin ids of the points along every axis.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The group of every point and the size of its group.
+    """
+    # merge the bin ids of all the axes into a single integer key
+    key = np.zeros(bins[0].shape[0], dtype=np.int64)
+    for b in bins:
+        b = b.astype(np.int64)
+        key = key * (np.max(b, initial=0) + 1) + b
+    _, first, inverse, counts = np.unique(key,
+                                          return_index=True,
+                                          return_inverse=True,
+                                          return_counts=True)
+    group = np.argsort(np.argsort(first))[inverse]
+    return group, counts[inverse]
+
+
+def rank_in_group(group: np.ndarray) -> np.ndarray:
+    """
+    Returns the position of every point inside its group, given the sorted group ids.
+    """
+    n = group.shape[0]
+    group_start = np.flatnonzero(np.diff(group, prepend=-1))
+    return np.arange(n) - np.repeat(group_start, np.diff(np.append(group_start, n)))
+
+
 def grid_filter(x,
                 y,
                 xmin=-np.inf,
@@ -245,30 +469,26 @@ def grid_filter(x,
                 xbins=10,
                 ybins=10,
                 max_num_per_bin=10,
-                min_num_per_bin=1):
-    xmin, xmax = max(min(x), xmin), min(max(x), xmax)
-    ymin, ymax = max(min(y), ymin), min(max(y), ymax)
+                min_num_per_bin=1,
+                rng: Optional[np.random.Generator] = None):
+    x, y = np.asarray(x), np.asarray(y)
+    xmin, xmax = max(np.min(x), xmin), min(np.max(x), xmax)
+    ymin, ymax = max(np.min(y), ymin), min(np.max(y), ymax)
     xbin_step = (xmax - xmin) / xbins
     ybin_step = (ymax - ymin) / ybins
-    # the key is x y bin index, the value is a list of indices
-    bin_hashmap = defaultdict(list)
-    for i in range(len(x)):
-        if x[i] < xmin or x[i] > xmax or y[i] < ymin or y[i] > ymax:
-            continue
-        x_bin_idx = (x[i] - xmin) // xbin_step
-        y_bin_idx = (y[i] - ymin) // ybin_step
-        bin_hashmap[(x_bin_idx, y_bin_idx)].append(i)
-    # start filtering
-    indices = []
-    for v in bin_hashmap.values():
-        if len(v) > max_num_per_bin:
-            # random sample max_num_per_bin indices
-            indices += random.sample(v, max_num_per_bin)
-        elif len(v) <= min_num_per_bin:
-            continue
-        else:
-            indices += v
-    return indices
+    idx = np.flatnonzero((x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax))
+    if idx.shape[0] == 0:
+        return []
+    # the x y bin index of every point, floor_divide matches the `//` of python floats
+    group, sizes = group_by_bin(np.floor_divide(x[idx] - xmin, xbin_step),
+                                np.floor_divide(y[idx] - ymin, ybin_step))
+    # start filtering, the points of the bins with more than max_num_per_bin points are
+    # shuffled before keeping the first ones, the other bins stay in index order
+    key = np.where(sizes > max_num_per_bin, get_generator(rng).random(idx.shape[0]), 0)
+    order = np.lexsort((idx, key, group))
+    rank = rank_in_group(group[order])
+    keep = (sizes[order] > min_num_per_bin) & (rank < max_num_per_bin)
+    return idx[order[keep]].tolist()
 
 
 def filter_trajectory(cost,
@@ -281,7 +501,8 @@ def filter_trajectory(cost,
                       cost_bins=60,
                       rew_bins=50,
                       max_num_per_bin=10,
-                      min_num_per_bin=1):
+                      min_num_per_bin=1,
+                      rng: Optional[np.random.Generator] = None):
     indices = grid_filter(cost,
                           rew,
                           cost_min,
@@ -291,7 +512,8 @@ def filter_trajectory(cost,
                           xbins=cost_bins,
                           ybins=rew_bins,
                           max_num_per_bin=max_num_per_bin,
-                          min_num_per_bin=min_num_per_bin)
+                          min_num_per_bin=min_num_per_bin,
+                          rng=rng)
     cost2, rew2, traj2 = [], [], []
     for i in indices:
         cost2.append(cost[i])
@@ -388,25 +610,29 @@ def augmentation(trajs: list,
     aug_trajs = []
     for i, target in zip(nearest_idx, sampled_data):
         target_cost_ret, target_rew_ret = target[0], target[1]
-        associated_traj = copy.deepcopy(trajs[i])
-        cost_ret, rew_ret = associated_traj["cost_returns"], associated_traj["returns"]
+        # only the relabelled returns are copied, the other arrays stay shared
+        associated_traj = dict(trajs[i])
+        cost_ret = associated_traj["cost_returns"] = trajs[i]["cost_returns"].copy()
+        rew_ret = associated_traj["returns"] = trajs[i]["returns"].copy()
         cost_ret += target_cost_ret - cost_ret[0]
         rew_ret += target_rew_ret - rew_ret[0]
         aug_trajs.append(associated_traj)
     return nearest_idx, aug_trajs, pareto_frontier, indices
 
 
-def compute_sample_prob(dataset, pareto_frontier, beta):
+def compute_sample_prob(dataset, pareto_frontier, beta, max_iter=50, tol=1e-8):
     """
     Computes the probability of sampling each trajectory in a given dataset.
 
     Args:
         dataset (list): A list of dictionaries containing the trajectories 
                         to compute the sample probabilities for.
-        pareto_frontier (callable): A function that takes in a cost value and 
-                                    returns the corresponding maximum reward value 
-                                    on the Pareto frontier.
+        pareto_frontier (np.poly1d): A polynomial that takes in a cost value and 
+                                     returns the corresponding maximum reward value 
+                                     on the Pareto frontier.
         beta (float): A hyperparameter that controls the shape of the probability distribution.
+        max_iter (int): The maximum number of Newton iterations. Defaults to 50.
+        tol (float): The step size at which the iterations stop. Defaults to 1e-8.
 
     Returns:
         np.ndarray: A 1D numpy array of the same length as the dataset, 
@@ -422,20 +648,80 @@ def compute_sample_prob(dataset, pareto_frontier, beta):
     rew_ret = np.array(rew_ret, dtype=np.float64)  # type should be float64
     cost_ret = np.array(cost_ret, dtype=np.float64)
 
-    prob_fun = lambda x: 1 / (x + beta)
-    sample_prob = []
-    for i in trange(cost_ret.shape[0], desc="Calculating sample prob"):
-        r, c = rew_ret[i], cost_ret[i]
-        dist_fun = lambda x: (x - c)**2 + (pareto_frontier(x) - r)**2
-        sol = minimize(dist_fun, x0=c, method="bfgs", tol=1e-4)
-        x = np.max([0, (sol.x)[0]])
-        dist = np.sqrt(dist_fun(x))
-        prob = prob_fun(dist)
-        sample_prob.append(prob)
+    dist = pareto_distance(cost_ret, rew_ret, pareto_frontier, max_iter, tol)
+    sample_prob = 1 / (dist + beta)
     sample_prob /= np.sum(sample_prob)
     return sample_prob
 
 
+def _frontier_newton(poly, x, c, r, max_iter, tol):
+    """
+    Damped Newton iterations on the derivative of the squared distance of every point
+    (c, r) to the polynomial, from x and only accepting descent steps.
+    """
+    d_poly, dd_poly = poly.deriv(), poly.deriv(2)
+    dist_fun = lambda x: (x - c)**2 + (poly(x) - r)**2
+    for _ in range(max_iter):
+        p, dp = poly(x) - r, d_poly(x)
+        grad = (x - c) + p * dp
+        hess = 1 + dp**2 + p * dd_poly(x)
+        # fall back to a scaled gradient step where the distance is not convex
+        step = np.where(hess > 0, grad / np.maximum(hess, 1e-12), grad / (1 + dp**2))
+        # halve the steps that do not decrease the distance
+        f = dist_fun(x)
+        for _ in range(20):
+            worse = dist_fun(x - step) > f
+            if not worse.any():
+                break
+            step = np.where(worse, step / 2, step)
+        x = x - step
+        if np.max(np.abs(step), initial=0) < tol:
+            break
+    return x
+
+
+def pareto_distance(cost_ret,
+                    rew_ret,
+                    pareto_frontier,
+                    max_iter=50,
+                    tol=1e-8,
+                    n_grid=32):
+    """
+    Computes the distance of every (cost, reward) point to the polynomial Pareto frontier.
+    All the points are solved together with damped Newton iterations on the derivative
+    of the squared distance. They start from x = cost, and from the argmin of a coarse
+    grid around it, so that a non-monotone frontier does not trap them in a farther
+    local minimum, and the closer of the two solutions is kept.
+
+    Args:
+        cost_ret (np.ndarray): The cost returns of the points.
+        rew_ret (np.ndarray): The reward returns of the points.
+        pareto_frontier (np.poly1d): The Pareto frontier polynomial.
+        max_iter (int): The maximum number of Newton iterations. Defaults to 50.
+        tol (float): The step size at which the iterations stop. Defaults to 1e-8.
+        n_grid (int): The number of points of the grid. Defaults to 32.
+
+    Returns:
+        np.ndarray: The distance of every point to the frontier, with the closest
+            frontier point clipped to non-negative costs.
+    """
+    poly = np.poly1d(pareto_frontier)
+    c, r = np.asarray(cost_ret, np.float64), np.asarray(rew_ret, np.float64)
+    dist_fun = lambda x: (x - c)**2 + (poly(x) - r)**2
+
+    # the closest frontier point is at most |poly(c) - r| away from c
+    radius = np.abs(poly(c) - r)
+    grid = c[:, None] + radius[:, None] * np.linspace(-1, 1, n_grid)
+    grid_dist = (grid - c[:, None])**2 + (poly(grid) - r[:, None])**2
+    x_grid = grid[np.arange(c.shape[0]), np.argmin(grid_dist, axis=1)]
+
+    x = _frontier_newton(poly, np.concatenate([c, x_grid]), np.tile(c, 2), np.tile(r, 2),
+                         max_iter, tol).reshape(2, -1)
+    x = x[np.argmin(dist_fun(x), axis=0), np.arange(c.shape[0])]
+    x = np.maximum(x, 0)
+    return np.sqrt(dist_fun(x))
+
+
 def compute_cost_sample_prob(dataset, cost_transform=lambda x: 50 - x):
     """
     Computes the sample probabilities for a given dataset based on its costs.
@@ -528,30 +814,19 @@ def select_optimal_trajectory(trajs, rmin=0, cost_bins=60, max_num_per_bin=1):
         r, c = traj["returns"][0], traj["cost_returns"][0]
         rew.append(r)
         cost.append(c)
+    rew, cost = np.array(rew), np.array(cost)
 
-    xmin, xmax = min(cost), max(cost)
+    xmin, xmax = np.min(cost), np.max(cost)
     xbin_step = (xmax - xmin) / cost_bins
-    # the key is x y bin index, the value is a list of indices
-    bin_hashmap = defaultdict(list)
-    for i in range(len(cost)):
-        if rew[i] < rmin:
-            continue
-        x_bin_idx = (cost[i] - xmin) // xbin_step
-        bin_hashmap[x_bin_idx].append(i)
-
-    # start filtering
-    def sort_index(idx):
-        return rew[idx]
-
-    indices = []
-    for v in bin_hashmap.values():
-        idx = heapq.nlargest(max_num_per_bin, v, key=sort_index)
-        indices += idx
-
-    traj2 = []
-    for i in indices:
-        traj2.append(trajs[i])
-    return traj2
+    idx = np.flatnonzero(rew >= rmin)
+    # the x bin index of every point, floor_divide matches the `//` of python floats
+    group, _ = group_by_bin(np.floor_divide(cost[idx] - xmin, xbin_step))
+
+    # start filtering, keep the max_num_per_bin largest returns of every bin, the ties
+    # are broken by index like heapq.nlargest
+    order = np.lexsort((idx, -rew[idx], group))
+    keep = rank_in_group(group[order]) < max_num_per_bin
+    return [trajs[i] for i in idx[order[keep]]]
 
 
 def random_augmentation(trajs: list,
@@ -602,26 +877,18 @@ def random_augmentation(trajs: list,
                                    high=(aug_cmax, aug_rmax),
                                    size=(num, 2))
 
-    idxes = []
     original_data = np.hstack([cost_ret[:, None], rew_ret[:, None]])
-    original_idx = np.arange(0, original_data.shape[0])
-    # for i in trange(sampled_data.shape[0], desc="Calculating nearest point"):
-    for i in range(sampled_cr.shape[0]):
-        p = sampled_cr[i, :]
-        boundary = max(p[0] - cgap, cmin + 1)
-        mask = original_data[:, 0] <= boundary
-        # mask = np.logical_and(original_data[:, 0] <= p[0], original_data[:, 0] >= p[0] - 5)
-        delta = original_data[mask, :] - p
-        dist = np.hypot(delta[:, 0], delta[:, 1])
-        idx = np.argmin(dist)
-        idxes.append(original_idx[mask][idx])
+    boundary = np.maximum(sampled_cr[:, 0] - cgap, cmin + 1)
+    idxes = CostBoundedNearest(original_data).query(sampled_cr, boundary).tolist()
 
     # relabel the dataset
     aug_trajs = []
     for i, target in zip(idxes, sampled_cr):
         target_cost_ret, target_rew_ret = target[0], target[1]
-        associated_traj = copy.deepcopy(trajs[i])
-        cost_ret, rew_ret = associated_traj["cost_returns"], associated_traj["returns"]
+        # only the relabelled returns are copied, the other arrays stay shared
+        associated_traj = dict(trajs[i])
+        cost_ret = associated_traj["cost_returns"] = trajs[i]["cost_returns"].copy()
+        rew_ret = associated_traj["returns"] = trajs[i]["returns"].copy()
         cost_ret += target_cost_ret - cost_ret[0] + np.random.normal(
             loc=0, scale=cstd, size=cost_ret.shape)
         rew_ret += target_rew_ret - rew_ret[0] + np.random.normal(
@@ -630,6 +897,120 @@ def random_augmentation(trajs: list,
     return idxes, aug_trajs
 
 
+def cache_key(dataset: dict, keys: List[str], args: dict) -> str:
+    """
+    Hashes the arrays `keys` of the dataset and the arguments into the name of a cache entry.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for k in keys:
+        v = np.ascontiguousarray(dataset[k])
+        h.update(f"{k}{v.dtype}{v.shape}".encode())
+        h.update(v.data)
+    h.update(repr(sorted(args.items())).encode())
+    return h.hexdigest()
+
+
+def save_arrays(path: str, arrays: Dict[str, np.ndarray]):
+    """
+    Saves the arrays as one .npy file each in the directory `path`. The files are written
+    to a temporary directory first, which is renamed into place once complete.
+    """
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    for k, v in arrays.items():
+        np.save(os.path.join(tmp_path, k + ".npy"), v)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process has written the same directory meanwhile
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_arrays(path: str) -> Dict[str, np.ndarray]:
+    """
+    Memory-maps the arrays saved by `save_arrays` read-only, the pages are only read when
+    they are touched and are shared by all the processes opening the same files.
+    """
+    return {
+        f[:-len(".npy")]: np.load(os.path.join(path, f), mmap_mode="r")
+        for f in os.listdir(path) if f.endswith(".npy")
+    }
+
+
+def to_storage_dtype(x: np.ndarray, dtype: Optional[str]) -> np.ndarray:
+    """
+    Casts an array to a half-precision storage dtype, "float16" or "bfloat16". numpy has
+    no bfloat16, so it is stored as the upper 16 bits of the float32 values, rounded to
+    the nearest even, in a uint16 array. None returns the array unchanged.
+    """
+    if dtype is None:
+        return x
+    if dtype == "float16":
+        if np.max(np.abs(x), initial=0) > np.finfo(np.float16).max:
+            raise ValueError("the values overflow float16, use bfloat16 instead")
+        return x.astype(np.float16)
+    if dtype == "bfloat16":
+        bits = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32)
+        bits = bits + (0x7FFF + ((bits >> 16) & 1))
+        return (bits >> 16).astype(np.uint16)
+    raise ValueError(f"unknown storage dtype {dtype}")
+
+
+def from_storage_dtype(x: np.ndarray, dtype: Optional[str]) -> np.ndarray:
+    """
+    Upcasts an array stored by `to_storage_dtype` back to float32.
+    """
+    if dtype is None:
+        return x
+    if dtype == "bfloat16":
+        return (x.astype(np.uint32) << 16).view(np.float32)
+    # the float16 conversion of torch is vectorized, the one of numpy is not
+    return torch.from_numpy(np.require(x, requirements="W")).float().numpy()
+
+
+class WeightedSampler:
+    """
+    Draws indices from one or several discrete distributions, the cumulative sums are
+    computed once so that every draw is a binary search.
+
+    Args:
+        weights (np.ndarray): The non-negative weights of all the distributions, flattened.
+        offsets (np.ndarray, optional): The boundaries of the distributions in `weights`, the
+            i-th one covers [offsets[i], offsets[i + 1]). Defaults to a single distribution.
+    """
+
+    def __init__(self, weights: np.ndarray, offsets: Optional[np.ndarray] = None):
+        weights = np.asarray(weights, dtype=np.float64)
+        if offsets is None:
+            offsets = np.array([0, weights.shape[0]])
+        self.offsets = np.asarray(offsets)
+        starts, ends = self.offsets[:-1], self.offsets[1:]
+        segment = np.repeat(np.arange(starts.shape[0]), ends - starts)
+
+        # normalize the cdf of every distribution and shift it by the distribution id,
+        # so that all of them live in one sorted array
+        cumsum = np.cumsum(weights)
+        base = np.append(0, cumsum)[starts]
+        total = cumsum[ends - 1] - base
+        self.cdf = (cumsum - base[segment]) / total[segment] + segment
+        self.cdf[ends - 1] = np.arange(starts.shape[0]) + 1
+
+    def sample(self,
+               size: Optional[int] = None,
+               segment: Optional[np.ndarray] = None,
+               rng: Optional[np.random.Generator] = None):
+        """
+        Draws `size` indices from the first distribution, or one index from each of the
+        distributions in `segment`. The indices are relative to their distribution.
+        The draws use `rng` if given, the global numpy random state otherwise.
+        """
+        if segment is None:
+            segment = np.zeros(() if size is None else size, dtype=int)
+        u = (np.random if rng is None else rng).random(np.shape(segment))
+        pos = np.searchsorted(self.cdf, segment + u, side="right")
+        return pos - self.offsets[segment]
+
+
 class SequenceDataset(IterableDataset):
     """
     A dataset of sequential data.
@@ -663,6 +1044,22 @@ class SequenceDataset(IterableDataset):
         cgap (float): Cost gap for random augmentation.
         rstd (float): Standard deviation of reward values for random augmentation.
         cstd (float): Standard deviation of cost values for random augmentation.
+        batch_size (int, optional): If given, the dataset yields whole padded batches of this
+            size instead of single windows. Use it with `DataLoader(batch_size=None)`.
+        cache_dir (str, optional): If given, the processed dataset is saved under this
+            directory, keyed by a hash of the raw arrays, the processing arguments and the
+            numpy random state. Later runs with the same key memory-map it instead of
+            processing the dataset again.
+        seed (int, optional): The seed of the sampling streams, every DataLoader worker
+            draws from its own stream spawned from it. Defaults to a seed drawn from the
+            numpy random state.
+        epoch_sampling (bool): If True, the dataset walks shuffled permutations of all the
+            windows (one per trajectory and start index) instead of sampling with
+            replacement, every window is seen once per epoch. The DataLoader workers walk
+            disjoint slices of each permutation. The sampling probabilities are ignored.
+        obs_dtype (str, optional): The storage dtype of the observations, "float16" or
+            "bfloat16", they are upcast to float32 when a batch is gathered. Defaults to
+            the dtype of the dataset.
     """
 
     def __init__(
@@ -695,12 +1092,89 @@ class SequenceDataset(IterableDataset):
         cgap: float = 5,
         rstd: float = 1,
         cstd: float = 0.2,
+        batch_size: Optional[int] = None,
+        cache_dir: Optional[str] = None,
+        seed: Optional[int] = None,
+        epoch_sampling: bool = False,
+        obs_dtype: Optional[str] = None,
     ):
-        self.original_data, info = process_sequence_dataset(dataset, cost_reverse)
         self.reward_scale = reward_scale
         self.cost_scale = cost_scale
         self.seq_len = seq_len
         self.start_sampling = start_sampling
+        self.batch_size = batch_size
+        self.epoch_sampling = epoch_sampling
+        self.obs_dtype = obs_dtype
+
+        # the arguments changing the processed trajectories
+        process_args = dict(deg=deg,
+                            pf_sample=pf_sample,
+                            max_rew_decrease=max_rew_decrease,
+                            beta=beta,
+                            augment_percent=augment_percent,
+                            max_reward=max_reward,
+                            min_reward=min_reward,
+                            cost_reverse=cost_reverse,
+                            pf_only=pf_only,
+                            rmin=rmin,
+                            cost_bins=cost_bins,
+                            npb=npb,
+                            cost_sample=cost_sample,
+                            prob=prob,
+                            start_sampling=start_sampling,
+                            random_aug=random_aug,
+                            aug_rmin=aug_rmin,
+                            aug_rmax=aug_rmax,
+                            aug_cmin=aug_cmin,
+                            aug_cmax=aug_cmax,
+                            cgap=cgap,
+                            rstd=rstd,
+                            cstd=cstd,
+                            obs_dtype=obs_dtype)
+        cache_path = None
+        if cache_dir is not None:
+            # the augmentations are random, so the random state is part of the key
+            _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+            key = cache_key(
+                dataset,
+                ["observations", "actions", "rewards", "costs", "terminals", "timeouts"],
+                dict(process_args,
+                     random_state=keys.tobytes(),
+                     random_pos=(pos, has_gauss, cached_gaussian)))
+            cache_path = os.path.join(cache_dir, key)
+
+        if cache_path is not None and os.path.isdir(cache_path):
+            self.__load(cache_path)
+            print(f"loaded the processed dataset from {cache_path}")
+        else:
+            self.__process(dataset, **process_args)
+            if cache_path is not None:
+                self.__save(cache_path)
+
+        # the cost transform is not part of the cache key, it is applied to the returns
+        # of the processed trajectories instead
+        if cost_sample:
+            first_cost_ret = self.buffers["cost_returns"][self.episode_offsets[:-1]]
+            trajs = [dict(cost_returns=[c]) for c in first_cost_ret]
+            self.sample_prob = compute_cost_sample_prob(trajs, cost_transform)
+
+        # build the samplers once, the start index tables of all the trajectories are
+        # stored as one flat array aligned with the buffers
+        self.traj_sampler = None
+        if self.sample_prob is not None:
+            self.traj_sampler = WeightedSampler(self.sample_prob)
+        if start_sampling:
+            self.start_idx_sampler = WeightedSampler(self.start_idx_prob,
+                                                     self.episode_offsets)
+
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self.rng = worker_generator(self.seed)
+
+    def __process(self, dataset, deg, pf_sample, max_rew_decrease, beta, augment_percent,
+                  max_reward, min_reward, cost_reverse, pf_only, rmin, cost_bins, npb,
+                  cost_sample, prob, start_sampling, random_aug, aug_rmin, aug_rmax,
+                  aug_cmin, aug_cmax, cgap, rstd, cstd, obs_dtype):
+        self.original_data, info = process_sequence_dataset(dataset, cost_reverse)
 
         self.aug_data = []
         if pf_only:
@@ -731,93 +1205,294 @@ class SequenceDataset(IterableDataset):
             f"original data: {len(self.original_data)}, augment data: {len(self.aug_data)}, total: {len(self.dataset)}"
         )
 
-        if cost_sample:
-            self.sample_prob = compute_cost_sample_prob(self.dataset, cost_transform)
-        elif pf_sample:
+        self.sample_prob = None
+        if pf_sample and not cost_sample:
             self.sample_prob = compute_sample_prob(self.dataset, self.pareto_frontier, 1)
-        else:
-            self.sample_prob = None
 
         # compute every trajectories start index sampling prob:
         if start_sampling:
-            self.start_idx_sample_prob = compute_start_index_sample_prob(
-                dataset=self.dataset, prob=prob)
+            self.start_idx_prob = np.concatenate(
+                compute_start_index_sample_prob(dataset=self.dataset, prob=prob))
+
+        # keep the trajectories as flat buffers instead of a list of dicts
+        self.__flatten(self.dataset)
+        del self.original_data, self.aug_data, self.dataset
+        self.buffers["observations"] = to_storage_dtype(self.buffers["observations"],
+                                                        obs_dtype)
+
+    def __save(self, path: str):
+        """
+        Saves the processed dataset together with the random state reached after
+        processing.
+        """
+        arrays = {f"buffer_{k}": v for k, v in self.buffers.items()}
+        for k in [
+                "traj_lens", "episode_offsets", "source_offsets", "sample_prob",
+                "start_idx_prob", "idx", "indices"
+        ]:
+            if getattr(self, k, None) is not None:
+                arrays[k] = np.asarray(getattr(self, k))
+        if hasattr(self, "pareto_frontier"):
+            arrays["pareto_frontier"] = self.pareto_frontier.coeffs
+        _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+        arrays["random_state"] = keys
+        arrays["random_pos"] = np.array([pos, has_gauss, cached_gaussian])
+        save_arrays(path, arrays)
+
+    def __load(self, path: str):
+        """
+        Memory-maps the arrays saved by `__save` and restores the random state, so that
+        the rest of the run is the same as without the cache.
+        """
+        arrays = load_arrays(path)
+        self.buffers = {
+            k[len("buffer_"):]: v
+            for k, v in arrays.items() if k.startswith("buffer_")
+        }
+        for k in ["traj_lens", "episode_offsets", "source_offsets", "idx", "indices"]:
+            if k in arrays:
+                setattr(self, k, np.asarray(arrays[k]))
+        self.sample_prob = np.asarray(
+            arrays["sample_prob"]) if "sample_prob" in arrays else None
+        if "start_idx_prob" in arrays:
+            self.start_idx_prob = np.asarray(arrays["start_idx_prob"])
+        if "pareto_frontier" in arrays:
+            self.pareto_frontier = np.poly1d(np.asarray(arrays["pareto_frontier"]))
+        pos, has_gauss, cached_gaussian = arrays["random_pos"]
+        np.random.set_state(("MT19937", np.asarray(arrays["random_state"]), int(pos),
+                             int(has_gauss), float(cached_gaussian)))
+
+    def __flatten(self, trajs: list):
+        """
+        Concatenates the trajectories into one contiguous array per field. The returns of
+        the i-th trajectory occupy [episode_offsets[i], episode_offsets[i + 1]) of their
+        buffers. The other fields are stored once per source trajectory, at source_offsets[i],
+        so the relabelled trajectories sharing their observations with another one do not
+        copy them again.
+        """
+        source_id, sources, source = {}, [], []
+        for traj in trajs:
+            key = id(traj["observations"])
+            if key not in source_id:
+                source_id[key] = len(sources)
+                sources.append(traj)
+            source.append(source_id[key])
+
+        self.traj_lens = np.array([traj["rewards"].shape[0] for traj in trajs])
+        self.episode_offsets = np.append(0, np.cumsum(self.traj_lens))
+        source_lens = np.array([traj["rewards"].shape[0] for traj in sources])
+        self.source_offsets = np.append(0, np.cumsum(source_lens))[source]
+        self.buffers = {
+            k: np.concatenate([traj[k] for traj in trajs])
+            for k in ["returns", "cost_returns"]
+        }
+        for k in ["observations", "actions", "costs"]:
+            self.buffers[k] = np.concatenate([traj[k] for traj in sources])
 
     def compute_pareto_return(self, cost):
         return self.pareto_frontier(cost)
 
-    def __prepare_sample(self, traj_idx, start_idx):
-        traj = self.dataset[traj_idx]
-        states = traj["observations"][start_idx:start_idx + self.seq_len]
-        actions = traj["actions"][start_idx:start_idx + self.seq_len]
-        returns = traj["returns"][start_idx:start_idx + self.seq_len]
-        cost_returns = traj["cost_returns"][start_idx:start_idx + self.seq_len]
-        time_steps = np.arange(start_idx, start_idx + self.seq_len)
-
-        costs = traj["costs"][start_idx:start_idx + self.seq_len]
-
-        episode_cost = traj["cost_returns"][0] * self.cost_scale
-
-        # states = (states - self.state_mean) / self.state_std
-        returns = returns * self.reward_scale
-        cost_returns = cost_returns * self.cost_scale
-        # pad up to seq_len if needed
-        mask = np.hstack(
-            [np.ones(states.shape[0]),
-             np.zeros(self.seq_len - states.shape[0])])
-        if states.shape[0] < self.seq_len:
-            states = pad_along_axis(states, pad_to=self.seq_len)
-            actions = pad_along_axis(actions, pad_to=self.seq_len)
-            returns = pad_along_axis(returns, pad_to=self.seq_len)
-            cost_returns = pad_along_axis(cost_returns, pad_to=self.seq_len)
-            costs = pad_along_axis(costs, pad_to=self.seq_len)
+    def __prepare_sample(self, traj_idx: np.ndarray, start_idx: np.ndarray):
+        """
+        Gathers the windows starting at start_idx of the trajectories traj_idx at once,
+        every returned array has the batch as its first dimension.
+        """
+        # [batch_size, seq_len] time steps of every window
+        time_steps = start_idx[:, None] + np.arange(self.seq_len)
+        # pad up to seq_len if needed, the padded steps point to the first step of the
+        # trajectory and are zeroed out after the gather
+        valid = time_steps < self.traj_lens[traj_idx][:, None]
+        steps = np.where(valid, time_steps, 0)
+        offsets = self.episode_offsets[traj_idx]
+        idx = offsets[:, None] + steps
+        source_idx = self.source_offsets[traj_idx][:, None] + steps
+
+        states = from_storage_dtype(self.buffers["observations"][source_idx],
+                                    self.obs_dtype)
+        actions = self.buffers["actions"][source_idx]
+        returns = self.buffers["returns"][idx] * self.reward_scale
+        cost_returns = self.buffers["cost_returns"][idx] * self.cost_scale
+        costs = self.buffers["costs"][source_idx]
+        for v in [states, actions, returns, cost_returns, costs]:
+            v[~valid] = 0.0
+        mask = valid.astype(np.float64)
+
+        episode_cost = self.buffers["cost_returns"][offsets] * self.cost_scale
 
         return states, actions, returns, cost_returns, time_steps, mask, episode_cost, costs
 
-    def __iter__(self):
+    def sample(self, batch_size: int):
+        """
+        Samples a batch of windows, drawing all trajectory ids and all start indices
+        at once. Returns padded [batch_size, seq_len, ...] arrays and the mask.
+        """
+        if self.traj_sampler is None:
+            traj_idx = self.rng.integers(self.traj_lens.shape[0], size=batch_size)
+        else:
+            traj_idx = self.traj_sampler.sample(batch_size, rng=self.rng)
+        if self.start_sampling:
+            start_idx = self.start_idx_sampler.sample(segment=traj_idx, rng=self.rng)
+        else:
+            start_idx = self.rng.integers(self.traj_lens[traj_idx])
+        return self.__prepare_sample(traj_idx, start_idx)
+
+    def __iter_random(self):
         while True:
-            traj_idx = np.random.choice(len(self.dataset), p=self.sample_prob)
-            # compute start index sampling prob
-            if self.start_sampling:
-                start_idx = np.random.choice(self.dataset[traj_idx]["rewards"].shape[0],
-                                             p=self.start_idx_sample_prob[traj_idx])
-            else:
-                start_idx = random.randint(
-                    0, self.dataset[traj_idx]["rewards"].shape[0] - 1)
+            yield self.sample(self.batch_size or 1)
+
+    def __iter_epochs(self):
+        # the window w starts at step w - episode_offsets[i] of the trajectory i
+        # containing it, so the windows are numbered like the flat buffers
+        num_windows = self.episode_offsets[-1]
+        for window in worker_epoch_batches(num_windows, self.batch_size or 1, self.seed):
+            traj_idx = np.searchsorted(self.episode_offsets, window, side="right") - 1
+            start_idx = window - self.episode_offsets[traj_idx]
             yield self.__prepare_sample(traj_idx, start_idx)
 
+    def __iter__(self):
+        if get_worker_info() is not None:
+            # a forked worker starts with a copy of the stream of the main process
+            self.rng = worker_generator(self.seed)
+        batches = self.__iter_epochs() if self.epoch_sampling else self.__iter_random()
+        for batch in batches:
+            if self.batch_size is not None:
+                yield batch
+            else:
+                yield tuple(v[0] for v in batch)
+
 
 class TransitionDataset(IterableDataset):
     """
     A dataset of transitions (state, action, reward, next state) used for training RL agents.
     
     Args:
-        dataset (dict): A dictionary of NumPy arrays containing the observations, actions, rewards, etc.
+        dataset (dict or callable): A dictionary of NumPy arrays containing the observations, actions, rewards, etc.
+            With `mmap_dir`, it can also be a function returning it, which is only
+            called if the memory-mapped copy does not exist yet.
         reward_scale (float): The scale factor for the rewards.
         cost_scale (float): The scale factor for the costs.
         state_init (bool): If True, the dataset will include an "is_init" flag indicating if a transition
             corresponds to the initial state of an episode.
-
+        batch_size (int, optional): If given, the dataset yields whole batches of this size
+            (drawn with a single index vector) instead of single transitions. Use it with
+            `DataLoader(batch_size=None)` or iterate over the dataset directly.
+        device (str, optional): If given, the whole dataset is moved to this device once and
+            batches are sampled there with `torch.randint`, so no per-step host-to-device copy
+            or DataLoader worker is needed. Requires `batch_size`.
+        mmap_dir (str, optional): If given, the sampled arrays are written once to .npy files
+            under this directory and memory-mapped read-only. The DataLoader workers and
+            the other runs on the same dataset then share the page cache instead of
+            holding private copies.
+        mmap_key (str, optional): The name of the memory-mapped copy under `mmap_dir`. It
+            must identify the dataset and its pre-processing, e.g. `shared_dataset_name`
+            of the task and the pre-processing arguments. The arrays are not hashed, an
+            existing copy is opened without loading the dataset. Required by `mmap_dir`.
+        seed (int, optional): The seed of the sampling streams, every DataLoader worker
+            draws from its own stream spawned from it. Defaults to a seed drawn from the
+            numpy random state.
+        epoch_sampling (bool): If True, the dataset walks shuffled permutations of the
+            transitions instead of sampling with replacement, every transition is seen
+            once per epoch. The DataLoader workers walk disjoint slices of each
+            permutation. The sampling probabilities are ignored.
+        obs_dtype (str, optional): The storage dtype of the observations and the next
+            observations, "float16" or "bfloat16", they are upcast to float32 when a batch
+            is gathered. The other fields keep their dtype. Defaults to the dtype of the
+            dataset.
     """
 
     def __init__(self,
                  dataset: dict,
                  reward_scale: float = 1.0,
                  cost_scale: float = 1.0,
-                 state_init: bool = False):
-        self.dataset = dataset
+                 state_init: bool = False,
+                 batch_size: Optional[int] = None,
+                 device: Optional[str] = None,
+                 mmap_dir: Optional[str] = None,
+                 mmap_key: Optional[str] = None,
+                 seed: Optional[int] = None,
+                 epoch_sampling: bool = False,
+                 obs_dtype: Optional[str] = None):
         self.reward_scale = reward_scale
         self.cost_scale = cost_scale
         self.sample_prob = None
         self.state_init = state_init
+        self.batch_size = batch_size
+        self.device = device
+        self.epoch_sampling = epoch_sampling
+        self.obs_dtype = obs_dtype
+
+        if mmap_dir is not None:
+            assert mmap_key is not None, "a memory-mapped dataset needs a mmap_key"
+            self.dataset = self.__open_mmap(dataset, mmap_dir, mmap_key)
+        else:
+            self.dataset = self.__prepare(dataset() if callable(dataset) else dataset)
         self.dataset_size = self.dataset["observations"].shape[0]
 
-        self.dataset["done"] = np.logical_or(self.dataset["terminals"],
-                                             self.dataset["timeouts"]).astype(np.float32)
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        self.rng = worker_generator(self.seed)
+
+        if self.device is not None:
+            assert self.batch_size is not None, \
+                "device-resident sampling needs a batch_size"
+            self.__to_device()
+
+    def __prepare(self, dataset: dict) -> dict:
+        """
+        Adds the done (and is_init) fields and casts the observations to their storage
+        dtype, in place.
+        """
+        dataset["done"] = np.logical_or(dataset["terminals"],
+                                        dataset["timeouts"]).astype(np.float32)
+        if self.state_init:
+            dataset["is_init"] = dataset["done"].copy()
+            dataset["is_init"][1:] = dataset["is_init"][:-1]
+            dataset["is_init"][0] = 1.0
+
+        for k in ["observations", "next_observations"]:
+            dataset[k] = to_storage_dtype(dataset[k], self.obs_dtype)
+        return dataset
+
+    def __open_mmap(self, dataset, mmap_dir: str, mmap_key: str) -> dict:
+        """
+        Returns read-only memory maps of the .npy copies of the sampled fields, which are
+        written first if they do not exist yet.
+        """
+        keys = [
+            "observations", "next_observations", "actions", "rewards", "costs", "done"
+        ]
+        if self.state_init:
+            keys.append("is_init")
+        path = os.path.join(mmap_dir,
+                            f"{mmap_key}_{self.obs_dtype}_{int(self.state_init)}")
+        if not os.path.isdir(path):
+            data = self.__prepare(dataset() if callable(dataset) else dataset)
+            save_arrays(path, {k: data[k] for k in keys})
+        return load_arrays(path)
+
+    def __to_device(self):
+        """
+        Copies the sampled fields to the target device once, with the rewards and
+        costs already scaled.
+        """
+        keys = [
+            "observations", "next_observations", "actions", "rewards", "costs", "done"
+        ]
         if self.state_init:
-            self.dataset["is_init"] = self.dataset["done"].copy()
-            self.dataset["is_init"][1:] = self.dataset["is_init"][:-1]
-            self.dataset["is_init"][0] = 1.0
+            keys.append("is_init")
+        self.tensors = {
+            k: torch.as_tensor(self.dataset[k], device=self.device)
+            for k in keys
+        }
+        if self.obs_dtype == "bfloat16":
+            # reinterpret the stored bits, torch has no uint16
+            for k in ["observations", "next_observations"]:
+                bits = torch.from_numpy(
+                    np.ascontiguousarray(self.dataset[k]).view(np.int16))
+                self.tensors[k] = bits.view(torch.bfloat16).to(self.device)
+        self.tensors["rewards"] = self.tensors["rewards"] * self.reward_scale
+        self.tensors["costs"] = self.tensors["costs"] * self.cost_scale
+        self.torch_rng = torch.Generator(device=self.device)
+        self.torch_rng.manual_seed(self.seed)
 
     def get_dataset_states(self):
         """
@@ -825,13 +1500,32 @@ class TransitionDataset(IterableDataset):
         as well as the standard deviations of the observation and action spaces.
         """
         init_state_propotion = self.dataset["is_init"].mean()
-        obs_std = self.dataset["observations"].std(0, keepdims=True)
+        obs_std = self.__obs_std()
         act_std = self.dataset["actions"].std(0, keepdims=True)
         return init_state_propotion, obs_std, act_std
 
+    def __obs_std(self, chunk_size: int = 65536) -> np.ndarray:
+        """
+        The standard deviation of the observations, upcast from the storage dtype one
+        chunk at a time instead of as a whole float32 copy.
+        """
+        observations = self.dataset["observations"]
+        n = observations.shape[0]
+
+        def chunks():
+            for start in range(0, n, chunk_size):
+                yield from_storage_dtype(observations[start:start + chunk_size],
+                                         self.obs_dtype)
+
+        mean = sum(x.sum(0, dtype=np.float64) for x in chunks()) / n
+        var = sum(((x - mean)**2).sum(0) for x in chunks()) / n
+        return np.sqrt(var, dtype=np.float32)[None]
+
     def __prepare_sample(self, idx):
-        observations = self.dataset["observations"][idx, :]
-        next_observations = self.dataset["next_observations"][idx, :]
+        observations = from_storage_dtype(self.dataset["observations"][idx, :],
+                                          self.obs_dtype)
+        next_observations = from_storage_dtype(self.dataset["next_observations"][idx, :],
+                                               self.obs_dtype)
         actions = self.dataset["actions"][idx, :]
         rewards = self.dataset["rewards"][idx] * self.reward_scale
         costs = self.dataset["costs"][idx] * self.cost_scale
@@ -841,7 +1535,139 @@ class TransitionDataset(IterableDataset):
             return observations, next_observations, actions, rewards, costs, done, is_init
         return observations, next_observations, actions, rewards, costs, done
 
-    def __iter__(self):
+    def __prepare_device_sample(self, idx):
+        half = (torch.float16, torch.bfloat16)
+        return tuple(v[idx].float() if v.dtype in half else v[idx]
+                     for v in self.tensors.values())
+
+    def sample(self, batch_size: int):
+        """
+        Samples a batch of transitions with a single index vector.
+        Every returned array has the batch as its first dimension.
+        """
+        if self.device is not None:
+            if self.sample_prob is None:
+                idx = torch.randint(self.dataset_size, (batch_size, ),
+                                    device=self.device,
+                                    generator=self.torch_rng)
+            else:
+                prob = torch.as_tensor(self.sample_prob, device=self.device)
+                idx = torch.multinomial(prob,
+                                        batch_size,
+                                        replacement=True,
+                                        generator=self.torch_rng)
+            return self.__prepare_device_sample(idx)
+        idx = self.rng.choice(self.dataset_size, size=batch_size, p=self.sample_prob)
+        return self.__prepare_sample(idx)
+
+    def __iter_random(self):
         while True:
-            idx = np.random.choice(self.dataset_size, p=self.sample_prob)
-            yield self.__prepare_sample(idx)
+            yield self.sample(self.batch_size or 1)
+
+    def __iter_epochs(self):
+        for idx in worker_epoch_batches(self.dataset_size, self.batch_size or 1,
+                                        self.seed):
+            if self.device is not None:
+                yield self.__prepare_device_sample(
+                    torch.as_tensor(idx, device=self.device))
+            else:
+                yield self.__prepare_sample(idx)
+
+    def __iter__(self):
+        if get_worker_info() is not None:
+            # a forked worker starts with a copy of the stream of the main process
+            self.rng = worker_generator(self.seed)
+        batches = self.__iter_epochs() if self.epoch_sampling else self.__iter_random()
+        for batch in batches:
+            if self.batch_size is not None:
+                yield batch
+            else:
+                # gather from a batch of one, so that the returned arrays are copies
+                # even when the dataset is memory-mapped read-only
+                yield tuple(v[0] for v in batch)
+
+
+class Prefetcher:
+    """
+    Wraps an iterator of batches with a background thread that keeps up to `num_batches`
+    of them ready, so that sampling overlaps with the training step. The batches are
+    converted to tensors and, on a CUDA device, copied from pinned memory with
+    non-blocking transfers on a side stream.
+
+    Args:
+        iterator (Iterator): Yields batches as tuples of arrays or tensors, e.g. an
+            iterator over a `TransitionDataset`, a `SequenceDataset` or their DataLoader.
+        device (str): The device of the returned batches. Defaults to "cpu".
+        num_batches (int): The maximum number of batches prepared ahead. Defaults to 2.
+    """
+
+    def __init__(self, iterator, device: str = "cpu", num_batches: int = 2):
+        self.iterator = iterator
+        self.device = torch.device(device)
+        self.cuda = self.device.type == "cuda"
+        # pinned memory only serves the non-blocking copies to a CUDA device
+        self.pin = self.cuda
+        self.stream = torch.cuda.Stream(self.device) if self.cuda else None
+        self.queue = queue.Queue(maxsize=num_batches)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.__produce, daemon=True)
+        self.thread.start()
+
+    def __to_tensor(self, x):
+        x = torch.as_tensor(x)
+        if self.pin and x.device.type == "cpu":
+            x = x.pin_memory()
+        return x
+
+    def __produce(self):
+        try:
+            for batch in self.iterator:
+                batch = [self.__to_tensor(x) for x in batch]
+                event = None
+                if self.cuda:
+                    with torch.cuda.stream(self.stream):
+                        batch = [x.to(self.device, non_blocking=True) for x in batch]
+                        event = torch.cuda.Event()
+                        event.record(self.stream)
+                else:
+                    batch = [x.to(self.device) for x in batch]
+                if not self.__put((batch, event)):
+                    return
+            self.__put(StopIteration())
+        except Exception as e:
+            self.__put(e)
+
+    def __put(self, item) -> bool:
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.stopped.is_set():
+            raise StopIteration
+        item = self.queue.get()
+        if isinstance(item, Exception):
+            self.stopped.set()
+            raise item
+        batch, event = item
+        if event is not None:
+            # wait for the copy and keep its memory alive for the consuming stream
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            for x in batch:
+                x.record_stream(current)
+        return tuple(batch)
+
+    def close(self):
+        """
+        Stops the background thread, the pending batches are dropped.
+        """
+        self.stopped.set()
+        self.thread.join()
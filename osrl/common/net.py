@@ -1,4 +1,5 @@
 import math
+import weakref
 from typing import Optional
 
 import numpy as np
@@ -30,6 +31,94 @@ def mlp(sizes, activation, output_activation=nn.Identity):
     return nn.Sequential(*layers)
 
 
+class EnsembleLinear(nn.Module):
+    """
+    A stack of independent linear layers evaluated with one batched matmul.
+
+    Args:
+        in_features (int): The size of the input of every member.
+        out_features (int): The size of the output of every member.
+        ensemble_size (int): The number of members.
+    """
+
+    def __init__(self, in_features, out_features, ensemble_size):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.ensemble_size = ensemble_size
+        self.weight = nn.Parameter(torch.empty(ensemble_size, in_features, out_features))
+        self.bias = nn.Parameter(torch.empty(ensemble_size, 1, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # the same distribution as the default initialization of nn.Linear
+        bound = 1 / math.sqrt(self.in_features)
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        """
+        Maps [ensemble_size, batch_size, in_features] to
+        [ensemble_size, batch_size, out_features], an input without the ensemble dimension
+        is shared by all the members.
+        """
+        if x.dim() == 2:
+            x = x.expand(self.ensemble_size, *x.shape)
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+def ensemble_mlp(sizes, ensemble_size, activation, output_activation=nn.Identity):
+    """
+    Creates an ensemble of `mlp`s of the same sizes whose layers are evaluated for all the
+    members at once.
+
+    Args:
+        sizes (list): A list of integers specifying the size of each layer in the MLP.
+        ensemble_size (int): The number of MLPs in the ensemble.
+        activation (nn.Module): The activation function to use for all layers except the output layer.
+        output_activation (nn.Module): The activation function to use for the output layer. Defaults to nn.Identity.
+
+    Returns:
+        nn.Sequential: Maps [batch_size, sizes[0]] or [ensemble_size, batch_size, sizes[0]] to
+            [ensemble_size, batch_size, sizes[-1]].
+    """
+    layers = []
+    for j in range(len(sizes) - 1):
+        act = activation if j < len(sizes) - 2 else output_activation
+        layer = EnsembleLinear(sizes[j], sizes[j + 1], ensemble_size)
+        layers += [layer, act()]
+    return nn.Sequential(*layers)
+
+
+def stack_ensemble_state_dict(state_dict, prefix, old_names, new_name):
+    """
+    Converts in place the parameters of ensembles stored as `nn.ModuleList`s of `mlp`s,
+    e.g. the checkpoints of the critics before they used `ensemble_mlp`, to the stacked
+    layout of one `ensemble_mlp`.
+
+    Args:
+        state_dict (dict): The state dict to convert.
+        prefix (str): The prefix of the module owning the ensembles in `state_dict`.
+        old_names (list): The names of the `nn.ModuleList`s, their members are stacked in
+            this order.
+        new_name (str): The name of the `ensemble_mlp`.
+    """
+    members = {}
+    for n, name in enumerate(old_names):
+        head = f"{prefix}{name}."
+        for key in [k for k in state_dict if k.startswith(head)]:
+            i, layer, param = key[len(head):].split(".")
+            members.setdefault((layer, param), {})[(n, int(i))] = state_dict.pop(key)
+    for (layer, param), tensors in members.items():
+        stacked = torch.stack([tensors[k] for k in sorted(tensors)])
+        # nn.Linear stores the weight as [out, in] and the bias as [out]
+        if param == "weight":
+            stacked = stacked.transpose(1, 2)
+        else:
+            stacked = stacked.unsqueeze(1)
+        state_dict[f"{prefix}{new_name}.{layer}.{param}"] = stacked
+
+
 class MLPGaussianPerturbationActor(nn.Module):
     """
     A MLP actor that adds Gaussian noise to the output.
@@ -220,26 +309,43 @@ class EnsembleQCritic(nn.Module):
     def __init__(self, obs_dim, act_dim, hidden_sizes, activation, num_q=2):
         super().__init__()
         assert num_q >= 1, "num_q param should be greater than 1"
-        self.q_nets = nn.ModuleList([
-            mlp([obs_dim + act_dim] + list(hidden_sizes) + [1], nn.ReLU)
-            for i in range(num_q)
-        ])
+        # all the Q networks are evaluated with one batched matmul per layer
+        self.q_nets = ensemble_mlp([obs_dim + act_dim] + list(hidden_sizes) + [1], num_q,
+                                   nn.ReLU)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the checkpoints with one mlp per Q network are stacked on the fly
+        if f"{prefix}q_nets.0.0.weight" in state_dict:
+            stack_ensemble_state_dict(state_dict, prefix, ["q_nets"], "q_nets")
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def q_values(self, obs, act=None):
+        """
+        Returns the values of all the Q networks as one [num_q, batch_size] tensor.
+        """
+        data = obs if act is None else torch.cat([obs, act], dim=-1)
+        return torch.squeeze(self.q_nets(data), -1)
 
     def forward(self, obs, act=None):
         # Squeeze is critical to ensure value has the right shape.
         # Without squeeze, the training stability will be greatly affected!
         # For instance, shape [3] - shape[3,1] = shape [3, 3] instead of shape [3]
-        data = obs if act is None else torch.cat([obs, act], dim=-1)
-        return [torch.squeeze(q(data), -1) for q in self.q_nets]
+        return list(self.q_values(obs, act))
 
     def predict(self, obs, act):
-        q_list = self.forward(obs, act)
-        qs = torch.vstack(q_list)  # [num_q, batch_size]
-        return torch.min(qs, dim=0).values, q_list
+        return self.predict_from(self.q_values(obs, act))
+
+    def predict_from(self, qs):
+        """
+        Returns the outputs of `predict` from the [num_q, batch_size] values of the Q
+        networks, e.g. computed by `CombinedCritics`.
+        """
+        return torch.min(qs, dim=0).values, list(qs)
 
     def loss(self, target, q_list=None):
-        losses = [((q - target)**2).mean() for q in q_list]
-        return sum(losses)
+        # the squared errors of all the Q networks are reduced at once
+        qs = torch.stack(q_list)  # [num_q, batch_size]
+        return ((qs - target)**2).mean(-1).sum()
 
 
 class EnsembleDoubleQCritic(nn.Module):
@@ -257,34 +363,51 @@ class EnsembleDoubleQCritic(nn.Module):
     def __init__(self, obs_dim, act_dim, hidden_sizes, activation, num_q=2):
         super().__init__()
         assert num_q >= 1, "num_q param should be greater than 1"
-        self.q1_nets = nn.ModuleList([
-            mlp([obs_dim + act_dim] + list(hidden_sizes) + [1], nn.ReLU)
-            for i in range(num_q)
-        ])
-        self.q2_nets = nn.ModuleList([
-            mlp([obs_dim + act_dim] + list(hidden_sizes) + [1], nn.ReLU)
-            for i in range(num_q)
-        ])
+        self.num_q = num_q
+        # the q1 networks are the first num_q members of the ensemble, the q2 networks
+        # the last num_q ones, all of them are evaluated with one batched matmul per layer
+        self.q_nets = ensemble_mlp([obs_dim + act_dim] + list(hidden_sizes) + [1],
+                                   2 * num_q, nn.ReLU)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the checkpoints with one mlp per Q network are stacked on the fly
+        if f"{prefix}q1_nets.0.0.weight" in state_dict:
+            stack_ensemble_state_dict(state_dict, prefix, ["q1_nets", "q2_nets"],
+                                      "q_nets")
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def q_values(self, obs, act):
+        """
+        Returns the values of the q1 and q2 networks as two [num_q, batch_size] tensors.
+        """
+        data = torch.cat([obs, act], dim=-1)
+        qs = torch.squeeze(self.q_nets(data), -1)
+        return qs[:self.num_q], qs[self.num_q:]
 
     def forward(self, obs, act):
         # Squeeze is critical to ensure value has the right shape.
         # Without squeeze, the training stability will be greatly affected!
         # For instance, shape [3] - shape[3,1] = shape [3, 3] instead of shape [3]
-        data = torch.cat([obs, act], dim=-1)
-        q1 = [torch.squeeze(q(data), -1) for q in self.q1_nets]
-        q2 = [torch.squeeze(q(data), -1) for q in self.q2_nets]
-        return q1, q2
+        qs1, qs2 = self.q_values(obs, act)
+        return list(qs1), list(qs2)
 
     def predict(self, obs, act):
-        q1_list, q2_list = self.forward(obs, act)
-        qs1, qs2 = torch.vstack(q1_list), torch.vstack(q2_list)
-        # qs = torch.vstack(q_list)  # [num_q, batch_size]
+        data = torch.cat([obs, act], dim=-1)
+        return self.predict_from(torch.squeeze(self.q_nets(data), -1))
+
+    def predict_from(self, qs):
+        """
+        Returns the outputs of `predict` from the [2 * num_q, batch_size] values of the q1
+        then the q2 networks, e.g. computed by `CombinedCritics`.
+        """
+        qs1, qs2 = qs[:self.num_q], qs[self.num_q:]  # [num_q, batch_size]
         qs1_min, qs2_min = torch.min(qs1, dim=0).values, torch.min(qs2, dim=0).values
-        return qs1_min, qs2_min, q1_list, q2_list
+        return qs1_min, qs2_min, list(qs1), list(qs2)
 
     def loss(self, target, q_list=None):
-        losses = [((q - target)**2).mean() for q in q_list]
-        return sum(losses)
+        # the squared errors of all the Q networks are reduced at once
+        qs = torch.stack(q_list)  # [num_q, batch_size]
+        return ((qs - target)**2).mean(-1).sum()
 
 
 class VAE(nn.Module):
@@ -353,6 +476,179 @@ class VAE(nn.Module):
         return torch.tanh(self.d3(a)), self.d3(a)
 
 
+# the flat parameter of every module flattened by flatten_parameters
+_flat_parameters = weakref.WeakKeyDictionary()
+
+
+def flatten_parameters(module, grad=True):
+    """
+    Moves the parameters of a module into one contiguous buffer, and their gradients into
+    another one, the parameters and the gradients become views of them. An optimizer
+    step, a soft update or a gradient norm over the flat parameter is then a single op,
+    and the tensors of the state dict, whose keys are unchanged, share one storage.
+
+    Args:
+        module (nn.Module): The module, all its parameters must have the same dtype and
+            device. It must not be moved afterwards.
+        grad (bool): Whether to allocate the flat gradient, False for target networks.
+
+    Returns:
+        nn.Parameter: The flat parameter, to optimize instead of the parameters of the
+            module. Its gradient must be zeroed in place, i.e. with
+            zero_grad(set_to_none=False), so that the gradients of the module stay views.
+    """
+    params = list(module.parameters())
+    flat = nn.Parameter(torch.cat([p.detach().reshape(-1) for p in params]))
+    if grad:
+        flat.grad = torch.zeros_like(flat)
+    offset = 0
+    for p in params:
+        n = p.numel()
+        p.data = flat.data[offset:offset + n].view_as(p)
+        if grad:
+            p.grad = flat.grad[offset:offset + n].view_as(p)
+        offset += n
+    _flat_parameters[module] = flat
+    return flat
+
+
+def module_parameters(module):
+    """
+    Returns the flat parameter of a module flattened by `flatten_parameters`, in a list,
+    or the parameters of the module otherwise.
+    """
+    if module in _flat_parameters:
+        return [_flat_parameters[module]]
+    return list(module.parameters())
+
+
+class CombinedCritics:
+    """
+    Evaluates several ensemble critics of the same hidden sizes on the same inputs, e.g.
+    the reward and the cost critics. With `stack`, the weights of every layer of all the
+    critics are kept in one persistent tensor, the critics being its consecutive members,
+    and they are evaluated with one batched matmul per layer. The parameters of every
+    critic become views of its slice, and their gradients views of the stacked gradient,
+    so each critic keeps its state dict keys, its optimizer over its own parameters, and
+    the soft update of its target, which then works on the slice of the stacked target.
+
+    Args:
+        critics (list): `EnsembleQCritic`s or `EnsembleDoubleQCritic`s. To be stacked,
+            they must be on the same device and not flattened by `flatten_parameters`,
+            and they must not be moved or copied afterwards.
+        stack (bool): Whether to stack the weights of the critics, they are evaluated one
+            after the other otherwise. Defaults to True.
+        grad (bool): Whether to allocate the stacked gradients, False for target networks.
+    """
+
+    def __init__(self, critics, stack=True, grad=True):
+        self.critics = critics
+        self.stack = stack
+        self.sizes = [critic.q_nets[0].ensemble_size for critic in critics]
+        # the stacked (weight, bias) of every EnsembleLinear, the activations otherwise
+        self.layers = []
+        if not stack:
+            return
+        assert not any(critic in _flat_parameters for critic in critics), \
+            "flattened critics can not be stacked"
+        for layers in zip(*[critic.q_nets for critic in critics]):
+            if not isinstance(layers[0], EnsembleLinear):
+                self.layers.append(layers[0])
+                continue
+            stacked = []
+            for name in ["weight", "bias"]:
+                params = [getattr(layer, name) for layer in layers]
+                tensor = torch.cat([p.detach() for p in params]).requires_grad_(grad)
+                if grad:
+                    tensor.grad = torch.zeros_like(tensor)
+                for p, data in zip(params, tensor.data.split(self.sizes)):
+                    p.data = data
+                if grad:
+                    for p, p_grad in zip(params, tensor.grad.split(self.sizes)):
+                        p.grad = p_grad
+                stacked.append(tensor)
+            self.layers.append(tuple(stacked))
+
+    def predict(self, obs, act):
+        """
+        Returns the outputs of `predict` of every critic on the same inputs.
+        """
+        if not self.stack:
+            return [critic.predict(obs, act) for critic in self.critics]
+        # the actor losses freeze the parameters of the critics, the gradients then only
+        # reach the inputs
+        frozen = not any(critic.q_nets[0].weight.requires_grad
+                         for critic in self.critics)
+        x = torch.cat([obs, act], dim=-1)
+        x = x.expand(sum(self.sizes), *x.shape)
+        for layer in self.layers:
+            if isinstance(layer, tuple):
+                weight, bias = [t.detach() if frozen else t for t in layer]
+                x = torch.baddbmm(bias, x, weight)
+            else:
+                x = layer(x)
+        qs = torch.squeeze(x, -1).split(self.sizes)
+        return [critic.predict_from(q) for critic, q in zip(self.critics, qs)]
+
+
+def build_adam(params, lr):
+    """
+    Adam with the fused implementation, one kernel for all the parameters, where torch
+    supports it on their device, and with the multi-tensor (foreach) one otherwise.
+    Both replace the loop over the parameters of the default implementation.
+    """
+    params = list(params)
+    try:
+        return torch.optim.Adam(params, lr=lr, fused=True)
+    except RuntimeError:
+        return torch.optim.Adam(params, lr=lr, foreach=True)
+
+
+@torch.no_grad()
+def soft_update(targets, sources, tau):
+    """
+    Polyak averaging target <- tau * source + (1 - tau) * target of the parameters of
+    all the target modules, in place with two multi-tensor ops and no temporaries. The
+    targets and the sources must be either all flattened by `flatten_parameters` or none.
+
+    Args:
+        targets (list): The target modules.
+        sources (list): The source modules, with the same parameters as the targets.
+        tau (float): The soft update coefficient.
+    """
+    tgt_params = [p for module in targets for p in module_parameters(module)]
+    src_params = [p for module in sources for p in module_parameters(module)]
+    torch._foreach_mul_(tgt_params, 1 - tau)
+    torch._foreach_add_(tgt_params, src_params, alpha=tau)
+
+
+class PolyakAverager:
+    """
+    Soft-updates target modules towards their sources once every `every` calls to `step`.
+    The coefficient is compounded over the skipped calls, 1 - (1 - tau)^every, so that
+    the targets forget their old weights at the same rate as with an update at every call.
+
+    Args:
+        targets (list): The target modules.
+        sources (list): The source modules, with the same parameters as the targets.
+        tau (float): The soft update coefficient of an update at every call.
+        every (int): The number of calls between two updates. Defaults to 1.
+    """
+
+    def __init__(self, targets, sources, tau, every=1):
+        assert every >= 1, "every should be at least 1"
+        self.targets = targets
+        self.sources = sources
+        self.tau = 1 - (1 - tau)**every
+        self.every = every
+        self.calls = 0
+
+    def step(self):
+        self.calls += 1
+        if self.calls % self.every == 0:
+            soft_update(self.targets, self.sources, self.tau)
+
+
 class LagrangianPIDController:
     '''
     Lagrangian multiplier controller
@@ -0,0 +1,189 @@
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Dict, Optional
+
+import numpy as np
+
+# the header block holds the json description of the arrays and the attached pids
+HEADER_SIZE = 1 << 16
+
+
+def shared_dataset_name(*args) -> str:
+    """
+    Hashes everything that identifies a dataset (task, pre-processing arguments, seed)
+    into a name usable for the shared memory blocks.
+    """
+    return "osrl_" + hashlib.blake2b(repr(args).encode(), digest_size=8).hexdigest()
+
+
+def untrack(shm: shared_memory.SharedMemory):
+    """
+    The resource tracker of python unlinks every block a process has opened when it
+    exits, even if other processes still use it, the blocks are released by reference
+    counting instead.
+    """
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SharedDataset:
+    """
+    A dict of numpy arrays published once in shared memory and attached read-only by
+    every other process using the same dataset. The processes attached to the blocks are
+    recorded in a header block, the last one to detach (or the first one to find only
+    dead processes left by crashed runs) unlinks them.
+
+    Args:
+        name (str): The name of the dataset, e.g. from `shared_dataset_name`.
+        loader (callable): Returns the dict of arrays, only called by the process that
+            publishes them.
+        lock_dir (str, optional): The directory of the lock file guarding the header.
+            Defaults to the temporary directory.
+    """
+
+    def __init__(self,
+                 name: str,
+                 loader: Callable[[], Dict[str, np.ndarray]],
+                 lock_dir: Optional[str] = None):
+        self.name = name
+        self.lock_path = os.path.join(lock_dir or tempfile.gettempdir(), name + ".lock")
+        self.blocks = []
+        self.arrays = {}
+        with self.__lock():
+            header = self.__open_header()
+            if header is None:
+                self.__publish(loader())
+            else:
+                self.__attach(header)
+        atexit.register(self.close)
+
+    @contextmanager
+    def __lock(self):
+        with open(self.lock_path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def __open_header(self) -> Optional[dict]:
+        try:
+            self.header = shared_memory.SharedMemory(name=self.name + "_meta")
+        except FileNotFoundError:
+            return None
+        untrack(self.header)
+        header = self.__read_header()
+        # the blocks left behind by crashed runs are published again
+        header["pids"] = [pid for pid in header["pids"] if pid_alive(pid)]
+        if len(header["pids"]) == 0:
+            self.__unlink(header)
+            self.header.close()
+            return None
+        return header
+
+    def __read_header(self) -> dict:
+        size = int.from_bytes(self.header.buf[:8], "little")
+        return json.loads(bytes(self.header.buf[8:8 + size]))
+
+    def __write_header(self, header: dict):
+        data = json.dumps(header).encode()
+        assert len(data) + 8 <= HEADER_SIZE, "too many arrays to share"
+        self.header.buf[:8] = len(data).to_bytes(8, "little")
+        self.header.buf[8:8 + len(data)] = data
+
+    def __publish(self, arrays: Dict[str, np.ndarray]):
+        header = {"arrays": [], "pids": [os.getpid()]}
+        self.header = shared_memory.SharedMemory(name=self.name + "_meta",
+                                                 create=True,
+                                                 size=HEADER_SIZE)
+        untrack(self.header)
+        for i, (k, v) in enumerate(arrays.items()):
+            v = np.ascontiguousarray(v)
+            # record every block before creating it, so that a crashed run leaves
+            # nothing the next one can not unlink
+            header["arrays"].append([k, f"{self.name}_{i}", v.dtype.str, list(v.shape)])
+            self.__write_header(header)
+            shm = shared_memory.SharedMemory(name=f"{self.name}_{i}",
+                                             create=True,
+                                             size=max(v.nbytes, 1))
+            untrack(shm)
+            np.ndarray(v.shape, v.dtype, buffer=shm.buf)[...] = v
+            self.blocks.append(shm)
+        self.__write_header(header)
+        self.__map(header)
+
+    def __attach(self, header: dict):
+        header["pids"].append(os.getpid())
+        self.__write_header(header)
+        for _, block, _, _ in header["arrays"]:
+            shm = shared_memory.SharedMemory(name=block)
+            untrack(shm)
+            self.blocks.append(shm)
+        self.__map(header)
+
+    def __map(self, header: dict):
+        for (k, _, dtype, shape), shm in zip(header["arrays"], self.blocks):
+            v = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+            v.flags.writeable = False
+            self.arrays[k] = v
+
+    def __unlink(self, header: dict):
+        # a fresh handle is tracked again, which unlink expects
+        blocks = [block for _, block, _, _ in header["arrays"]] + [self.name + "_meta"]
+        for block in blocks:
+            try:
+                shm = shared_memory.SharedMemory(name=block)
+                shm.close()
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """
+        Detaches from the blocks, the last process attached to them also unlinks them.
+        The arrays must not be used afterwards.
+        """
+        if self.header is None:
+            return
+        self.arrays = {}
+        with self.__lock():
+            header = self.__read_header()
+            header["pids"] = [
+                pid for pid in header["pids"] if pid != os.getpid() and pid_alive(pid)
+            ]
+            self.__write_header(header)
+            for shm in self.blocks:
+                try:
+                    shm.close()
+                except BufferError:
+                    # arrays still point to the block, it is unmapped on exit
+                    pass
+            if len(header["pids"]) == 0:
+                self.__unlink(header)
+            self.header.close()
+        self.blocks, self.header = [], None
+        atexit.unregister(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,214 @@
+import os
+import shutil
+import zipfile
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    print("h5py is not installed, can not stream HDF5 datasets.")
+
+from osrl.common.dataset import (fit_bc_frontier, load_arrays, segment_discounted_cumsum,
+                                 select_bc_transitions)
+
+Chunks = Iterable[Dict[str, np.ndarray]]
+
+
+def read_hdf5_chunks(
+        path: str,
+        chunk_size: int = 100_000,
+        keys: Optional[List[str]] = None) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Reads the arrays of an HDF5 dataset file (e.g. the ones of DSRL) chunk by chunk.
+
+    Args:
+        path (str): The path of the HDF5 file.
+        chunk_size (int): The number of transitions in every chunk. Defaults to 100_000.
+        keys (list, optional): The arrays to read. Defaults to all the top-level datasets.
+    """
+    with h5py.File(path, "r") as f:
+        if keys is None:
+            keys = [k for k in f.keys() if isinstance(f[k], h5py.Dataset)]
+        n_transitions = f[keys[0]].shape[0]
+        for start in range(0, n_transitions, chunk_size):
+            yield {k: f[k][start:start + chunk_size] for k in keys}
+
+
+def read_npz_chunks(paths: List[str],
+                    chunk_size: int = 100_000,
+                    keys: Optional[List[str]] = None) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Reads a dataset split into .npz shards chunk by chunk. The arrays of a shard are read
+    from the archive one chunk at a time, whether they are compressed or not, so a shard
+    is never loaded whole.
+
+    Args:
+        paths (list): The paths of the shards, in the order of the transitions.
+        chunk_size (int): The number of transitions in every chunk. Defaults to 100_000.
+        keys (list, optional): The arrays to read. Defaults to all the arrays of the shards.
+    """
+    for path in paths:
+        with zipfile.ZipFile(path) as shard:
+            names = keys or [
+                f[:-len(".npy")] for f in shard.namelist() if f.endswith(".npy")
+            ]
+            members = {k: shard.open(k + ".npy") for k in names}
+            headers = {k: read_npy_header(f) for k, f in members.items()}
+            n_transitions = next(iter(headers.values()))[0][0]
+            for start in range(0, n_transitions, chunk_size):
+                n = min(chunk_size, n_transitions - start)
+                chunk = {}
+                for k, f in members.items():
+                    shape, dtype = headers[k]
+                    row = int(np.prod(shape[1:], dtype=int))
+                    chunk[k] = np.frombuffer(f.read(n * row * dtype.itemsize),
+                                             dtype=dtype).reshape((n, ) + shape[1:])
+                yield chunk
+            for f in members.values():
+                f.close()
+
+
+def read_npy_header(f) -> Tuple[Tuple[int, ...], np.dtype]:
+    """
+    Reads the header of a .npy file up to its data, returns the shape and the dtype.
+    """
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+    if fortran_order or dtype.hasobject:
+        raise ValueError("only C-ordered arrays without objects can be streamed")
+    return shape, dtype
+
+
+def read_npy_chunks(path: str,
+                    chunk_size: int = 100_000) -> Iterator[Dict[str, np.ndarray]]:
+    """
+    Reads a directory of .npy files, e.g. written by `stream_bc_dataset`, chunk by chunk.
+    """
+    arrays = load_arrays(path)
+    n_transitions = next(iter(arrays.values())).shape[0]
+    for start in range(0, n_transitions, chunk_size):
+        yield {k: np.asarray(v[start:start + chunk_size]) for k, v in arrays.items()}
+
+
+def iter_episodes(chunks: Chunks) -> Iterator[Tuple[Dict[str, np.ndarray], bool]]:
+    """
+    Regroups a stream of transition chunks into (episode, complete) pairs, only the
+    unfinished episode is carried over from one chunk to the next. The transitions after
+    the last terminal or timeout are yielded last, as an incomplete episode.
+    """
+    carry = None
+    for chunk in chunks:
+        if carry is not None:
+            chunk = {k: np.concatenate([carry[k], v]) for k, v in chunk.items()}
+        done_idx = np.where((chunk["terminals"] == 1) | (chunk["timeouts"] == 1))[0]
+        start = 0
+        for end in done_idx + 1:
+            yield {k: v[start:end] for k, v in chunk.items()}, True
+            start = end
+        carry = {k: v[start:] for k, v in chunk.items()}
+    if carry is not None and carry["terminals"].shape[0] > 0:
+        yield carry, False
+
+
+def stream_bc_dataset(chunks_fn: Callable[[], Chunks], path: str, cost_limit: float,
+                      gamma: float, bc_mode: str) -> Dict[str, np.ndarray]:
+    """
+    The streaming version of `process_bc_dataset` for datasets larger than the memory.
+    The chunks are read twice: the first pass computes the return of every episode, the
+    second one writes the selected transitions to one .npy file per array. The memory used
+    is bounded by the chunk size and the longest episode, except for one return per
+    episode. The output matches `process_bc_dataset` on the same data.
+
+    Args:
+        chunks_fn (callable): Returns a new iterator over the chunks of the dataset, e.g.
+            `lambda: read_hdf5_chunks(file)`.
+        path (str): The directory of the processed datasets of this source. Every
+            combination of `cost_limit`, `gamma` and `bc_mode` is written to its own
+            subdirectory, an existing one is reused.
+        cost_limit (float): The maximum cost allowed for the dataset.
+        gamma (float): The discount factor used to compute the returns.
+        bc_mode (str): The behavior cloning mode, see `process_bc_dataset`.
+
+    Returns:
+        dict: The processed arrays, memory-mapped read-only. They can be passed to
+            `TransitionDataset` directly.
+    """
+    path = os.path.join(path, f"{bc_mode}_{cost_limit}_{gamma}")
+    if os.path.isdir(path):
+        return load_arrays(path)
+
+    # the first pass computes the episode returns as process_bc_dataset does, the
+    # transitions after the last terminal or timeout keep zero returns
+    cost_ret, rew_ret, lens, complete = [], [], [], []
+    specs = {}
+    for episode, done in iter_episodes(chunks_fn()):
+        complete.append(done)
+        costs, rewards = episode["costs"], episode["rewards"]
+        if done:
+            done_idx = np.array([costs.shape[0] - 1])
+            cost_ret.append(segment_discounted_cumsum(costs, done_idx, gamma)[1][0])
+            rew_ret.append(segment_discounted_cumsum(rewards, done_idx, gamma)[1][0])
+        else:
+            cost_ret.append(0)
+            rew_ret.append(0)
+        lens.append(costs.shape[0])
+        specs = {k: (v.dtype, v.shape[1:]) for k, v in episode.items()}
+    specs["cost_returns"] = (specs["costs"][0], ())
+    specs["rew_returns"] = (specs["rewards"][0], ())
+    cost_ret = np.array(cost_ret, dtype=specs["costs"][0])
+    rew_ret = np.array(rew_ret, dtype=specs["rewards"][0])
+    lens, complete = np.array(lens), np.array(complete)
+
+    frontier = None
+    if bc_mode == "frontier":
+        frontier = fit_bc_frontier(cost_ret[complete], rew_ret[complete])
+    # every transition of an episode shares its returns, so episodes are selected whole
+    selected = select_bc_transitions(cost_ret, rew_ret, cost_limit, bc_mode,
+                                     frontier) == 1
+    n_selected = int(np.sum(lens[selected]))
+    if bc_mode == "multi-task":
+        dtype, shape = specs["observations"]
+        specs["observations"] = (np.result_type(dtype, specs["cost_returns"][0]),
+                                 (shape[0] + 1, ))
+
+    # the second pass writes the selected episodes
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    os.makedirs(tmp_path, exist_ok=True)
+    out = {
+        k:
+        np.lib.format.open_memmap(os.path.join(tmp_path, k + ".npy"),
+                                  mode="w+",
+                                  dtype=dtype,
+                                  shape=(n_selected, ) + shape)
+        for k, (dtype, shape) in specs.items()
+    }
+    offset = 0
+    for i, (episode, _) in enumerate(iter_episodes(chunks_fn())):
+        if not selected[i]:
+            continue
+        n = lens[i]
+        episode["cost_returns"] = np.full(n, cost_ret[i])
+        episode["rew_returns"] = np.full(n, rew_ret[i])
+        if bc_mode == "multi-task":
+            episode["observations"] = np.hstack(
+                (episode["observations"], episode["cost_returns"].reshape(-1, 1)))
+        for k, v in episode.items():
+            out[k][offset:offset + n] = v
+        offset += n
+    for v in out.values():
+        v.flush()
+    del out
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process has written the same directory meanwhile
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+    print(f"original size = {np.sum(lens)}, cost limit = {cost_limit}, "
+          f"filtered size = {n_selected}")
+    return load_arrays(path)
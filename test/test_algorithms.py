@@ -0,0 +1,109 @@
+import copy
+
+import pytest
+import torch
+
+pytest.importorskip("fsrl")
+
+from osrl import algorithms  # noqa: E402
+
+ALGOS = {
+    "bcql": (algorithms.BCQL, algorithms.BCQLTrainer),
+    "bearl": (algorithms.BEARL, algorithms.BEARLTrainer),
+    "cpq": (algorithms.CPQ, algorithms.CPQTrainer),
+    "bcpq": (algorithms.BCPQ, algorithms.BCPQTrainer),
+}
+# the random draws that critic_loss and cost_critic_loss each make on their own
+SAMPLERS = {
+    "bcql": ["_next_actions"],
+    "bearl": ["_next_actions"],
+    "cpq": ["_actor_forward", "_ood_cost"],
+    "bcpq": ["_actor_forward"],
+}
+
+
+def pin_samplers(model, algo, cache):
+    """
+    Makes the samplers of the model return the draws cached for the same inputs, so that
+    the models sharing `cache` see the same samples.
+    """
+    for name in SAMPLERS[algo]:
+        sampler = getattr(model, name)
+
+        def pinned(x, *args, name=name, sampler=sampler):
+            key = (name, x.data_ptr()) + args
+            if key not in cache:
+                cache[key] = sampler(x, *args)
+            return cache[key]
+
+        setattr(model, name, pinned)
+
+
+def random_batch(g, batch_size, obs_dim, act_dim):
+    return [
+        torch.randn(batch_size, obs_dim, generator=g),
+        torch.randn(batch_size, obs_dim, generator=g),
+        torch.rand(batch_size, act_dim, generator=g) * 2 - 1,
+        torch.randn(batch_size, generator=g),
+        torch.rand(batch_size, generator=g),
+        (torch.rand(batch_size, generator=g) < 0.1).float(),
+    ]
+
+
+@pytest.mark.parametrize("algo", ["bcql", "bearl", "cpq", "bcpq"])
+def test_critics_loss(algo):
+    torch.manual_seed(0)
+    obs_dim, act_dim, batch_size = 5, 2, 32
+    model_cls, trainer_cls = ALGOS[algo]
+    model = model_cls(state_dim=obs_dim, action_dim=act_dim, max_action=1.0)
+    trainer_cls(model, None)
+    fused = copy.deepcopy(model)
+    trainer_cls(fused, None)
+    cache = {}
+    pin_samplers(model, algo, cache)
+    pin_samplers(fused, algo, cache)
+
+    observations, next_observations, actions, rewards, costs, done = random_batch(
+        torch.Generator().manual_seed(1), batch_size, obs_dim, act_dim)
+
+    # one update of both critics matches the two separate updates
+    loss_critic, _ = model.critic_loss(observations, next_observations, actions, rewards,
+                                       done)
+    loss_cost_critic, _ = model.cost_critic_loss(observations, next_observations,
+                                                 actions, costs, done)
+    fused_critic, _, fused_cost_critic, _ = fused.critics_loss(
+        observations, next_observations, actions, rewards, costs, done)
+    torch.testing.assert_close(fused_critic, loss_critic)
+    torch.testing.assert_close(fused_cost_critic, loss_cost_critic)
+    state_dict = model.state_dict()
+    for k, v in fused.state_dict().items():
+        torch.testing.assert_close(v, state_dict[k], msg=k)
+
+
+def train_model(algo, stack_critics, fused_critic_update, steps=3):
+    torch.manual_seed(0)
+    model_cls, trainer_cls = ALGOS[algo]
+    # BEARL waits 20k steps before updating the actor
+    kwargs = {"start_update_policy_step": 0} if algo == "bearl" else {}
+    model = model_cls(state_dim=5,
+                      action_dim=2,
+                      max_action=1.0,
+                      stack_critics=stack_critics,
+                      **kwargs)
+    trainer = trainer_cls(model, None, fused_critic_update=fused_critic_update)
+    g = torch.Generator().manual_seed(1)
+    for _ in range(steps):
+        trainer.train_one_step(*random_batch(g, 32, 5, 2))
+    return model
+
+
+@pytest.mark.parametrize("algo", ["bcql", "bearl", "cpq", "bcpq"])
+@pytest.mark.parametrize("fused_critic_update", [False, True])
+def test_stack_critics(algo, fused_critic_update):
+    model = train_model(algo, False, fused_critic_update)
+    stacked = train_model(algo, True, fused_critic_update)
+    # the stacked critics, and their targets, give the same training steps, up to the
+    # order of the sum over all their members of the gradient of the actions
+    state_dict = model.state_dict()
+    for k, v in stacked.state_dict().items():
+        torch.testing.assert_close(v, state_dict[k], msg=k)
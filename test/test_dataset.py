@@ -0,0 +1,551 @@
+import heapq
+import itertools
+import os
+from collections import defaultdict
+
+import numpy as np
+import pytest
+import torch
+from scipy.optimize import minimize
+from torch.utils.data import DataLoader
+
+from osrl.common.dataset import (CostBoundedNearest, Prefetcher, SequenceDataset,
+                                 TransitionDataset, WeightedSampler, cache_key,
+                                 discounted_cumsum, epoch_batches, from_storage_dtype,
+                                 grid_filter, pad_along_axis, pareto_distance,
+                                 process_bc_dataset, process_sequence_dataset,
+                                 random_augmentation, segment_discounted_cumsum,
+                                 select_optimal_trajectory, worker_generator)
+
+
+@pytest.mark.parametrize("gamma", [1.0, 0.99, 0.5, 0.0])
+def test_segment_discounted_cumsum(gamma):
+    rng = np.random.default_rng(0)
+    done_idx = np.cumsum(rng.integers(1, 50, 200)) - 1
+    # the transitions after the last episode are left out
+    x = rng.normal(size=done_idx[-1] + 10).astype(np.float32)
+    returns, totals = segment_discounted_cumsum(x, done_idx, gamma)
+
+    starts = np.append(0, done_idx[:-1] + 1)
+    expected = np.concatenate(
+        [discounted_cumsum(x[s:e + 1], gamma) for s, e in zip(starts, done_idx)])
+    assert returns.dtype == np.float32
+    np.testing.assert_array_equal(returns, expected)
+    np.testing.assert_array_equal(totals, expected[starts])
+
+
+def test_segment_discounted_cumsum_no_episode():
+    returns, totals = segment_discounted_cumsum(np.ones(5, np.float32), np.array([]),
+                                                0.9)
+    assert returns.shape == (0, ) and totals.shape == (0, )
+
+
+def random_transitions(n=1000, obs_dim=5, act_dim=2, seed=0):
+    rng = np.random.default_rng(seed)
+    observations = rng.normal(size=(n + 1, obs_dim)).astype(np.float32)
+    return {
+        "observations": observations[:-1],
+        "next_observations": observations[1:],
+        "actions": rng.uniform(-1, 1, (n, act_dim)).astype(np.float32),
+        "rewards": rng.normal(size=n).astype(np.float32),
+        "costs": rng.integers(0, 2, n).astype(np.float32),
+        "terminals": np.zeros(n, dtype=np.float32),
+        "timeouts": (np.arange(n) % 100 == 99).astype(np.float32),
+    }
+
+
+def random_episodes(n_episodes=30, obs_dim=3, act_dim=2, seed=0):
+    rng = np.random.default_rng(seed)
+    ends = np.cumsum(rng.integers(1, 40, n_episodes)) - 1
+    # the transitions after the last episode are not a complete episode
+    n = ends[-1] + 6
+    terminals, timeouts = np.zeros(n, dtype=np.float32), np.zeros(n, dtype=np.float32)
+    timeout = rng.random(n_episodes) < 0.5
+    terminals[ends[~timeout]] = 1
+    timeouts[ends[timeout]] = 1
+    return {
+        "observations": rng.normal(size=(n, obs_dim)).astype(np.float32),
+        "actions": rng.uniform(-1, 1, (n, act_dim)).astype(np.float32),
+        "rewards": rng.normal(size=n).astype(np.float32),
+        "costs": rng.integers(0, 2, n).astype(np.float32),
+        "terminals": terminals,
+        "timeouts": timeouts,
+    }
+
+
+@pytest.mark.parametrize("cost_reverse", [False, True])
+def test_process_sequence_dataset(cost_reverse):
+    data = random_episodes()
+    trajs, info = process_sequence_dataset(data, cost_reverse)
+
+    # the per-transition loop it replaces
+    expected, traj_lens, start, step = [], [], 0, 0
+    for i in range(data["rewards"].shape[0]):
+        if data["terminals"][i] or data["timeouts"][i]:
+            traj = {
+                k: data[k][start:i + 1]
+                for k in ["observations", "actions", "rewards", "costs"]
+            }
+            if cost_reverse:
+                traj["costs"] = 1.0 - traj["costs"]
+            traj["returns"] = discounted_cumsum(traj["rewards"], 1)
+            traj["cost_returns"] = discounted_cumsum(traj["costs"], 1)
+            expected.append(traj)
+            traj_lens.append(step)
+            start, step = i + 1, 0
+        step += 1
+
+    assert len(trajs) == len(expected)
+    for traj, ref in zip(trajs, expected):
+        assert traj.keys() == ref.keys()
+        for k, v in ref.items():
+            assert traj[k].dtype == np.float32
+            np.testing.assert_array_equal(traj[k], v)
+    np.testing.assert_array_equal(info["traj_lens"], traj_lens)
+
+
+def loader_rewards(epoch_sampling, num_batches=32):
+    dataset = TransitionDataset(random_transitions(),
+                                batch_size=32,
+                                seed=0,
+                                epoch_sampling=epoch_sampling)
+    it = iter(DataLoader(dataset, batch_size=None, num_workers=2))
+    return [next(it)[3].numpy() for _ in range(num_batches)]
+
+
+@pytest.mark.parametrize("epoch_sampling", [False, True])
+def test_transition_dataset_workers(epoch_sampling):
+    batches = loader_rewards(epoch_sampling)
+    # the workers draw the same batches from one run to the next
+    for a, b in zip(batches, loader_rewards(epoch_sampling)):
+        np.testing.assert_array_equal(a, b)
+
+    # the DataLoader takes the batches of the two workers in turns
+    workers = [np.concatenate(batches[0::2]), np.concatenate(batches[1::2])]
+    if epoch_sampling:
+        # 16 batches are one epoch of every worker, over disjoint halves of the dataset
+        assert not set(workers[0].tolist()) & set(workers[1].tolist())
+        np.testing.assert_array_equal(np.sort(np.concatenate(workers)),
+                                      np.sort(random_transitions()["rewards"]))
+    else:
+        # the workers have their own streams instead of copies of the same one
+        first, second = [{b.tobytes() for b in batches[i::2]} for i in range(2)]
+        assert not first & second
+
+
+def test_transition_dataset_mmap(tmp_path):
+    ref = next(iter(TransitionDataset(random_transitions(), batch_size=32, seed=0)))
+    dataset = TransitionDataset(random_transitions,
+                                batch_size=32,
+                                mmap_dir=str(tmp_path),
+                                mmap_key="random",
+                                seed=0)
+    assert isinstance(dataset.dataset["observations"], np.memmap)
+    for a, b in zip(ref, next(iter(dataset))):
+        np.testing.assert_array_equal(a, b)
+
+    def fail():
+        raise AssertionError("the dataset is loaded despite its memory-mapped copy")
+
+    # an existing copy is opened without loading the dataset
+    cached = TransitionDataset(fail,
+                               batch_size=32,
+                               mmap_dir=str(tmp_path),
+                               mmap_key="random",
+                               seed=0)
+    for a, b in zip(ref, next(iter(cached))):
+        np.testing.assert_array_equal(a, b)
+
+
+@pytest.mark.parametrize("obs_dtype", [None, "float16", "bfloat16"])
+def test_transition_dataset_obs_std(obs_dtype):
+    dataset = TransitionDataset(random_transitions(),
+                                batch_size=32,
+                                state_init=True,
+                                obs_dtype=obs_dtype)
+    _, obs_std, _ = dataset.get_dataset_states()
+    observations = from_storage_dtype(dataset.dataset["observations"], obs_dtype)
+    expected = observations.astype(np.float64).std(0, keepdims=True)
+    np.testing.assert_allclose(obs_std, expected, rtol=1e-6)
+
+
+def test_epoch_batches():
+    size, batch_size, num_shards = 1000, 32, 3
+    shards = [
+        epoch_batches(size, batch_size, seed=0, num_shards=num_shards, shard=i)
+        for i in range(num_shards)
+    ]
+    epochs = []
+    for _ in range(2):
+        epoch = []
+        for shard, n in zip(shards, [334, 333, 333]):
+            # every shard walks its slice of the permutation, 11 batches of up to 32
+            batches = [next(shard) for _ in range(11)]
+            assert sum(len(idx) for idx in batches) == n
+            epoch += batches
+        # the shards cover range(size) once per epoch, without overlapping
+        np.testing.assert_array_equal(np.sort(np.concatenate(epoch)), np.arange(size))
+        epochs.append({frozenset(idx.tolist()) for idx in epoch})
+    # the batches are drawn again every epoch
+    assert not epochs[0] & epochs[1]
+
+
+def test_transition_dataset_epoch_sampling():
+    data = random_transitions()
+    dataset = TransitionDataset(data, batch_size=32, seed=0, epoch_sampling=True)
+    it = iter(dataset)
+    # every transition is seen once per epoch
+    for _ in range(2):
+        rewards = np.concatenate([next(it)[3] for _ in range(32)])
+        np.testing.assert_array_equal(np.sort(rewards), np.sort(data["rewards"]))
+
+
+def baseline_window(traj, start_idx, seq_len):
+    """The window of one trajectory as SequenceDataset gathered it before flat buffers."""
+    keys = ["observations", "actions", "returns", "cost_returns", "costs"]
+    window = {k: traj[k][start_idx:start_idx + seq_len] for k in keys}
+    n = window["returns"].shape[0]
+    window = {k: pad_along_axis(v, pad_to=seq_len) for k, v in window.items()}
+    window["time_steps"] = np.arange(start_idx, start_idx + seq_len)
+    window["mask"] = np.hstack([np.ones(n), np.zeros(seq_len - n)])
+    window["episode_cost"] = traj["cost_returns"][0]
+    return window
+
+
+def assert_windows_equal(batch, trajs, traj_idx, start_idx, seq_len):
+    keys = [
+        "observations", "actions", "returns", "cost_returns", "time_steps", "mask",
+        "episode_cost", "costs"
+    ]
+    for i, (t, s) in enumerate(zip(traj_idx, start_idx)):
+        window = baseline_window(trajs[t], s, seq_len)
+        for k, v in zip(keys, batch):
+            np.testing.assert_allclose(v[i], window[k], rtol=1e-6, err_msg=k)
+
+
+def test_sequence_dataset_flat_buffers():
+    data = random_episodes()
+    trajs, _ = process_sequence_dataset(random_episodes())
+    dataset = SequenceDataset(data, seq_len=10, seed=0)
+    batch = dataset.sample(256)
+
+    # the trajectories and start indices drawn by sample
+    rng = worker_generator(0)
+    traj_idx = rng.integers(len(trajs), size=256)
+    start_idx = rng.integers([trajs[i]["rewards"].shape[0] for i in traj_idx])
+    assert_windows_equal(batch, trajs, traj_idx, start_idx, 10)
+    np.testing.assert_array_equal(
+        dataset.episode_offsets, np.cumsum([0] + [t["rewards"].shape[0] for t in trajs]))
+
+
+def test_sequence_dataset_relabelled_trajectories():
+    data = random_episodes()
+    aug_args = [0.5, 0, 600, 5, 50, 5, 1, 0.2]
+    np.random.seed(0)
+    dataset = SequenceDataset(data, seq_len=10, random_aug=aug_args[0], seed=0)
+    np.random.seed(0)
+    trajs, _ = process_sequence_dataset(data)
+    idx, aug_trajs = random_augmentation(trajs, *aug_args)
+
+    # the relabelled trajectories share all but their returns with their source, which
+    # is left unchanged, like with the deep copies they replace
+    originals, _ = process_sequence_dataset(data)
+    for i, traj in zip(idx, aug_trajs):
+        assert traj["observations"] is trajs[i]["observations"]
+        assert traj["returns"] is not trajs[i]["returns"]
+    for traj, ref in zip(trajs, originals):
+        for k, v in ref.items():
+            np.testing.assert_array_equal(traj[k], v)
+    # the shared arrays are stored once in the flat buffers
+    n_transitions = sum(traj["rewards"].shape[0] for traj in originals)
+    assert dataset.buffers["observations"].shape[0] == n_transitions
+    assert dataset.buffers["returns"].shape[0] > n_transitions
+
+    trajs = trajs + aug_trajs
+    batch = dataset.sample(256)
+    rng = worker_generator(0)
+    traj_idx = rng.integers(len(trajs), size=256)
+    start_idx = rng.integers([trajs[i]["rewards"].shape[0] for i in traj_idx])
+    assert_windows_equal(batch, trajs, traj_idx, start_idx, 10)
+
+
+def test_weighted_sampler():
+    rng = np.random.default_rng(0)
+    lens = np.array([5, 1, 20, 8])
+    offsets = np.append(0, np.cumsum(lens))
+    weights = rng.random(offsets[-1])
+    weights[[2, 10, 11]] = 0
+    probs = [
+        weights[s:e] / weights[s:e].sum() for s, e in zip(offsets[:-1], offsets[1:])
+    ]
+
+    # the draws are the ones of np.random.choice on the same random state
+    np.random.seed(0)
+    expected = np.random.choice(lens[0], size=1000, p=probs[0])
+    np.random.seed(0)
+    np.testing.assert_array_equal(WeightedSampler(weights[:5]).sample(1000), expected)
+
+    segment = rng.integers(lens.shape[0], size=1000)
+    np.random.seed(0)
+    expected = [np.random.choice(lens[i], p=probs[i]) for i in segment]
+    sampler = WeightedSampler(weights, offsets)
+    np.random.seed(0)
+    np.testing.assert_array_equal(sampler.sample(segment=segment), expected)
+    # the zero weights are never drawn
+    idx = sampler.sample(segment=np.full(100_000, 2), rng=np.random.default_rng(1))
+    assert not np.isin(idx, [10 - offsets[2], 11 - offsets[2]]).any()
+    assert np.all((idx >= 0) & (idx < lens[2]))
+
+
+def bfgs_distance(c, r, poly, starts):
+    dist_fun = lambda x: ((x - c)**2 + (poly(x) - r)**2)[0]
+    xs = [minimize(dist_fun, x0=x0, method="bfgs", tol=1e-10).x for x0 in starts]
+    return np.sqrt(dist_fun(np.maximum(min(xs, key=dist_fun), 0)))
+
+
+def test_pareto_distance():
+    rng = np.random.default_rng(0)
+    farther = 0
+    for _ in range(5):
+        # a degree-3 fit of a noisy frontier, non-monotone over the costs
+        xs = rng.uniform(0, 100, 30)
+        poly = np.poly1d(np.polyfit(xs, 0.5 * xs + rng.normal(0, 30, 30), 3))
+        c = rng.uniform(0, 100, 10)
+        r = poly(c) + rng.normal(0, 40, 10)
+        dist = pareto_distance(c, r, poly.coeffs)
+
+        for i in range(c.shape[0]):
+            # the closest of the local minima from many starts around the point
+            radius = abs(poly(c[i]) - r[i])
+            starts = c[i] + radius * np.linspace(-1, 1, 9)
+            ref = bfgs_distance(c[i], r[i], poly, starts)
+            np.testing.assert_allclose(dist[i], ref, rtol=1e-6, atol=1e-6)
+            # the single start from x = cost of the loop it replaces
+            farther += bfgs_distance(c[i], r[i], poly, [c[i]]) > ref + 1e-3
+    # some points are in the basin of a farther local minimum
+    assert farther > 0
+
+
+def numbered_batches(n=None, fail_after=None):
+    i = 0
+    while n is None or i < n:
+        if i == fail_after:
+            raise ValueError("sampling failed")
+        yield np.full((4, 3), i, dtype=np.float32), np.arange(4) + i
+        i += 1
+
+
+def test_prefetcher():
+    prefetcher = Prefetcher(numbered_batches(10), num_batches=3)
+    assert not prefetcher.pin
+    batches = list(prefetcher)
+    # the batches come in order, as tensors
+    assert len(batches) == 10
+    for i, (x, y) in enumerate(batches):
+        assert isinstance(x, torch.Tensor) and x.dtype == torch.float32
+        np.testing.assert_array_equal(x.numpy(), np.full((4, 3), i))
+        np.testing.assert_array_equal(y.numpy(), np.arange(4) + i)
+    # the end is reached again on the next calls
+    with pytest.raises(StopIteration):
+        next(prefetcher)
+    prefetcher.close()
+
+
+def test_prefetcher_exception():
+    prefetcher = Prefetcher(numbered_batches(fail_after=2))
+    assert next(prefetcher)[0][0, 0] == 0
+    assert next(prefetcher)[0][0, 0] == 1
+    # the error of the producer thread is raised in the consumer
+    with pytest.raises(ValueError, match="sampling failed"):
+        next(prefetcher)
+    with pytest.raises(StopIteration):
+        next(prefetcher)
+    prefetcher.close()
+
+
+def test_prefetcher_close():
+    # the producer of an endless iterator blocks on the full queue
+    prefetcher = Prefetcher(numbered_batches(), num_batches=2)
+    next(prefetcher)
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+    with pytest.raises(StopIteration):
+        next(prefetcher)
+
+
+def nearest_loop(points, queries, bounds):
+    """The per-query loop of get_nearest_point that CostBoundedNearest replaces."""
+    idxes = []
+    for p, bound in zip(queries, bounds):
+        mask = points[:, 0] <= bound
+        delta = points[mask, :] - p
+        dist = np.hypot(delta[:, 0], delta[:, 1])
+        idxes.append(np.flatnonzero(mask)[np.argmin(dist)])
+    return np.array(idxes)
+
+
+@pytest.mark.parametrize("n", [1, 31, 32, 33, 100, 257, 1000])
+@pytest.mark.parametrize("leaf_size", [1, 8, 32])
+def test_cost_bounded_nearest(n, leaf_size):
+    rng = np.random.default_rng(n)
+    # the integer costs tie, and some points are duplicated
+    points = np.stack([rng.integers(0, 50, n), rng.normal(size=n)], axis=1)
+    points[rng.integers(0, n, n // 10)] = points[rng.integers(0, n, n // 10)]
+    queries = np.stack([rng.uniform(0, 60, 300), rng.normal(size=300)], axis=1)
+    bounds = np.maximum(queries[:, 0], points[:, 0].min())
+    bounds[:50] = np.floor(bounds[:50])
+
+    nearest = CostBoundedNearest(points, leaf_size)
+    np.testing.assert_array_equal(nearest.query(queries, bounds),
+                                  nearest_loop(points, queries, bounds))
+    with pytest.raises(ValueError):
+        nearest.query(queries[:1], points[:, 0].min() - 1)
+
+
+def grid_bins_loop(x, y, xmin, xmax, ymin, ymax, xbins, ybins):
+    """The bins of the loop of grid_filter, before sampling the crowded ones."""
+    xmin, xmax = max(min(x), xmin), min(max(x), xmax)
+    ymin, ymax = max(min(y), ymin), min(max(y), ymax)
+    xbin_step = (xmax - xmin) / xbins
+    ybin_step = (ymax - ymin) / ybins
+    bin_hashmap = defaultdict(list)
+    for i in range(len(x)):
+        if x[i] < xmin or x[i] > xmax or y[i] < ymin or y[i] > ymax:
+            continue
+        x_bin_idx = (x[i] - xmin) // xbin_step
+        y_bin_idx = (y[i] - ymin) // ybin_step
+        bin_hashmap[(x_bin_idx, y_bin_idx)].append(i)
+    return list(bin_hashmap.values())
+
+
+@pytest.mark.parametrize("bounds", [(-np.inf, np.inf, -np.inf, np.inf), (5, 40, -1, 2)])
+@pytest.mark.parametrize("max_num_per_bin,min_num_per_bin", [(10, 1), (3, 0), (2, 2)])
+def test_grid_filter(bounds, max_num_per_bin, min_num_per_bin):
+    rng = np.random.default_rng(0)
+    # rounded values put points on the bin edges
+    x = np.round(rng.uniform(0, 50, 500), 1).astype(np.float32)
+    y = np.round(rng.normal(size=500), 1).astype(np.float32)
+    indices = grid_filter(x, y, *bounds, 6, 5, max_num_per_bin, min_num_per_bin, rng=rng)
+
+    expected, bin_of = [], {}
+    for b, v in enumerate(grid_bins_loop(x, y, *bounds, 6, 5)):
+        bin_of.update({i: b for i in v})
+        if len(v) > max_num_per_bin:
+            # the crowded bins keep a random sample of their points
+            kept = [i for i in indices if bin_of.get(i) == b]
+            assert len(kept) == len(set(kept)) == max_num_per_bin
+            assert set(kept) <= set(v)
+            expected += kept
+        elif len(v) > min_num_per_bin:
+            expected += v
+    assert indices == expected
+
+
+@pytest.mark.parametrize("rmin,max_num_per_bin", [(0, 1), (-1, 3)])
+def test_select_optimal_trajectory(rmin, max_num_per_bin):
+    rng = np.random.default_rng(0)
+    # the integer returns tie within the bins
+    trajs = [{
+        "id": i,
+        "returns": rng.integers(-2, 5, 1).astype(np.float32),
+        "cost_returns": rng.uniform(0, 30, 1).astype(np.float32),
+    } for i in range(300)]
+    selected = select_optimal_trajectory(trajs, rmin, 20, max_num_per_bin)
+
+    # the loop it replaces
+    rew = [traj["returns"][0] for traj in trajs]
+    cost = [traj["cost_returns"][0] for traj in trajs]
+    xbin_step = (max(cost) - min(cost)) / 20
+    bin_hashmap = defaultdict(list)
+    for i in range(len(cost)):
+        if rew[i] >= rmin:
+            bin_hashmap[(cost[i] - min(cost)) // xbin_step].append(i)
+    expected = []
+    for v in bin_hashmap.values():
+        expected += heapq.nlargest(max_num_per_bin, v, key=lambda i: rew[i])
+    assert [traj["id"] for traj in selected] == expected
+
+
+def test_cache_key():
+    data = random_episodes()
+    keys, args = ["observations", "rewards"], {"a": 1, "b": 2}
+    key = cache_key(data, keys, args)
+    # the order of the arguments and the memory layout of the arrays do not matter
+    assert cache_key(data, keys, {"b": 2, "a": 1}) == key
+    fortran = dict(data, observations=np.asfortranarray(data["observations"]))
+    assert cache_key(fortran, keys, args) == key
+
+    # a change of any value, dtype, shape, array or argument gives another key
+    rewards = data["rewards"].copy()
+    rewards[5] += 1
+    changed = [
+        cache_key(dict(data, rewards=rewards), keys, args),
+        cache_key(dict(data, rewards=data["rewards"].astype(np.float64)), keys, args),
+        cache_key(dict(data, observations=data["observations"].reshape(-1)), keys, args),
+        cache_key(data, ["observations", "costs"], args),
+        cache_key(data, keys, dict(args, b=3)),
+    ]
+    assert len({key, *changed}) == len(changed) + 1
+
+
+def sequence_run(data, seed, **kwargs):
+    np.random.seed(seed)
+    # the random augmentation and the sampling seed draw from the numpy random state
+    dataset = SequenceDataset(data,
+                              seq_len=5,
+                              batch_size=8,
+                              random_aug=0.5,
+                              aug_rmin=-50,
+                              aug_rmax=50,
+                              aug_cmin=0,
+                              aug_cmax=40,
+                              cgap=1,
+                              start_sampling=True,
+                              **kwargs)
+    batches = list(itertools.islice(iter(dataset), 3))
+    return dataset, batches, np.random.random(4)
+
+
+def test_sequence_dataset_cache(tmp_path, capsys):
+    data = random_episodes()
+    ref, ref_batches, ref_draws = sequence_run(data, 0)
+    for hit in [False, True]:
+        dataset, batches, draws = sequence_run(data, 0, cache_dir=str(tmp_path))
+        assert ("loaded the processed dataset" in capsys.readouterr().out) == hit
+        assert dataset.buffers.keys() == ref.buffers.keys()
+        for k, v in ref.buffers.items():
+            np.testing.assert_array_equal(dataset.buffers[k], v)
+        for k in ["episode_offsets", "source_offsets", "start_idx_prob", "idx"]:
+            np.testing.assert_array_equal(getattr(dataset, k), getattr(ref, k))
+        for batch, ref_batch in zip(batches, ref_batches):
+            for a, b in zip(batch, ref_batch):
+                np.testing.assert_array_equal(a, b)
+        # the random state after loading is the one reached by processing
+        np.testing.assert_array_equal(draws, ref_draws)
+    assert len(os.listdir(tmp_path)) == 1
+
+    # another random state gives other augmentations, processed again
+    sequence_run(data, 1, cache_dir=str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 2
+
+
+@pytest.mark.parametrize("bc_mode", ["all", "multi-task", "safe", "risky", "boundary"])
+def test_process_bc_dataset_no_copy(bc_mode):
+    caller = random_episodes()
+    originals = {k: v.copy() for k, v in caller.items()}
+    data = dict(caller)
+    process_bc_dataset(data, 10, 0.99, bc_mode, copy=False)
+
+    # the arrays of the caller are left as they were
+    for k, v in originals.items():
+        np.testing.assert_array_equal(caller[k], v)
+    # the result is the same as with the copies
+    copied = random_episodes()
+    process_bc_dataset(copied, 10, 0.99, bc_mode)
+    assert data.keys() == copied.keys()
+    for k, v in copied.items():
+        np.testing.assert_array_equal(data[k], v)
+    if bc_mode == "all":
+        # every transition is selected, so the arrays are not copied
+        for k in originals:
+            assert data[k] is caller[k]
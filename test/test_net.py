@@ -0,0 +1,196 @@
+import copy
+
+import pytest
+import torch
+import torch.nn as nn
+
+from osrl.common.net import (CombinedCritics, EnsembleDoubleQCritic, EnsembleQCritic,
+                             PolyakAverager, build_adam, flatten_parameters, mlp,
+                             module_parameters, soft_update)
+
+
+def old_ensemble(names, sizes, num_q):
+    """The critics before `ensemble_mlp`, with a `nn.ModuleList` of `mlp`s per name."""
+    module = nn.Module()
+    for name in names:
+        setattr(module, name, nn.ModuleList([mlp(sizes, nn.ReLU) for _ in range(num_q)]))
+    return module
+
+
+@pytest.mark.parametrize("double", [False, True])
+def test_load_old_critic_checkpoint(double):
+    torch.manual_seed(0)
+    obs_dim, act_dim, hidden_sizes, num_q = 5, 2, [16, 16], 3
+    names = ["q1_nets", "q2_nets"] if double else ["q_nets"]
+    critic_cls = EnsembleDoubleQCritic if double else EnsembleQCritic
+    # the critic is nested to check the prefixes of its keys
+    old = nn.Module()
+    old.critic = old_ensemble(names, [obs_dim + act_dim] + hidden_sizes + [1], num_q)
+    new = nn.Module()
+    new.critic = critic_cls(obs_dim, act_dim, hidden_sizes, nn.ReLU, num_q)
+    new.load_state_dict(old.state_dict())
+
+    obs, act = torch.randn(8, obs_dim), torch.randn(8, act_dim)
+    data = torch.cat([obs, act], dim=-1)
+    expected = [
+        torch.squeeze(q(data), -1) for name in names for q in getattr(old.critic, name)
+    ]
+    outputs = new.critic(obs, act)
+    if double:
+        outputs = outputs[0] + outputs[1]
+    for q, ref in zip(outputs, expected):
+        torch.testing.assert_close(q, ref)
+
+
+def train_critic(flat, steps=5):
+    torch.manual_seed(0)
+    critic = EnsembleDoubleQCritic(5, 2, [16, 16], nn.ReLU, 2)
+    critic_old = copy.deepcopy(critic)
+    if flat:
+        flatten_parameters(critic)
+        flatten_parameters(critic_old, grad=False)
+    optim = build_adam(module_parameters(critic), 1e-2)
+    g = torch.Generator().manual_seed(1)
+    for _ in range(steps):
+        obs, act = torch.randn(32, 5, generator=g), torch.randn(32, 2, generator=g)
+        target = torch.randn(32, generator=g)
+        _, _, q1_list, q2_list = critic.predict(obs, act)
+        loss = critic.loss(target, q1_list) + critic.loss(target, q2_list)
+        optim.zero_grad(set_to_none=False)
+        loss.backward()
+        optim.step()
+        soft_update([critic_old], [critic], 0.1)
+    return critic, critic_old
+
+
+def test_flatten_parameters():
+    critic, critic_old = train_critic(flat=False)
+    flat_critic, flat_critic_old = train_critic(flat=True)
+    # the flat buffers give the same updates, and the same state dicts
+    for module, flat_module in [(critic, flat_critic), (critic_old, flat_critic_old)]:
+        state_dict, flat_state_dict = module.state_dict(), flat_module.state_dict()
+        assert state_dict.keys() == flat_state_dict.keys()
+        for k, v in state_dict.items():
+            torch.testing.assert_close(flat_state_dict[k], v, rtol=0, atol=0)
+
+    # loading a state dict writes through to the flat parameter
+    (flat, ) = module_parameters(flat_critic_old)
+    flat_critic_old.load_state_dict(critic.state_dict())
+    torch.testing.assert_close(flat, module_parameters(flat_critic)[0])
+
+
+def train_critics(stack, steps=5):
+    torch.manual_seed(0)
+    # a reward and a cost critic, with different ensemble sizes
+    critics = [
+        EnsembleDoubleQCritic(5, 2, [16, 16], nn.ReLU, 2),
+        EnsembleDoubleQCritic(5, 2, [16, 16], nn.ReLU, 3)
+    ]
+    critics_old = copy.deepcopy(critics)
+    combined = CombinedCritics(critics, stack)
+    combined_old = CombinedCritics(critics_old, stack, grad=False)
+    optims = [build_adam(module_parameters(critic), 1e-2) for critic in critics]
+    g = torch.Generator().manual_seed(1)
+    act_grads = []
+    for _ in range(steps):
+        obs, act = torch.randn(32, 5, generator=g), torch.randn(32, 2, generator=g)
+        with torch.no_grad():
+            targets = [q1 + 0.5 for q1, _, _, _ in combined_old.predict(obs, act)]
+        loss = 0
+        for critic, target, (_, _, q1_list, q2_list) in zip(critics, targets,
+                                                            combined.predict(obs, act)):
+            loss = loss + critic.loss(target, q1_list) + critic.loss(target, q2_list)
+        for optim in optims:
+            optim.zero_grad(set_to_none=False)
+        loss.backward()
+        for optim in optims:
+            optim.step()
+        soft_update(critics_old, critics, 0.1)
+
+        # with frozen parameters, like in the actor losses, only the inputs get gradients
+        params = [p for critic in critics for p in critic.parameters()]
+        grads = [p.grad.clone() for p in params]
+        for p in params:
+            p.requires_grad = False
+        act.requires_grad = True
+        sum(q1.sum() for q1, _, _, _ in combined.predict(obs, act)).backward()
+        act_grads.append(act.grad)
+        for p, grad in zip(params, grads):
+            p.requires_grad = True
+            torch.testing.assert_close(p.grad, grad, rtol=0, atol=0)
+    return critics, critics_old, act_grads
+
+
+def test_combined_critics():
+    critics, critics_old, act_grads = train_critics(stack=False)
+    stacked, stacked_old, stacked_act_grads = train_critics(stack=True)
+    # the stacked critics give the same updates, and the same state dicts
+    for module, stacked_module in zip(critics + critics_old, stacked + stacked_old):
+        state_dict, stacked_state_dict = module.state_dict(), stacked_module.state_dict()
+        assert state_dict.keys() == stacked_state_dict.keys()
+        for k, v in state_dict.items():
+            torch.testing.assert_close(stacked_state_dict[k], v, rtol=0, atol=0)
+    # the gradient of the actions is summed over all the members at once
+    for grad, stacked_grad in zip(act_grads, stacked_act_grads):
+        torch.testing.assert_close(stacked_grad, grad)
+
+    # the critics, and their targets, are slices of one persistent tensor per layer
+    for modules in [stacked, stacked_old]:
+        weights = [critic.q_nets[0].weight for critic in modules]
+        assert weights[0].data_ptr() + weights[0].numel() * 4 == weights[1].data_ptr()
+
+
+def random_modules(seed):
+    torch.manual_seed(seed)
+    return [EnsembleDoubleQCritic(5, 2, [16, 16], nn.ReLU, 2), mlp([5, 16, 2], nn.ReLU)]
+
+
+def soft_update_loop(targets, sources, tau):
+    """The per-parameter loop of the algorithms that soft_update replaces."""
+    for tgt, src in zip(targets, sources):
+        for tgt_param, src_param in zip(tgt.parameters(), src.parameters()):
+            tgt_param.data.copy_(tau * src_param.data + (1 - tau) * tgt_param.data)
+
+
+def assert_same_modules(modules, expected):
+    for module, ref in zip(modules, expected):
+        state_dict = ref.state_dict()
+        for k, v in module.state_dict().items():
+            torch.testing.assert_close(v, state_dict[k], msg=k)
+
+
+@pytest.mark.parametrize("flat", [False, True])
+def test_soft_update(flat):
+    sources, targets = random_modules(0), random_modules(1)
+    expected = copy.deepcopy(targets)
+    if flat:
+        for source, target in zip(sources, targets):
+            flatten_parameters(source)
+            flatten_parameters(target, grad=False)
+    for _ in range(3):
+        soft_update(targets, sources, 0.1)
+        soft_update_loop(expected, sources, 0.1)
+    assert_same_modules(targets, expected)
+
+
+def test_polyak_averager_every():
+    sources, targets = random_modules(0), random_modules(1)
+    stepwise = copy.deepcopy(targets)
+    averager = PolyakAverager(targets, sources, 0.1, every=4)
+    stepwise_averager = PolyakAverager(stepwise, sources, 0.1)
+    for call in range(1, 13):
+        before = copy.deepcopy(targets)
+        averager.step()
+        stepwise_averager.step()
+        if call % 4 != 0:
+            # the targets are only updated at every 4th call
+            for module, ref in zip(targets, before):
+                for p, p_ref in zip(module.parameters(), ref.parameters()):
+                    torch.testing.assert_close(p, p_ref, rtol=0, atol=0)
+            continue
+        # one update with the compounded coefficient is 4 updates towards the same
+        # sources
+        assert_same_modules(targets, stepwise)
+        with torch.no_grad():
+            for p in [p for source in sources for p in source.parameters()]:
+                p.add_(torch.randn_like(p))
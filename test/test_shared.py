@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+from multiprocessing import shared_memory
+
+import numpy as np
+import pytest
+
+from osrl.common.shared import SharedDataset, shared_dataset_name
+
+fork = multiprocessing.get_context("fork")
+
+
+def arrays(seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        "observations": rng.normal(size=(100, 4)).astype(np.float32),
+        "actions": rng.uniform(-1, 1, (100, 2)),
+        "timeouts": np.zeros(0, dtype=np.float32),
+    }
+
+
+def fail():
+    raise AssertionError("the dataset is loaded again despite its published copy")
+
+
+def attach(name, lock_dir):
+    with SharedDataset(name, fail, lock_dir) as shared:
+        for k, v in arrays().items():
+            np.testing.assert_array_equal(shared.arrays[k], v)
+
+
+def publish_and_crash(name, lock_dir):
+    SharedDataset(name, arrays, lock_dir)
+    # exits without detaching, like a crashed run
+    os._exit(0)
+
+
+def run(target, *args):
+    p = fork.Process(target=target, args=args)
+    p.start()
+    p.join()
+    assert p.exitcode == 0
+
+
+def is_published(name):
+    try:
+        shared_memory.SharedMemory(name=name + "_meta").close()
+    except FileNotFoundError:
+        return False
+    return True
+
+
+@pytest.fixture
+def name(tmp_path):
+    name = shared_dataset_name("test", str(tmp_path))
+    yield name
+    assert not is_published(name)
+
+
+def test_shared_dataset(name, tmp_path):
+    shared = SharedDataset(name, arrays, str(tmp_path))
+    for k, v in arrays().items():
+        np.testing.assert_array_equal(shared.arrays[k], v)
+        assert not shared.arrays[k].flags.writeable
+
+    # the other processes attach without loading, and detaching keeps the blocks
+    run(attach, name, str(tmp_path))
+    run(attach, name, str(tmp_path))
+    assert is_published(name)
+    # the last process to detach unlinks them
+    shared.close()
+    assert not is_published(name)
+
+
+def test_shared_dataset_crashed_run(name, tmp_path):
+    run(publish_and_crash, name, str(tmp_path))
+    assert is_published(name)
+    # the blocks of a dead process are published again from the loader
+    with SharedDataset(name, lambda: arrays(1), str(tmp_path)) as shared:
+        for k, v in arrays(1).items():
+            np.testing.assert_array_equal(shared.arrays[k], v)
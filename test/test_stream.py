@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from osrl.common.dataset import process_bc_dataset
+from osrl.common.stream import read_npz_chunks, stream_bc_dataset
+
+
+def random_episodes(n_episodes=50, obs_dim=3, seed=0):
+    rng = np.random.default_rng(seed)
+    ends = np.cumsum(rng.integers(1, 40, n_episodes)) - 1
+    # the transitions after the last episode are not a complete episode
+    n = ends[-1] + 8
+    timeout = rng.random(n_episodes) < 0.5
+    terminals, timeouts = np.zeros(n, dtype=np.float32), np.zeros(n, dtype=np.float32)
+    terminals[ends[~timeout]] = 1
+    timeouts[ends[timeout]] = 1
+    return {
+        "observations": rng.normal(size=(n, obs_dim)).astype(np.float32),
+        "actions": rng.uniform(-1, 1, (n, 2)).astype(np.float32),
+        "rewards": rng.normal(size=n).astype(np.float32),
+        "costs": rng.integers(0, 2, n).astype(np.float32),
+        "terminals": terminals,
+        "timeouts": timeouts,
+    }
+
+
+@pytest.mark.parametrize("compressed", [False, True])
+def test_read_npz_chunks(tmp_path, compressed):
+    data = random_episodes()
+    save = np.savez_compressed if compressed else np.savez
+    half = data["costs"].shape[0] // 2
+    paths = [str(tmp_path / "0.npz"), str(tmp_path / "1.npz")]
+    save(paths[0], **{k: v[:half] for k, v in data.items()})
+    save(paths[1], **{k: v[half:] for k, v in data.items()})
+
+    chunks = list(read_npz_chunks(paths, chunk_size=64))
+    assert all(c["costs"].shape[0] <= 64 for c in chunks)
+    for k, v in data.items():
+        np.testing.assert_array_equal(np.concatenate([c[k] for c in chunks]), v)
+
+
+@pytest.mark.parametrize("bc_mode", ["all", "multi-task", "safe", "risky", "boundary"])
+@pytest.mark.parametrize("gamma", [1.0, 0.99])
+def test_stream_bc_dataset(tmp_path, bc_mode, gamma):
+    np.savez(tmp_path / "data.npz", **random_episodes())
+
+    def chunks_fn():
+        return read_npz_chunks([str(tmp_path / "data.npz")], chunk_size=50)
+
+    # every cost limit gets its own directory instead of reusing the first one
+    for cost_limit in [10, 5]:
+        streamed = stream_bc_dataset(chunks_fn, str(tmp_path), cost_limit, gamma,
+                                     bc_mode)
+        data = random_episodes()
+        process_bc_dataset(data, cost_limit, gamma, bc_mode)
+        assert streamed.keys() == data.keys()
+        for k, v in data.items():
+            np.testing.assert_allclose(streamed[k], v, rtol=1e-6)
+
+
+def test_stream_bc_dataset_frontier(tmp_path):
+    pytest.importorskip("oapackage")
+    data = random_episodes()
+    np.savez(tmp_path / "data.npz", **data)
+    streamed = stream_bc_dataset(
+        lambda: read_npz_chunks([str(tmp_path / "data.npz")], chunk_size=50),
+        str(tmp_path), 10, 1.0, "frontier")
+    process_bc_dataset(data, 10, 1.0, "frontier")
+    for k, v in data.items():
+        np.testing.assert_allclose(streamed[k], v, rtol=1e-6)